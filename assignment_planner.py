@@ -0,0 +1,360 @@
+from naive_centralized_algorithm import RoleAssignmentService
+from assignment_solvers import BacktrackingSolver, HopcroftKarpSolver, HungarianSolver
+from network import SimulatedNetwork, InlineExecutor
+from role_criteria import evaluate_grade_matrix
+import logging
+import random
+import numpy
+import math
+import csv
+import os
+
+##################################################################################
+# Planner choosing between the centralized RoleAssignmentService and the token
+# algorithm of the logical nodes. It grades a sample of the nodes to estimate the
+# density of the grade matrix, predicts the compute time and traffic of both
+# strategies with a cost model calibrated from benchmark output (the CSV of
+# benchmarks.run, or the legacy metrics_naive.csv / metrics_smart.csv), adds the
+# time the traffic takes on the network, and runs the cheaper strategy.
+##################################################################################
+
+logger = logging.getLogger(__name__)
+
+CENTRALIZED = "centralized"
+TOKEN = "token"
+STRATEGIES = [CENTRALIZED, TOKEN]
+
+# Metrics predicted by the cost model, each from the features of cost_features
+METRICS = ["compute_time", "bytes"]
+
+def solver_name(solver):
+    """
+    Name of a centralized solver in the cost model, None being the RoleAssignmentService
+    default. The token strategy has no solver.
+    """
+    return solver.__class__.__name__ if solver is not None else HopcroftKarpSolver.__name__
+
+def cost_features(num_nodes, num_roles, num_edges):
+    """
+    Constant, nodes, roles, node x role pairs, and satisfiable pairs (edges)
+    """
+    return [1.0, float(num_nodes), float(num_roles), float(num_nodes) * num_roles, float(num_edges)]
+
+def fit_nonnegative(features, targets):
+    """
+    Least squares fit of targets ~ features . coefficients, with nonnegative coefficients,
+    weighting every row by its target so that the relative error is minimized. Features
+    that are a linear combination of the ones before them in the samples (e.g. roles and
+    edges when every sample has as many of both as nodes) are left out, their effect being
+    carried by those. Features whose coefficient comes out negative are dropped and the
+    rest refitted.
+    """
+    features = numpy.asarray(features, dtype=float)
+    targets = numpy.asarray(targets, dtype=float)
+    weights = 1.0 / numpy.maximum(targets, 1e-12)
+
+    coefficients = numpy.zeros(features.shape[1])
+    active = independent_columns(features)
+    while active:
+        solution = numpy.linalg.lstsq(features[:, active] * weights[:, None], targets * weights, rcond=None)[0]
+        if (solution >= 0).all():
+            coefficients[active] = solution
+            break
+        active = [column for (column, coefficient) in zip(active, solution) if coefficient > 0]
+    return coefficients
+
+def independent_columns(features):
+    """
+    Columns of features that are nonzero and not a linear combination of the columns kept
+    before them
+    """
+    scales = numpy.abs(features).max(axis=0)
+    kept = []
+    for column in range(features.shape[1]):
+        if not scales[column]:
+            continue
+        candidate = kept + [column]
+        if numpy.linalg.matrix_rank(features[:, candidate] / scales[candidate]) == len(candidate):
+            kept = candidate
+    return kept
+
+# Strategy and solver of the rows of benchmarks.run, by their strategy name
+BENCHMARK_STRATEGIES = {
+    "centralized": (CENTRALIZED, HopcroftKarpSolver.__name__),
+    "centralized_hungarian": (CENTRALIZED, HungarianSolver.__name__),
+    "distributed": (TOKEN, None)
+}
+
+def read_benchmark_csv(path, strategy=None):
+    """
+    Reads calibration samples from benchmark output. Two formats are understood:
+
+    - the --csv output of benchmarks.run, see BENCHMARK_STRATEGIES
+    - the legacy metrics_naive.csv / metrics_smart.csv (num_nodes_and_roles, scenario,
+      elapsed_time, bytes_transferred), for which strategy must be given: the naive
+      script ran the centralized backtracking solver, the smart one the token algorithm.
+      Every legacy sample has as many roles as nodes.
+
+    Returns a list of sample dictionaries.
+    """
+    samples = []
+    with open(path) as input_file:
+        reader = csv.DictReader(input_file)
+
+        if "num_nodes_and_roles" in reader.fieldnames:
+            if strategy not in STRATEGIES:
+                raise ValueError("the strategy of legacy benchmark output %s must be given" % path)
+            for row in reader:
+                size = int(row["num_nodes_and_roles"])
+                # The legacy scenarios, see benchmarks.scenarios.legacy_worst_case and legacy_best_case
+                if row["scenario"] == "worst_case":
+                    (num_edges, flexible_nodes) = (size * (size + 1) / 2, size - 1)
+                elif row["scenario"] == "best_case":
+                    (num_edges, flexible_nodes) = (size, 0)
+                else:
+                    continue
+                samples.append({
+                    "strategy": strategy,
+                    "solver": BacktrackingSolver.__name__ if strategy == CENTRALIZED else None,
+                    "num_nodes": size,
+                    "num_roles": size,
+                    "num_edges": num_edges,
+                    "flexible_nodes": flexible_nodes,
+                    "compute_time": float(row["elapsed_time"]),
+                    "bytes": float(row["bytes_transferred"])
+                })
+        else:
+            for row in reader:
+                if row["strategy"] not in BENCHMARK_STRATEGIES:
+                    continue
+                (sample_strategy, solver) = BENCHMARK_STRATEGIES[row["strategy"]]
+                samples.append({
+                    "strategy": sample_strategy,
+                    "solver": solver,
+                    "num_nodes": int(row["num_nodes"]),
+                    "num_roles": int(row["num_roles"]),
+                    "num_edges": int(row["num_edges"]) if row.get("num_edges") else None,
+                    "flexible_nodes": None,
+                    "compute_time": float(row["wall_time"]),
+                    "bytes": float(row["bytes"])
+                })
+    return samples
+
+class CostModel:
+    """
+    Linear model of the compute time and bytes of each strategy and centralized solver (see
+    solver_name) over cost_features, plus, for the backtracking solver, an exponential term
+    scale * growth ** flexible_nodes (the nodes able to take several roles are the ones it
+    backtracks over).
+    """
+
+    def __init__(self):
+        # (strategy, solver name or None, metric) -> coefficients of cost_features
+        self.coefficients = {}
+        self.backtracking_scale = 0.0
+        self.backtracking_growth = 1.0
+
+    def calibrate(self, samples):
+        """
+        Fits the model to samples from read_benchmark_csv, separately for every strategy and
+        solver. Those without samples keep their previous coefficients.
+        """
+        backtracking = BacktrackingSolver.__name__
+        groups = {}
+        for sample in samples:
+            # Backtracking samples only calibrate the linear part where nothing was backtracked over
+            if not (sample["solver"] == backtracking and sample["flexible_nodes"]):
+                groups.setdefault((sample["strategy"], sample["solver"]), []).append(sample)
+
+        for ((strategy, solver), group_samples) in groups.items():
+            # The edge feature is only used when every sample knows its edges
+            use_edges = all(sample["num_edges"] is not None for sample in group_samples)
+            features = [cost_features(sample["num_nodes"], sample["num_roles"],
+                sample["num_edges"] if use_edges else 0) for sample in group_samples]
+            for metric in METRICS:
+                self.coefficients[(strategy, solver, metric)] = fit_nonnegative(features,
+                    [sample[metric] for sample in group_samples])
+
+        # log(time - linear part) = log(scale) + flexible_nodes * log(growth)
+        points = []
+        for sample in samples:
+            if sample["solver"] == backtracking and sample["flexible_nodes"]:
+                linear_time = self.estimate_linear(CENTRALIZED, backtracking, "compute_time", sample["num_nodes"],
+                    sample["num_roles"], sample["num_edges"])
+                if sample["compute_time"] > linear_time:
+                    points.append((sample["flexible_nodes"], math.log(sample["compute_time"] - linear_time)))
+        if len(points) >= 2:
+            (slope, intercept) = numpy.polyfit([x for (x, _) in points], [y for (_, y) in points], 1)
+            self.backtracking_growth = max(math.exp(slope), 1.0)
+            self.backtracking_scale = math.exp(intercept)
+
+        return self
+
+    def estimate_linear(self, strategy, solver, metric, num_nodes, num_roles, num_edges):
+        coefficients = self.coefficients.get((strategy, solver, metric))
+        if coefficients is None:
+            if solver is None:
+                raise ValueError("the cost model has no %s samples for the %s strategy" % (metric, strategy))
+            raise ValueError("the cost model has no %s samples for the %s strategy with %s" % (metric, strategy, solver))
+        return float(numpy.dot(coefficients, cost_features(num_nodes, num_roles, num_edges)))
+
+    def estimate(self, strategy, num_nodes, num_roles, num_edges, flexible_nodes=0, solver=None):
+        """
+        Returns the metric -> predicted value dictionary of a strategy. solver is the
+        solver_name of the centralized strategy's solver, None for the token strategy.
+        """
+        estimates = dict((metric, self.estimate_linear(strategy, solver, metric, num_nodes, num_roles, num_edges))
+            for metric in METRICS)
+
+        if solver == BacktrackingSolver.__name__ and self.backtracking_scale:
+            exponent = math.log(self.backtracking_scale) + flexible_nodes * math.log(self.backtracking_growth)
+            # Beyond ~1e300 seconds the estimate is as good as infinite
+            estimates["compute_time"] += math.exp(exponent) if exponent < 690 else float("inf")
+
+        return estimates
+
+def load_cost_model(paths=None):
+    """
+    Cost model calibrated from (path, strategy) pairs of benchmark output (see
+    read_benchmark_csv; strategy may be None for benchmarks.run output). Defaults to the
+    metrics_calibration.csv shipped with the package, written by
+
+        python -m benchmarks.run --suite calibration --strategy centralized
+            --strategy centralized_hungarian --strategy distributed --csv metrics_calibration.csv
+
+    for the matching solvers and the token algorithm, and to the legacy metrics_naive.csv
+    for the backtracking solver.
+    """
+    if paths is None:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        paths = [(os.path.join(directory, "metrics_calibration.csv"), None),
+            (os.path.join(directory, "metrics_naive.csv"), CENTRALIZED)]
+
+    samples = []
+    for (path, strategy) in paths:
+        samples.extend(read_benchmark_csv(path, strategy))
+    return CostModel().calibrate(samples)
+
+class NetworkCost:
+    """
+    Estimate of the network the nodes run on: latency seconds per message, and the
+    bandwidth in bytes per second of the busiest link (None for unlimited)
+    """
+
+    def __init__(self, latency=0.0005, bandwidth=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+    def get_time(self, critical_path_messages, num_bytes):
+        transfer_time = float(num_bytes) / self.bandwidth if self.bandwidth else 0.0
+        return critical_path_messages * self.latency + transfer_time
+
+def critical_path_messages(strategy, num_roles):
+    """
+    Messages on the longest causal chain of a strategy. The centralized service waits for
+    one report from every node (in parallel) and replies once; the token algorithm
+    broadcasts once, then sends the token on and updates the candidates for every role.
+    """
+    if strategy == CENTRALIZED:
+        return 2
+    return 2 + 2 * num_roles
+
+class AssignmentPlanner:
+
+    def __init__(self, role_criterias, cost_model=None, network_cost=None, solver=None, role_counts=None,
+                 evaluation_cache=None, sample_size=256, seed=0):
+        """
+        cost_model defaults to load_cost_model(), network_cost to a NetworkCost with
+        0.5ms of latency and unlimited bandwidth. solver is the backend of the centralized
+        strategy, as for RoleAssignmentService, and picks the coefficients of the cost model
+        (with a BacktrackingSolver its exponential term is taken into account). plan grades
+        sample_size random nodes, picked with seed, to estimate the grade matrix density.
+        """
+        self.role_criterias = role_criterias
+        self.cost_model = cost_model if cost_model is not None else load_cost_model()
+        self.network_cost = network_cost if network_cost is not None else NetworkCost()
+        self.solver = solver
+        self.role_counts = role_counts
+        self.evaluation_cache = evaluation_cache
+        self.sample_size = sample_size
+        self.random = random.Random(seed)
+
+    def inspect(self, nodes):
+        """
+        Size and estimated density of the nodes x roles grade matrix. flexible_nodes is the
+        estimated number of nodes satisfying more than one role.
+        """
+        num_nodes = len(nodes)
+        num_roles = len(self.role_criterias)
+        sample = self.random.sample(nodes, min(self.sample_size, num_nodes))
+
+        if sample and num_roles:
+            grade_matrix = evaluate_grade_matrix(self.role_criterias, [node.parameters for node in sample],
+                self.evaluation_cache)
+            satisfiable_counts = (grade_matrix > 0).sum(axis=1)
+            density = float(satisfiable_counts.sum()) / (len(sample) * num_roles)
+            flexible_fraction = float((satisfiable_counts > 1).sum()) / len(sample)
+        else:
+            (density, flexible_fraction) = (0.0, 0.0)
+
+        return {
+            "num_nodes": num_nodes,
+            "num_roles": num_roles,
+            "density": density,
+            "num_edges": density * num_nodes * num_roles,
+            "flexible_nodes": flexible_fraction * num_nodes
+        }
+
+    def plan(self, nodes):
+        """
+        Returns the plan for nodes: the chosen "strategy", the "features" of inspect, and
+        the "estimates" of every strategy (compute time, bytes, network time and total time)
+        """
+        nodes = list(nodes)
+        features = self.inspect(nodes)
+
+        estimates = {}
+        for strategy in STRATEGIES:
+            estimate = self.cost_model.estimate(strategy, features["num_nodes"], features["num_roles"],
+                features["num_edges"], features["flexible_nodes"],
+                solver=solver_name(self.solver) if strategy == CENTRALIZED else None)
+            estimate["network_time"] = self.network_cost.get_time(
+                critical_path_messages(strategy, features["num_roles"]), estimate["bytes"])
+            estimate["time"] = estimate["compute_time"] + estimate["network_time"]
+            estimates[strategy] = estimate
+
+        strategy = min(STRATEGIES, key=lambda strategy: estimates[strategy]["time"])
+        logger.info("planned %s assignment for %d nodes, %d roles, density %.4f: %s", strategy,
+            features["num_nodes"], features["num_roles"], features["density"],
+            ", ".join("%s %.4gs (compute %.4gs, network %.4gs, %d bytes)" % (name, estimates[name]["time"],
+                estimates[name]["compute_time"], estimates[name]["network_time"], estimates[name]["bytes"])
+                for name in STRATEGIES))
+
+        return { "strategy": strategy, "features": features, "estimates": estimates }
+
+    def run(self, nodes, network=None):
+        """
+        Plans and runs the assignment of nodes, LogicalNodes built with this planner's role
+        criterias. The token algorithm runs on network, by default an inline SimulatedNetwork
+        of the nodes, with nodes[0] as coordinator. Returns (plan, role_assignment_map,
+        unassigned_roles), unassigned_roles being None when every role was filled.
+        """
+        nodes = list(nodes)
+        plan = self.plan(nodes)
+
+        if plan["strategy"] == CENTRALIZED:
+            service = RoleAssignmentService(self.role_criterias, self.solver, self.evaluation_cache, self.role_counts)
+            service.evaluate_nodes(nodes)
+            unassigned_roles = service.compute_role_assignment()
+            return (plan, dict(service.role_assignment_map), unassigned_roles)
+
+        if network is None:
+            network = SimulatedNetwork(nodes, InlineExecutor())
+        coordinator = nodes[0]
+        coordinator.begin_logical_assignment(self.role_counts)
+
+        role_assignment_map = {}
+        for (role_id, node_ids) in coordinator.role_assignments.items():
+            for node_id in node_ids:
+                role_assignment_map[node_id] = role_id
+        return (plan, role_assignment_map, coordinator.unfilled_roles or None)
@@ -0,0 +1,263 @@
+from collections import deque
+import numpy
+
+##################################################################################
+# Solver backends for the RoleAssignmentService. Every solver takes a role grade
+# map (node_id -> {role_id: grade} for each role the node satisfies) and the set
+# of role ids to assign, and returns a (role_assignment_map, unassigned_roles)
+# pair where role_assignment_map maps node ids to role ids and unassigned_roles
+# is either None (all roles assigned) or the set of roles left unassigned.
+# solve_with_role_counts runs any of them for roles wanted by several nodes.
+##################################################################################
+
+class BacktrackingSolver:
+    """
+    The original recursive backtracking search. Exponential in the worst case and
+    recurses once per node, so it is only suitable for small clusters.
+    """
+
+    def solve(self, role_grade_map, role_ids):
+        self.node_ids = sorted(role_grade_map)
+        self.role_grade_map = role_grade_map
+        self.role_assignment_map = {}
+        self.unassigned_roles = None
+
+        self._compute_role_assignment(0, set(role_ids))
+
+        return (self.role_assignment_map, self.unassigned_roles)
+
+    def _compute_role_assignment(self, node_index, unassigned_roles):
+        if not unassigned_roles:
+            self.unassigned_roles = None
+            return True
+
+        if node_index >= len(self.node_ids):
+            self.unassigned_roles = set(unassigned_roles)
+            return False
+
+        node_id = self.node_ids[node_index]
+        assignable_roles = unassigned_roles.intersection(self.role_grade_map[node_id])
+        if assignable_roles:
+            for role_id in assignable_roles:
+                unassigned_roles.remove(role_id)
+
+                if self._compute_role_assignment(node_index + 1, unassigned_roles):
+                    self.role_assignment_map[node_id] = role_id
+                    return True
+
+                unassigned_roles.add(role_id)
+
+            return False
+
+        elif self._compute_role_assignment(node_index + 1, unassigned_roles):
+            return True
+
+        else:
+            return False
+
+class HopcroftKarpSolver:
+    """
+    Maximum cardinality bipartite matching between nodes and roles, in
+    O(E * sqrt(V)). Answers the feasibility question (can every role be filled?)
+    without regard to grades. Iterative, so it does not hit the recursion limit.
+    """
+
+    def solve(self, role_grade_map, role_ids):
+        role_ids = set(role_ids)
+        adjacency = dict((node_id, [role_id for role_id in satisfiable_roles if role_id in role_ids])
+            for (node_id, satisfiable_roles) in role_grade_map.items())
+
+        node_match = dict((node_id, None) for node_id in adjacency)
+        role_match = dict((role_id, None) for role_id in role_ids)
+
+        while self._build_layers(adjacency, node_match, role_match):
+            for node_id in adjacency:
+                if node_match[node_id] is None:
+                    self._augment(node_id, adjacency, node_match, role_match)
+
+        role_assignment_map = dict((node_id, role_id)
+            for (node_id, role_id) in node_match.items() if role_id is not None)
+        unassigned_roles = set(role_id for (role_id, node_id) in role_match.items() if node_id is None)
+
+        return (role_assignment_map, unassigned_roles or None)
+
+    def _build_layers(self, adjacency, node_match, role_match):
+        """
+        Breadth first search from every free node, layering the alternating paths up to
+        the layer where a free role is first reached (free_role_layer), so that a phase
+        only augments along shortest paths. Returns True if an augmenting path exists.
+        """
+        self.layers = {}
+        self.free_role_layer = None
+        queue = deque()
+        for node_id in adjacency:
+            if node_match[node_id] is None:
+                self.layers[node_id] = 0
+                queue.append(node_id)
+
+        while queue:
+            node_id = queue.popleft()
+            layer = self.layers[node_id]
+            if self.free_role_layer is not None and layer > self.free_role_layer:
+                break
+
+            for role_id in adjacency[node_id]:
+                matched_node_id = role_match[role_id]
+                if matched_node_id is None:
+                    if self.free_role_layer is None:
+                        self.free_role_layer = layer
+                elif matched_node_id not in self.layers:
+                    self.layers[matched_node_id] = layer + 1
+                    queue.append(matched_node_id)
+
+        return self.free_role_layer is not None
+
+    def _augment(self, root_node_id, adjacency, node_match, role_match):
+        """
+        Depth first search along the layers for an augmenting path starting at
+        root_node_id and ending in a free role at free_role_layer, using an explicit
+        stack instead of recursion
+        """
+        stack = [(root_node_id, iter(adjacency[root_node_id]))]
+        path = []
+
+        while stack:
+            (node_id, role_ids) = stack[-1]
+            advanced = False
+
+            layer = self.layers[node_id]
+            for role_id in role_ids:
+                matched_node_id = role_match[role_id]
+                if matched_node_id is None:
+                    if layer != self.free_role_layer:
+                        continue
+                    path.append((node_id, role_id))
+                    for (path_node_id, path_role_id) in path:
+                        node_match[path_node_id] = path_role_id
+                        role_match[path_role_id] = path_node_id
+                    return True
+
+                if layer < self.free_role_layer and self.layers.get(matched_node_id) == layer + 1:
+                    path.append((node_id, role_id))
+                    stack.append((matched_node_id, iter(adjacency[matched_node_id])))
+                    advanced = True
+                    break
+
+            if not advanced:
+                # Dead end: never visit this node again during the current phase
+                self.layers[node_id] = None
+                stack.pop()
+                if path:
+                    path.pop()
+
+        return False
+
+class HungarianSolver:
+    """
+    Maximum weight assignment of roles to nodes, using the shortest augmenting path
+    (Jonker-Volgenant style) formulation of the Hungarian algorithm in O(n^2 * m).
+    The number of assigned roles is maximized first; among maximum assignments the
+    one with the highest total grade is chosen.
+    """
+
+    def solve(self, role_grade_map, role_ids):
+        node_ids = sorted(role_grade_map)
+        role_ids = sorted(role_ids)
+        role_indexes = dict((role_id, role_index) for (role_index, role_id) in enumerate(role_ids))
+
+        grade_matrix = numpy.zeros((len(node_ids), len(role_ids)))
+        for (node_index, node_id) in enumerate(node_ids):
+            for (role_id, grade) in role_grade_map[node_id].items():
+                if role_id in role_indexes:
+                    grade_matrix[node_index, role_indexes[role_id]] = grade
+
+        satisfiable = grade_matrix > 0
+        # Every satisfiable pair is worth more than all grades combined, so that
+        # maximizing the total weight maximizes the number of assigned roles first
+        bonus = grade_matrix[satisfiable].sum() + 1.0
+        cost = numpy.where(satisfiable, -(grade_matrix + bonus), 0.0)
+
+        role_assignment_map = {}
+        if node_ids and role_ids:
+            if len(role_ids) <= len(node_ids):
+                pairs = [(node_index, role_index) for (role_index, node_index) in _min_cost_assignment(cost.T)]
+            else:
+                pairs = _min_cost_assignment(cost)
+
+            for (node_index, role_index) in pairs:
+                if satisfiable[node_index, role_index]:
+                    role_assignment_map[node_ids[node_index]] = role_ids[role_index]
+
+        unassigned_roles = set(role_ids).difference(role_assignment_map.values())
+
+        return (role_assignment_map, unassigned_roles or None)
+
+def solve_with_role_counts(solver, role_grade_map, role_counts):
+    """
+    Assigns role_counts[role_id] nodes to each role with any solver, by treating every
+    replica as a role of its own. Returns (role_assignment_map, unassigned_roles) in terms
+    of the original role ids, where unassigned_roles holds the roles short of replicas.
+    """
+    replica_ids = dict((role_id, [(role_id, replica) for replica in range(count)])
+        for (role_id, count) in role_counts.items() if count > 0)
+
+    replica_grade_map = {}
+    for (node_id, role_grades) in role_grade_map.items():
+        replica_grade_map[node_id] = dict((replica_id, grade)
+            for (role_id, grade) in role_grades.items() for replica_id in replica_ids.get(role_id, ()))
+
+    all_replica_ids = [replica_id for role_replica_ids in replica_ids.values() for replica_id in role_replica_ids]
+    (replica_assignment_map, unassigned_replicas) = solver.solve(replica_grade_map, all_replica_ids)
+
+    role_assignment_map = dict((node_id, replica_id[0]) for (node_id, replica_id) in replica_assignment_map.items())
+    unassigned_roles = set(replica_id[0] for replica_id in unassigned_replicas or ())
+
+    return (role_assignment_map, unassigned_roles or None)
+
+def _min_cost_assignment(cost):
+    """
+    Assigns every row of cost (rows <= columns) to a distinct column at minimum total
+    cost. Returns a list of (row, column) pairs.
+    """
+    (num_rows, num_columns) = cost.shape
+
+    # Index 0 is a sentinel column/row, as in the classic formulation
+    row_potentials = numpy.zeros(num_rows + 1)
+    column_potentials = numpy.zeros(num_columns + 1)
+    column_rows = numpy.zeros(num_columns + 1, dtype=int)
+    way = numpy.zeros(num_columns + 1, dtype=int)
+
+    for row in range(1, num_rows + 1):
+        column_rows[0] = row
+        column = 0
+        min_values = numpy.full(num_columns + 1, numpy.inf)
+        used = numpy.zeros(num_columns + 1, dtype=bool)
+
+        while True:
+            used[column] = True
+            current_row = column_rows[column]
+
+            reduced = cost[current_row - 1] - row_potentials[current_row] - column_potentials[1:]
+            free = ~used[1:]
+            improved = free & (reduced < min_values[1:])
+            min_values[1:][improved] = reduced[improved]
+            way[1:][improved] = column
+
+            candidates = numpy.where(free, min_values[1:], numpy.inf)
+            next_column = int(candidates.argmin()) + 1
+            delta = candidates[next_column - 1]
+
+            row_potentials[column_rows[used]] += delta
+            column_potentials[used] -= delta
+            min_values[1:][free] -= delta
+
+            column = next_column
+            if column_rows[column] == 0:
+                break
+
+        while column:
+            previous_column = way[column]
+            column_rows[column] = column_rows[previous_column]
+            column = previous_column
+
+    return [(column_rows[column] - 1, column - 1) for column in range(1, num_columns + 1) if column_rows[column]]
@@ -0,0 +1,497 @@
+from network import Network, SimulatedNetwork, ThreadPoolExecutor, HANDLER_MESSAGE_TYPES
+from tracing import TRACED_MESSAGE
+import cPickle as pickle
+import traceback
+import threading
+import socket
+import select
+import time
+import struct
+import errno
+import os
+
+##################################################################################
+# An event driven alternative to the rpyc transport used by LiveNetwork. Every
+# node runs a single poll loop that owns its listening socket and one persistent
+# connection per peer. Messages travel as length-prefixed frames tagged with a
+# request id, so many requests can be in flight on one connection at a time.
+# Incoming requests are handed to a bounded pool of workers, since LogicalNode
+# handlers block while they wait on their own outgoing messages.
+##################################################################################
+
+FRAME_HEADER = struct.Struct("!IBI")   # payload length, frame kind, request id
+
+REQUEST_FRAME = 0
+REPLY_FRAME = 1
+ERROR_FRAME = 2
+
+GET_ATTRIBUTE = "__getattr__"
+
+EXPOSED_METHODS = frozenset([
+    "begin_logical_assignment",
+    "node_joined",
+    "node_left",
+    "repair_assignment",
+    "receive_evaluate_roles_message",
+    "receive_token",
+    "receive_token_hop",
+    "receive_update_assignment_index_message",
+    "receive_encoded_evaluate_roles_message",
+    "receive_encoded_token",
+    "receive_encoded_token_hop",
+    "receive_encoded_update_assignment_index_message"
+])
+
+class RemoteError(Exception):
+    """
+    Raised on the caller's side when a remote handler fails. Holds the remote traceback.
+    """
+    pass
+
+class AsyncResult:
+    """
+    Mirrors the rpyc async result interface (wait, ready, value and add_callback)
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self._value = None
+        self.exception = None
+        self.lock = threading.Lock()
+        self.callbacks = []
+
+    def set_value(self, value):
+        self._value = value
+        self._set()
+
+    def set_exception(self, exception):
+        self.exception = exception
+        self._set()
+
+    def _set(self):
+        self.lock.acquire()
+        self.event.set()
+        callbacks = self.callbacks
+        self.callbacks = []
+        self.lock.release()
+
+        for callback in callbacks:
+            callback(self)
+
+    def add_callback(self, callback):
+        self.lock.acquire()
+        ready = self.event.is_set()
+        if not ready:
+            self.callbacks.append(callback)
+        self.lock.release()
+        if ready:
+            callback(self)
+
+    def poll(self):
+        # Replies are read by the frame loop's thread
+        pass
+
+    def wait(self):
+        self.event.wait()
+
+    @property
+    def ready(self):
+        return self.event.is_set()
+
+    @property
+    def value(self):
+        self.wait()
+        if self.exception is not None:
+            raise self.exception
+        return self._value
+
+class FramedConnection:
+    """
+    One end of a persistent, multiplexed connection. Frames may be sent from any
+    thread; reading and flushing are done by the owning FrameLoop.
+    """
+
+    def __init__(self, loop, sock):
+        self.loop = loop
+        self.sock = sock
+        self.input = bytearray()
+        self.output = bytearray()
+        self.output_lock = threading.Lock()
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.next_request_id = 0
+        self.closed = False
+
+    def request(self, payload):
+        result = AsyncResult()
+
+        self.pending_lock.acquire()
+        if self.closed:
+            self.pending_lock.release()
+            result.set_exception(EOFError("connection closed"))
+            return result
+        request_id = self.next_request_id
+        self.next_request_id = (self.next_request_id + 1) & 0xFFFFFFFF
+        self.pending[request_id] = result
+        self.pending_lock.release()
+
+        self.send_frame(REQUEST_FRAME, request_id, payload)
+        return result
+
+    def send_frame(self, kind, request_id, payload):
+        self.output_lock.acquire()
+        self.output += FRAME_HEADER.pack(len(payload), kind, request_id)
+        self.output += payload
+        self.output_lock.release()
+
+        # Try to write straight away and only involve the loop if the socket is full
+        try:
+            self.flush()
+        except socket.error:
+            pass
+        if self.has_output():
+            self.loop.wake()
+
+    def has_output(self):
+        return len(self.output) > 0
+
+    def flush(self):
+        self.output_lock.acquire()
+        try:
+            sent = self.sock.send(self.output)
+            del self.output[:sent]
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        finally:
+            self.output_lock.release()
+
+    def read_frames(self):
+        """
+        Reads what is available on the socket and returns the complete frames as
+        (kind, request_id, payload) tuples. Raises EOFError once the peer hangs up.
+        """
+        try:
+            data = self.sock.recv(65536)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            raise EOFError(str(e))
+
+        if not data:
+            raise EOFError("connection closed by peer")
+        self.input += data
+
+        frames = []
+        while len(self.input) >= FRAME_HEADER.size:
+            (length, kind, request_id) = FRAME_HEADER.unpack_from(buffer(self.input))
+            frame_end = FRAME_HEADER.size + length
+            if len(self.input) < frame_end:
+                break
+            frames.append((kind, request_id, bytes(self.input[FRAME_HEADER.size:frame_end])))
+            del self.input[:frame_end]
+
+        return frames
+
+    def resolve(self, kind, request_id, payload):
+        self.pending_lock.acquire()
+        result = self.pending.pop(request_id, None)
+        self.pending_lock.release()
+
+        if result is None:
+            return
+        if kind == REPLY_FRAME:
+            result.set_value(pickle.loads(payload))
+        else:
+            result.set_exception(RemoteError(pickle.loads(payload)))
+
+    def close(self):
+        self.pending_lock.acquire()
+        self.closed = True
+        pending = self.pending
+        self.pending = {}
+        self.pending_lock.release()
+
+        for result in pending.values():
+            result.set_exception(EOFError("connection closed"))
+        self.sock.close()
+
+class FrameLoop:
+    """
+    Single threaded poll loop that owns a node's sockets. on_request(connection, request_id, payload)
+    is called on the loop thread for every incoming request frame and must not block.
+    """
+
+    def __init__(self, on_request):
+        self.on_request = on_request
+        self.listener = None
+        self.connections = {}
+        self.lock = threading.Lock()
+        (self.wake_reader, self.wake_writer) = os.pipe()
+        self.running = False
+        self.thread = None
+
+    def listen(self, node_ip_address):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(node_ip_address)
+        self.listener.listen(128)
+        self.listener.setblocking(0)
+
+    def connect(self, node_ip_address):
+        sock = socket.create_connection(node_ip_address)
+        return self._add_connection(sock)
+
+    def attach(self, sock):
+        """
+        Adds an already connected socket, e.g. one end of a socketpair
+        """
+        return self._add_connection(sock)
+
+    def _add_connection(self, sock):
+        if sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(0)
+        connection = FramedConnection(self, sock)
+
+        self.lock.acquire()
+        self.connections[sock.fileno()] = connection
+        self.lock.release()
+
+        self.wake()
+        return connection
+
+    def wake(self):
+        wake_writer = self.wake_writer
+        if wake_writer is None:
+            return
+        try:
+            os.write(wake_writer, b"x")
+        except OSError:
+            pass
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wake()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def run(self):
+        try:
+            while self.running:
+                self._poll_once()
+        finally:
+            self._close_all()
+
+    def _poll_once(self):
+        self.lock.acquire()
+        connections = dict(self.connections)
+        self.lock.release()
+
+        poller = select.poll()
+        poller.register(self.wake_reader, select.POLLIN)
+        if self.listener is not None:
+            poller.register(self.listener.fileno(), select.POLLIN)
+        for (fd, connection) in connections.items():
+            poller.register(fd, select.POLLIN | (select.POLLOUT if connection.has_output() else 0))
+
+        for (fd, event) in poller.poll():
+            if fd == self.wake_reader:
+                os.read(self.wake_reader, 4096)
+
+            elif self.listener is not None and fd == self.listener.fileno():
+                self._accept()
+
+            elif fd in connections:
+                self._service(connections[fd], event)
+
+    def _accept(self):
+        try:
+            (sock, _) = self.listener.accept()
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        self._add_connection(sock)
+
+    def _service(self, connection, event):
+        try:
+            if event & select.POLLOUT:
+                connection.flush()
+
+            if event & (select.POLLIN | select.POLLHUP | select.POLLERR):
+                for (kind, request_id, payload) in connection.read_frames():
+                    if kind == REQUEST_FRAME:
+                        self.on_request(connection, request_id, payload)
+                    else:
+                        connection.resolve(kind, request_id, payload)
+
+        except (EOFError, socket.error):
+            self._remove_connection(connection)
+
+    def _remove_connection(self, connection):
+        self.lock.acquire()
+        self.connections.pop(connection.sock.fileno(), None)
+        self.lock.release()
+        connection.close()
+
+    def _close_all(self):
+        self.lock.acquire()
+        connections = self.connections.values()
+        self.connections = {}
+        self.lock.release()
+
+        for connection in connections:
+            connection.close()
+        if self.listener is not None:
+            self.listener.close()
+
+        (wake_reader, wake_writer) = (self.wake_reader, self.wake_writer)
+        self.wake_writer = None
+        os.close(wake_reader)
+        os.close(wake_writer)
+
+class AsyncLiveNetwork(Network):
+    """
+    Drop-in alternative to LiveNetwork built on FrameLoop instead of rpyc. Each node keeps a
+    constant number of threads: the poll loop plus a bounded pool of request handlers.
+    """
+
+    class Peer:
+        """
+        Proxy for a remote logical node. Attribute access returns a RemoteMethod. The
+        connection is opened on first use and then kept for the lifetime of the network.
+        """
+
+        def __init__(self, loop, node_ip_address):
+            self.loop = loop
+            self.node_ip_address = node_ip_address
+            self.connection = None
+            self.lock = threading.Lock()
+
+        def call_async(self, name, *args):
+            return self._get_connection().request(pickle.dumps((name, args), pickle.HIGHEST_PROTOCOL))
+
+        def get_attribute(self, name):
+            result = self.call_async(GET_ATTRIBUTE, name)
+            return result.value
+
+        def _get_connection(self):
+            self.lock.acquire()
+            try:
+                if self.connection is None or self.connection.closed:
+                    self.connection = self.loop.connect(self.node_ip_address)
+                return self.connection
+            finally:
+                self.lock.release()
+
+        def __getattr__(self, name):
+            if name.startswith("_"):
+                raise AttributeError(name)
+            return AsyncLiveNetwork.RemoteMethod(self, name)
+
+    class RemoteMethod:
+
+        def __init__(self, peer, name):
+            self.peer = peer
+            self.name = name
+
+        def call_async(self, *args):
+            return self.peer.call_async(self.name, *args)
+
+        def __call__(self, *args):
+            return self.call_async(*args).value
+
+    def __init__(self, server_node, node_ip_addresses, executor=None):
+        """
+        executor runs the incoming requests. Defaults to a bounded ThreadPoolExecutor.
+        """
+        Network.__init__(self, encode_messages=True)
+
+        self.executor = executor if executor is not None else ThreadPoolExecutor()
+        self.async = self._async
+        self.server_node = server_node
+        self.server_address = node_ip_addresses[server_node.node_id]
+        self.loop = FrameLoop(self._on_request)
+
+        self.logical_nodes = []
+        for (node_id, node_ip_address) in enumerate(node_ip_addresses):
+            if node_id != server_node.node_id:
+                self.logical_nodes.append(AsyncLiveNetwork.Peer(self.loop, node_ip_address))
+            else:
+                server_node.set_network(self)
+                self.logical_nodes.append(server_node)
+
+    def add_node(self, node_id, node_ip_address):
+        Network.add_node(self, node_id, AsyncLiveNetwork.Peer(self.loop, node_ip_address))
+
+    def remove_node(self, node_id):
+        logical_node = Network.remove_node(self, node_id)
+        connection = getattr(logical_node, "connection", None)
+        if connection is not None and not connection.closed:
+            self.loop._remove_connection(connection)
+        return logical_node
+
+    def _async(self, func):
+        if hasattr(func, "call_async"):
+            return func.call_async
+        return SimulatedNetwork.Future(func, self.executor)
+
+    def set_batching(self, max_batch_size=256):
+        raise NotImplementedError("AsyncLiveNetwork sends every message on the connection of its node")
+
+    def _on_request(self, connection, request_id, payload):
+        self.executor.submit(self._handle_request, connection, request_id, payload, time.time())
+
+    def _handle_request(self, connection, request_id, payload, received_time):
+        try:
+            (name, args) = pickle.loads(payload)
+
+            trace_context = None
+            if name == TRACED_MESSAGE:
+                (trace_context, name, args) = (args[0], args[1], args[2:])
+
+            if name == GET_ATTRIBUTE and not args[0].startswith("_"):
+                value = getattr(self.server_node, args[0])
+            elif name in EXPOSED_METHODS:
+                if self.metrics is not None:
+                    self.metrics.record_queue_time(self.server_node.node_id, time.time() - received_time)
+                handler = getattr(self.server_node, name)
+                value = self.run_traced_handler(self.server_node.node_id, HANDLER_MESSAGE_TYPES.get(name, name),
+                    trace_context, handler, *args)
+            else:
+                raise AttributeError("%s is not exposed" % name)
+
+            connection.send_frame(REPLY_FRAME, request_id, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            connection.send_frame(ERROR_FRAME, request_id, pickle.dumps(traceback.format_exc()))
+
+    def start_server(self, block=True):
+        """
+        Starts listening for peers. With block set, returns only once the server is stopped.
+        """
+        self.loop.listen(self.server_address)
+        self.loop.start()
+
+        if block:
+            while self.loop.thread.is_alive():
+                self.loop.thread.join(1)
+
+    def stop_server(self):
+        self.loop.stop()
+        self.executor.shutdown()
+
+    @staticmethod
+    def create_client(node_ip_address):
+        """
+        Creates a Peer for a driver process that is not itself a node of the network
+        """
+        loop = FrameLoop(None)
+        loop.start()
+        return AsyncLiveNetwork.Peer(loop, node_ip_address)
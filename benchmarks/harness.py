@@ -0,0 +1,183 @@
+from logical_node import LogicalNode
+from network import SimulatedNetwork, InlineExecutor, ThreadPoolExecutor
+from process_network import ProcessSimulatedNetwork
+from network_metrics import MetricsCollector
+from naive_centralized_algorithm import RoleAssignmentService
+from hierarchical_assignment import HierarchicalAssignment, BlockPartitioner
+import math
+import time
+import os
+
+##################################################################################
+# Timing harness. Every trial builds its nodes and network from scratch, outside of
+# the timed region, and reports wall clock time (which includes the time threads
+# spend waiting on each other) alongside the CPU time of the whole process.
+##################################################################################
+
+class Timer:
+
+    def __enter__(self):
+        self.start_wall_time = time.time()
+        self.start_cpu_time = cpu_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall_time = time.time() - self.start_wall_time
+        self.cpu_time = cpu_time() - self.start_cpu_time
+
+def cpu_time():
+    """
+    User and system CPU time of the process, across all of its threads
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+def summarize(samples):
+    mean = sum(samples) / len(samples)
+    variance = sum((sample - mean) ** 2 for sample in samples) / len(samples)
+    return {
+        "mean": mean,
+        "min": min(samples),
+        "max": max(samples),
+        "stdev": math.sqrt(variance),
+        "samples": samples
+    }
+
+def run_trials(run_trial, trials=5, warmup=1):
+    """
+    Calls run_trial warmup times without recording, then trials times. run_trial returns a
+    (Timer, counters) pair; the counters of the last trial are reported, since every trial
+    of a scenario exchanges the same messages.
+    """
+    for _ in range(warmup):
+        run_trial()
+
+    wall_times = []
+    cpu_times = []
+    for _ in range(trials):
+        (timer, counters) = run_trial()
+        wall_times.append(timer.wall_time)
+        cpu_times.append(timer.cpu_time)
+
+    result = { "wall_time": summarize(wall_times), "cpu_time": summarize(cpu_times) }
+    result.update(counters)
+    return result
+
+def centralized_trial(scenario, solver=None):
+    """
+    Runs the RoleAssignmentService: every node reports its parameters, the service solves
+    the assignment, and every node asks for its role
+    """
+    def run_trial():
+        role_criterias = scenario.create_role_criterias()
+        nodes = [LogicalNode(node_id, scenario.create_node_parameters(node_id), role_criterias)
+            for node_id in range(scenario.num_nodes)]
+        service = RoleAssignmentService(role_criterias, solver)
+
+        with Timer() as timer:
+            service.evaluate_nodes(nodes)
+            unassigned_roles = service.compute_role_assignment()
+            for node_id in service.role_assignment_map:
+                service.get_role_assignment(node_id)
+
+        return (timer, {
+            "messages": service.get_messages_received() + service.get_messages_sent(),
+            "bytes": service.get_bytes_received() + service.get_bytes_sent(),
+            "unassigned_roles": len(unassigned_roles or ())
+        })
+
+    return run_trial
+
+def distributed_trial(scenario, num_workers=None, iterative_token_walk=True, broadcast_fanout=None):
+    """
+    Runs the token algorithm on a SimulatedNetwork with encoded messages. Without
+    num_workers, messages run inline on a single thread, which scales to the largest
+    scenarios; otherwise they run on a pool of num_workers threads.
+    """
+    def run_trial():
+        role_criterias = scenario.create_role_criterias()
+        nodes = [LogicalNode(node_id, scenario.create_node_parameters(node_id), role_criterias,
+                iterative_token_walk=iterative_token_walk, broadcast_fanout=broadcast_fanout)
+            for node_id in range(scenario.num_nodes)]
+
+        executor = ThreadPoolExecutor(num_workers) if num_workers else InlineExecutor()
+        network = SimulatedNetwork(nodes, executor, encode_messages=True)
+        metrics = MetricsCollector()
+        network.set_metrics_collector(metrics)
+
+        try:
+            with Timer() as timer:
+                token = nodes[0].begin_logical_assignment()
+        finally:
+            executor.shutdown()
+
+        return (timer, {
+            "messages": metrics.get_message_count(),
+            "bytes": network.get_bytes_sent(),
+            "wire_bytes": network.get_wire_bytes_sent(),
+            "token_hops": network.get_token_hops(),
+            "unassigned_roles": len(token.unassigned_roles)
+        })
+
+    return run_trial
+
+def process_trial(scenario, num_processes=None, num_workers=None, broadcast_fanout=None):
+    """
+    Runs the token algorithm on a ProcessSimulatedNetwork, one shard process per core by
+    default. Forking the shards is not timed, and the reported CPU time only covers the
+    driving process.
+    """
+    def run_trial():
+        role_criterias = scenario.create_role_criterias()
+        nodes = [LogicalNode(node_id, scenario.create_node_parameters(node_id), role_criterias,
+                iterative_token_walk=True, broadcast_fanout=broadcast_fanout)
+            for node_id in range(scenario.num_nodes)]
+
+        network = ProcessSimulatedNetwork(nodes, num_processes, num_workers, encode_messages=True)
+        metrics = MetricsCollector()
+        network.set_metrics_collector(metrics)
+
+        try:
+            with Timer() as timer:
+                token = network.logical_nodes[0].begin_logical_assignment()
+
+            network.collect_metrics()
+            return (timer, {
+                "messages": metrics.get_message_count(),
+                "bytes": network.get_bytes_sent(),
+                "wire_bytes": network.get_wire_bytes_sent(),
+                "token_hops": network.get_token_hops(),
+                "unassigned_roles": len(token.unassigned_roles)
+            })
+        finally:
+            network.stop_server()
+
+    return run_trial
+
+def hierarchical_trial(scenario, zone_size=1000, num_workers=None, zone_assigner=None):
+    """
+    Runs a HierarchicalAssignment over contiguous zones of zone_size nodes. The latency of
+    each level of the last trial is reported, along with the demand and idle nodes that
+    the zones escalated to the global reconciliation step.
+    """
+    def run_trial():
+        role_criterias = scenario.create_role_criterias()
+        nodes = [LogicalNode(node_id, scenario.create_node_parameters(node_id), role_criterias)
+            for node_id in range(scenario.num_nodes)]
+        assignment = HierarchicalAssignment(role_criterias, BlockPartitioner(zone_size), zone_assigner,
+            num_workers=num_workers)
+
+        with Timer() as timer:
+            unassigned_roles = assignment.compute_role_assignment(nodes)
+
+        latencies = assignment.get_latencies()
+        return (timer, {
+            "zone_level_time": latencies["zone_level"],
+            "max_zone_time": max(latencies["zones"]),
+            "global_time": latencies["global"],
+            "escalated_demand": sum(assignment.escalated_demand.values()),
+            "escalated_nodes": len(assignment.escalated_node_ids),
+            "unassigned_roles": len(unassigned_roles or ())
+        })
+
+    return run_trial
@@ -0,0 +1,152 @@
+from benchmarks.scenarios import SUITES, create_suite
+from benchmarks.harness import run_trials, centralized_trial, distributed_trial, process_trial, hierarchical_trial
+from assignment_solvers import HungarianSolver
+import argparse
+import platform
+import json
+import time
+import csv
+import sys
+
+##################################################################################
+# Benchmark suite runner, replacing metrics_naive.py and metrics_smart.py.
+#
+#   python -m benchmarks.run --suite quick --output results.json
+#   python -m benchmarks.run --suite quick --compare baseline.json
+#
+# Results are written as JSON. With --compare, every result is checked against the
+# matching result of a stored baseline, and the exit status is 1 if any regressed.
+##################################################################################
+
+STRATEGIES = {
+    "centralized": centralized_trial,
+    "centralized_hungarian": lambda scenario: centralized_trial(scenario, HungarianSolver()),
+    "distributed": distributed_trial,
+    "processes": process_trial,
+    "hierarchical": hierarchical_trial
+}
+
+DEFAULT_STRATEGIES = ["centralized", "distributed"]
+
+def run_suite(suite, strategies, trials, warmup, log=sys.stdout):
+    results = []
+
+    for scenario in create_suite(suite):
+        for strategy in strategies:
+            result = run_trials(STRATEGIES[strategy](scenario), trials, warmup)
+            result["scenario"] = scenario.describe()
+            result["strategy"] = strategy
+            result["num_edges"] = scenario.get_num_edges()
+            results.append(result)
+
+            log.write("%-20s %-12s nodes=%-7d roles=%-6d wall=%.6fs cpu=%.6fs messages=%d bytes=%d\n" % (
+                scenario.name, strategy, scenario.num_nodes, scenario.get_num_roles(),
+                result["wall_time"]["min"], result["cpu_time"]["min"], result.get("messages", 0), result.get("bytes", 0)))
+
+    return {
+        "suite": suite,
+        "trials": trials,
+        "warmup": warmup,
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results
+    }
+
+def result_key(result):
+    return (result["strategy"], json.dumps(result["scenario"], sort_keys=True))
+
+def compare(report, baseline, threshold, min_time_delta=0.001):
+    """
+    Returns a list of regression messages. Timings regress when the best wall clock time
+    grows by more than threshold (a fraction) and by more than min_time_delta seconds;
+    counts regress whenever they grow at all.
+    """
+    baseline_results = dict((result_key(result), result) for result in baseline["results"])
+    regressions = []
+
+    for result in report["results"]:
+        baseline_result = baseline_results.get(result_key(result))
+        if baseline_result is None:
+            continue
+
+        label = "%s %s (%d nodes)" % (result["scenario"]["name"], result["strategy"], result["scenario"]["num_nodes"])
+
+        wall_time = result["wall_time"]["min"]
+        baseline_wall_time = baseline_result["wall_time"]["min"]
+        if wall_time > baseline_wall_time * (1 + threshold) and wall_time - baseline_wall_time > min_time_delta:
+            # A coarse clock can time a trivial baseline at zero
+            change = "%+.1f%%" % (100.0 * (wall_time / baseline_wall_time - 1)) if baseline_wall_time else "n/a"
+            regressions.append("%s: wall time %.6fs -> %.6fs (%s)" % (label, baseline_wall_time, wall_time, change))
+
+        for counter in ("messages", "bytes", "wire_bytes", "token_hops", "escalated_demand", "unassigned_roles"):
+            if counter in result and counter in baseline_result and result[counter] > baseline_result[counter]:
+                regressions.append("%s: %s %d -> %d" % (label, counter, baseline_result[counter], result[counter]))
+
+    return regressions
+
+def write_csv(report, output_file):
+    """
+    Flat summary, one row per scenario and strategy
+    """
+    output = csv.DictWriter(output_file, fieldnames=["scenario", "strategy", "num_nodes", "num_roles",
+        "num_edges", "wall_time", "cpu_time", "messages", "bytes", "wire_bytes", "token_hops", "unassigned_roles"])
+    output.writeheader()
+
+    for result in report["results"]:
+        output.writerow({
+            "scenario": result["scenario"]["name"],
+            "strategy": result["strategy"],
+            "num_nodes": result["scenario"]["num_nodes"],
+            "num_roles": result["scenario"]["num_roles"],
+            "num_edges": result.get("num_edges", ""),
+            "wall_time": result["wall_time"]["min"],
+            "cpu_time": result["cpu_time"]["min"],
+            "messages": result.get("messages", ""),
+            "bytes": result.get("bytes", ""),
+            "wire_bytes": result.get("wire_bytes", ""),
+            "token_hops": result.get("token_hops", ""),
+            "unassigned_roles": result["unassigned_roles"]
+        })
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Role assignment benchmark suite")
+    parser.add_argument("--suite", choices=sorted(SUITES), default="quick")
+    parser.add_argument("--strategy", choices=sorted(STRATEGIES), action="append",
+        help="strategy to run, may be repeated (default: %s)" % ", ".join(DEFAULT_STRATEGIES))
+    parser.add_argument("--trials", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--csv", help="also write a flat CSV summary to this file")
+    parser.add_argument("--compare", help="baseline JSON results to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.1,
+        help="tolerated wall clock slowdown before flagging a regression (default: 0.1)")
+    parser.add_argument("--min-time-delta", type=float, default=0.001,
+        help="wall clock slowdowns below this many seconds are never flagged (default: 0.001)")
+    arguments = parser.parse_args(argv)
+
+    report = run_suite(arguments.suite, arguments.strategy or DEFAULT_STRATEGIES, arguments.trials, arguments.warmup)
+
+    if arguments.output:
+        with open(arguments.output, "w") as output_file:
+            json.dump(report, output_file, indent=2, sort_keys=True)
+
+    if arguments.csv:
+        with open(arguments.csv, "wb") as output_file:
+            write_csv(report, output_file)
+
+    if arguments.compare:
+        with open(arguments.compare) as baseline_file:
+            regressions = compare(report, json.load(baseline_file), arguments.threshold,
+                arguments.min_time_delta)
+
+        for regression in regressions:
+            print "REGRESSION %s" % regression
+        if regressions:
+            return 1
+        print "No regressions against %s" % arguments.compare
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
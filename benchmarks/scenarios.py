@@ -0,0 +1,161 @@
+from role_criteria import RoleCriteria
+import numpy
+
+##################################################################################
+# Scenario generators for the benchmark suite. A scenario is a sparse nodes x roles
+# grade matrix, stored one role column at a time so that large, sparse clusters
+# (up to 100k nodes) fit in memory. Every generator is deterministic for a seed.
+##################################################################################
+
+class ColumnRoleCriteria(RoleCriteria):
+    """
+    Grades nodes by looking up their node id in one column of a scenario's grade matrix
+    """
+
+    def __init__(self, name, node_ids, grades):
+        self.name = name
+        self.node_ids = node_ids
+        self.grades = grades
+
+    def evaluate_against(self, node_parameters):
+        return self.evaluate_batch([node_parameters])[0]
+
+    def evaluate_batch(self, parameter_table):
+        node_ids = numpy.array([node_parameters["node_id"] for node_parameters in parameter_table], dtype=numpy.int64)
+        positions = numpy.searchsorted(self.node_ids, node_ids)
+        positions = numpy.minimum(positions, max(len(self.node_ids) - 1, 0))
+
+        grades = numpy.zeros(len(node_ids))
+        if len(self.node_ids):
+            found = self.node_ids[positions] == node_ids
+            grades[found] = self.grades[positions[found]]
+        return grades
+
+class Scenario:
+
+    def __init__(self, name, num_nodes, role_columns, settings=None):
+        """
+        role_columns holds one (node_ids, grades) pair of arrays per role, with node_ids
+        sorted. settings are the generator arguments, reported with the results.
+        """
+        self.name = name
+        self.num_nodes = num_nodes
+        self.role_columns = role_columns
+        self.settings = settings if settings is not None else {}
+
+    def get_num_roles(self):
+        return len(self.role_columns)
+
+    def get_num_edges(self):
+        """
+        Number of satisfiable (node, role) pairs
+        """
+        return sum(len(node_ids) for (node_ids, _) in self.role_columns)
+
+    def create_role_criterias(self):
+        return [ColumnRoleCriteria("role_%d" % role_id, node_ids, grades)
+            for (role_id, (node_ids, grades)) in enumerate(self.role_columns)]
+
+    def create_node_parameters(self, node_id):
+        return { "node_id": node_id }
+
+    def describe(self):
+        description = { "name": self.name, "num_nodes": self.num_nodes, "num_roles": self.get_num_roles() }
+        description.update(self.settings)
+        return description
+
+def _column(node_ids, grades):
+    order = numpy.argsort(node_ids)
+    return (numpy.asarray(node_ids, dtype=numpy.int64)[order], numpy.asarray(grades, dtype=float)[order])
+
+def _random_columns(random, num_nodes, num_roles, density, draw_grades):
+    role_columns = []
+    for _ in range(num_roles):
+        num_candidates = random.binomial(num_nodes, density)
+        node_ids = random.choice(num_nodes, num_candidates, replace=False)
+        role_columns.append(_column(node_ids, draw_grades(num_candidates)))
+    return role_columns
+
+def random_bipartite(num_nodes, num_roles, density, seed=0):
+    """
+    Every (node, role) pair is satisfiable with probability density, with uniform grades
+    """
+    random = numpy.random.RandomState(seed)
+    role_columns = _random_columns(random, num_nodes, num_roles, density,
+        lambda size: random.uniform(0.5, 10.0, size))
+    return Scenario("random_bipartite", num_nodes, role_columns,
+        { "density": density, "seed": seed })
+
+def skewed_grades(num_nodes, num_roles, density, shape=1.5, seed=0):
+    """
+    Like random_bipartite, but grades follow a heavy tailed Pareto distribution, so a few
+    nodes grade far higher than the rest
+    """
+    random = numpy.random.RandomState(seed)
+    role_columns = _random_columns(random, num_nodes, num_roles, density,
+        lambda size: random.pareto(shape, size) + 1.0)
+    return Scenario("skewed_grades", num_nodes, role_columns,
+        { "density": density, "shape": shape, "seed": seed })
+
+def unsatisfiable_roles(num_nodes, num_roles, density, unsatisfiable_fraction=0.1, seed=0):
+    """
+    Like random_bipartite, but a fraction of the roles is satisfied by no node at all
+    """
+    random = numpy.random.RandomState(seed)
+    role_columns = _random_columns(random, num_nodes, num_roles, density,
+        lambda size: random.uniform(0.5, 10.0, size))
+
+    num_unsatisfiable = int(round(num_roles * unsatisfiable_fraction))
+    for role_id in random.choice(num_roles, num_unsatisfiable, replace=False):
+        role_columns[role_id] = _column([], [])
+
+    return Scenario("unsatisfiable_roles", num_nodes, role_columns,
+        { "density": density, "unsatisfiable_fraction": unsatisfiable_fraction, "seed": seed })
+
+def legacy_worst_case(num_nodes):
+    """
+    The "worst_case" scenario of the original metrics scripts: role i is satisfied by
+    every node j with num_nodes - j > i, so flexibilities form a staircase
+    """
+    role_columns = [_column(range(num_nodes - role_id), [1] * (num_nodes - role_id)) for role_id in range(num_nodes)]
+    return Scenario("worst_case", num_nodes, role_columns)
+
+def legacy_best_case(num_nodes):
+    """
+    The "best_case" scenario of the original metrics scripts: node i only satisfies role i
+    """
+    role_columns = [_column([role_id], [1]) for role_id in range(num_nodes)]
+    return Scenario("best_case", num_nodes, role_columns)
+
+# Each suite is a list of (generator, arguments) pairs
+SUITES = {
+    "legacy":
+        [(legacy_worst_case, { "num_nodes": num_nodes }) for num_nodes in range(1, 15)] +
+        [(legacy_best_case, { "num_nodes": num_nodes }) for num_nodes in range(10, 101, 10)],
+
+    "quick": [
+        (random_bipartite, { "num_nodes": 100, "num_roles": 50, "density": 0.1 }),
+        (random_bipartite, { "num_nodes": 1000, "num_roles": 100, "density": 0.01 }),
+        (skewed_grades, { "num_nodes": 1000, "num_roles": 100, "density": 0.01 }),
+        (unsatisfiable_roles, { "num_nodes": 1000, "num_roles": 100, "density": 0.01 })
+    ],
+
+    # Varied shapes, so that the nodes, roles, node x role pairs and edges of the cost
+    # model (see assignment_planner.cost_features) can be told apart
+    "calibration": [
+        (random_bipartite, { "num_nodes": num_nodes, "num_roles": num_roles, "density": density })
+        for (num_nodes, num_roles, density) in [(100, 100, 0.2), (200, 20, 0.05), (200, 100, 0.02),
+            (300, 200, 0.01), (500, 10, 0.2), (500, 50, 0.01), (1000, 20, 0.01), (1000, 100, 0.05),
+            (1000, 200, 0.005), (2000, 10, 0.05), (2000, 50, 0.002), (3000, 30, 0.01)]
+    ],
+
+    "large": [
+        (random_bipartite, { "num_nodes": 10000, "num_roles": 100, "density": 0.001 }),
+        (skewed_grades, { "num_nodes": 10000, "num_roles": 100, "density": 0.001 }),
+        (random_bipartite, { "num_nodes": 100000, "num_roles": 20, "density": 0.0001 }),
+        (unsatisfiable_roles, { "num_nodes": 100000, "num_roles": 20, "density": 0.0001 })
+    ]
+}
+
+def create_suite(name):
+    return [generator(**arguments) for (generator, arguments) in SUITES[name]]
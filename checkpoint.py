@@ -0,0 +1,229 @@
+from collections import MutableMapping
+import binascii
+import struct
+import numpy
+import mmap
+import os
+
+##################################################################################
+# Versioned binary checkpoints of assignment state, laid out so that a restarted
+# coordinator can memory-map them and serve lookups right away instead of loading
+# them. A checkpoint holds, per node: its assigned role, a fingerprint of the
+# parameters it was graded with, and its grades as a sparse row (CSR). Every section
+# is a flat little-endian array at an 8 byte aligned offset given by the header.
+##################################################################################
+
+CHECKPOINT_MAGIC = b"DFRMCKPT"
+CHECKPOINT_VERSION = 1
+
+# magic, version, number of roles, number of nodes, number of assigned nodes, number of
+# grades, number of unassigned roles, then the offsets of the sections below
+HEADER = struct.Struct("<8sIIQQQQ7Q")
+
+NO_ROLE = -1
+FINGERPRINT_SIZE = 20
+
+# (name, dtype) of each section, in file order
+SECTIONS = [
+    ("node_ids", numpy.dtype("<i8")),
+    ("assigned_roles", numpy.dtype("<i4")),
+    ("fingerprints", numpy.dtype(("<u1", (FINGERPRINT_SIZE,)))),
+    ("row_offsets", numpy.dtype("<i8")),
+    ("grade_role_ids", numpy.dtype("<i4")),
+    ("grades", numpy.dtype("<f8")),
+    ("unassigned_roles", numpy.dtype("<i4"))
+]
+
+def write_checkpoint(path, num_roles, role_grade_map, role_assignment_map, fingerprints=None, unassigned_roles=None):
+    """
+    Writes a checkpoint of every node in role_grade_map (node id -> role id -> grade; a
+    grade may be NaN when only the role is known) and role_assignment_map (node id ->
+    role id). fingerprints maps node ids to parameters_fingerprint digests. The file is
+    written next to path and renamed over it, so a crash never leaves a partial checkpoint.
+    """
+    fingerprints = fingerprints if fingerprints is not None else {}
+    node_ids = numpy.array(sorted(set(role_grade_map).union(role_assignment_map)), dtype=numpy.int64)
+
+    assigned_roles = numpy.array([role_assignment_map.get(node_id, NO_ROLE) for node_id in node_ids.tolist()],
+        dtype=numpy.int32)
+    # Nodes without a fingerprint keep an all zero one
+    node_fingerprints = numpy.zeros((len(node_ids), FINGERPRINT_SIZE), dtype=numpy.uint8)
+    for (row, node_id) in enumerate(node_ids.tolist()):
+        if node_id in fingerprints:
+            node_fingerprints[row] = numpy.frombuffer(binascii.unhexlify(fingerprints[node_id]), numpy.uint8)
+
+    rows = [sorted(role_grade_map.get(node_id, {}).items()) for node_id in node_ids.tolist()]
+    row_offsets = numpy.zeros(len(rows) + 1, dtype=numpy.int64)
+    row_offsets[1:] = numpy.cumsum([len(row) for row in rows])
+    grade_role_ids = numpy.array([role_id for row in rows for (role_id, _) in row], dtype=numpy.int32)
+    grades = numpy.array([grade for row in rows for (_, grade) in row], dtype=numpy.float64)
+    unassigned_roles = numpy.array(sorted(unassigned_roles or ()), dtype=numpy.int32)
+
+    sections = [node_ids, assigned_roles, node_fingerprints, row_offsets, grade_role_ids, grades, unassigned_roles]
+
+    offsets = []
+    offset = _align(HEADER.size)
+    for ((_, dtype), section) in zip(SECTIONS, sections):
+        offsets.append(offset)
+        offset = _align(offset + len(section) * dtype.itemsize)
+
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as output_file:
+        output_file.write(HEADER.pack(CHECKPOINT_MAGIC, CHECKPOINT_VERSION, num_roles, len(node_ids),
+            int((assigned_roles != NO_ROLE).sum()), len(grades), len(unassigned_roles), *offsets))
+        for ((_, dtype), section, section_offset) in zip(SECTIONS, sections, offsets):
+            output_file.write(b"\0" * (section_offset - output_file.tell()))
+            output_file.write(section.astype(dtype.base).tobytes())
+        output_file.flush()
+        os.fsync(output_file.fileno())
+    os.rename(temporary_path, path)
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+class Checkpoint:
+    """
+    Read only, memory-mapped view of a checkpoint. Opening one reads the header only;
+    lookups binary search the sorted node ids.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as input_file:
+            self.buffer = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.buffer) < HEADER.size:
+            raise ValueError("%s is not a checkpoint" % path)
+        header = HEADER.unpack_from(self.buffer)
+        (magic, version, self.num_roles, num_nodes, self.num_assigned, num_grades, num_unassigned) = header[:7]
+        if magic != CHECKPOINT_MAGIC:
+            raise ValueError("%s is not a checkpoint" % path)
+        if version != CHECKPOINT_VERSION:
+            raise ValueError("unsupported checkpoint version %d" % version)
+
+        counts = [num_nodes, num_nodes, num_nodes, num_nodes + 1, num_grades, num_grades, num_unassigned]
+        for ((name, dtype), count, offset) in zip(SECTIONS, counts, header[7:]):
+            setattr(self, name, numpy.frombuffer(self.buffer, dtype, count, offset))
+
+    def get_num_nodes(self):
+        return len(self.node_ids)
+
+    def find_row(self, node_id):
+        """
+        Row of node_id in the checkpoint, or None
+        """
+        row = int(numpy.searchsorted(self.node_ids, node_id))
+        if row < len(self.node_ids) and self.node_ids[row] == node_id:
+            return row
+        return None
+
+    def get_assigned_role(self, node_id):
+        row = self.find_row(node_id)
+        if row is None or self.assigned_roles[row] == NO_ROLE:
+            return None
+        return int(self.assigned_roles[row])
+
+    def get_grades(self, node_id):
+        """
+        role id -> grade dictionary of node_id, or None if the node is not in the checkpoint
+        """
+        row = self.find_row(node_id)
+        if row is None:
+            return None
+        return self.get_row_grades(row)
+
+    def get_row_grades(self, row):
+        (start, end) = (self.row_offsets[row], self.row_offsets[row + 1])
+        return dict(zip(self.grade_role_ids[start:end].tolist(), self.grades[start:end].tolist()))
+
+    def get_fingerprint(self, node_id):
+        row = self.find_row(node_id)
+        if row is None or not self.fingerprints[row].any():
+            return None
+        return binascii.hexlify(self.fingerprints[row].tobytes())
+
+    def get_unassigned_roles(self):
+        return set(self.unassigned_roles.tolist())
+
+    def close(self):
+        # The arrays hold on to the buffer; drop them before closing it
+        for (name, _) in SECTIONS:
+            setattr(self, name, None)
+        self.buffer.close()
+
+MISSING = object()
+
+class CheckpointMap(MutableMapping):
+    """
+    Dictionary backed by a checkpoint: reads fall through to the memory-mapped file, and
+    writes and deletions are kept in memory on top of it. get_base(key) returns the
+    checkpointed value or MISSING; base_keys() iterates the checkpointed keys.
+    """
+
+    def __init__(self, get_base, base_keys, base_length):
+        self.get_base = get_base
+        self.base_keys = base_keys
+        self.overlay = {}
+        self.deleted = set()
+        self.length = base_length
+
+    def __getitem__(self, key):
+        if key in self.overlay:
+            return self.overlay[key]
+        if key in self.deleted:
+            raise KeyError(key)
+        value = self.get_base(key)
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        if key in self.overlay:
+            return True
+        return key not in self.deleted and self.get_base(key) is not MISSING
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self.length += 1
+        self.overlay[key] = value
+        self.deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.overlay.pop(key, None)
+        if self.get_base(key) is not MISSING:
+            self.deleted.add(key)
+        self.length -= 1
+
+    def __iter__(self):
+        for key in self.base_keys():
+            if key not in self.overlay and key not in self.deleted:
+                yield key
+        for key in list(self.overlay):
+            yield key
+
+    def __len__(self):
+        return self.length
+
+def assignment_map(checkpoint):
+    """
+    node id -> role id of the nodes holding a role
+    """
+    def get_base(node_id):
+        role_id = checkpoint.get_assigned_role(node_id)
+        return role_id if role_id is not None else MISSING
+
+    def base_keys():
+        return (int(node_id) for node_id in checkpoint.node_ids[checkpoint.assigned_roles != NO_ROLE])
+
+    return CheckpointMap(get_base, base_keys, checkpoint.num_assigned)
+
+def fingerprint_map(checkpoint):
+    def get_base(node_id):
+        fingerprint = checkpoint.get_fingerprint(node_id)
+        return fingerprint if fingerprint is not None else MISSING
+
+    def base_keys():
+        return (int(node_id) for node_id in checkpoint.node_ids[checkpoint.fingerprints.any(axis=1)])
+
+    return CheckpointMap(get_base, base_keys, int(checkpoint.fingerprints.any(axis=1).sum()))
@@ -0,0 +1,257 @@
+from role_criteria import RoleCriteria, evaluate_grade_matrix
+import bisect
+import numpy
+
+##################################################################################
+# Declarative role criterias. A DeclarativeRoleCriteria is built from predicates on
+# node parameter keys (Equals, OneOf, Range) that a node must match, and weighted
+# score terms that grade the nodes that do. compile_criterias turns a list of
+# criterias into an inverted index from parameter values to the roles that can
+# match them, so grading a node only touches those roles. Hand-written RoleCriteria
+# subclasses can be mixed in; they are graded for every node, as before.
+##################################################################################
+
+class Equals:
+
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+
+    def matches(self, node_parameters):
+        return self.key in node_parameters and node_parameters[self.key] == self.value
+
+    def describe(self):
+        return ("equals", self.key, self.value)
+
+class OneOf:
+
+    def __init__(self, key, values):
+        self.key = key
+        self.values = frozenset(values)
+
+    def matches(self, node_parameters):
+        try:
+            return self.key in node_parameters and node_parameters[self.key] in self.values
+        except TypeError:
+            # Unhashable parameter values are in no set
+            return False
+
+    def describe(self):
+        return ("one_of", self.key, tuple(sorted(self.values)))
+
+class Range:
+    """
+    minimum <= value <= maximum. Either bound may be left out.
+    """
+
+    def __init__(self, key, minimum=None, maximum=None):
+        self.key = key
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def matches(self, node_parameters):
+        if self.key not in node_parameters:
+            return False
+        value = node_parameters[self.key]
+        return (self.minimum is None or value >= self.minimum) and (self.maximum is None or value <= self.maximum)
+
+    def describe(self):
+        return ("range", self.key, self.minimum, self.maximum)
+
+class Weighted:
+    """
+    Score term adding weight to the grade of the nodes that match predicate
+    """
+
+    def __init__(self, predicate, weight):
+        self.predicate = predicate
+        self.weight = weight
+
+    def score(self, node_parameters):
+        return self.weight if self.predicate.matches(node_parameters) else 0
+
+    def describe(self):
+        return ("weighted", self.predicate.describe(), self.weight)
+
+class Scaled:
+    """
+    Score term adding weight times the numeric value of a parameter (0 if it is missing)
+    """
+
+    def __init__(self, key, weight):
+        self.key = key
+        self.weight = weight
+
+    def score(self, node_parameters):
+        return self.weight * float(node_parameters.get(self.key, 0))
+
+    def describe(self):
+        return ("scaled", self.key, self.weight)
+
+class DeclarativeRoleCriteria(RoleCriteria):
+    """
+    Nodes matching every requirement are graded base_grade plus the sum of the score terms;
+    the other nodes are graded 0. As with any criteria, a grade that is not positive means
+    the node does not satisfy the role.
+
+    Example:
+    DeclarativeRoleCriteria("gpu worker", [Equals("gpu", True), Range("memory_gb", minimum=16)],
+        [Scaled("memory_gb", 0.1), Weighted(OneOf("zone", ["us-east-1a", "us-east-1b"]), 2)])
+    """
+
+    def __init__(self, name, requirements=(), scores=(), base_grade=1.0):
+        self.name = name
+        self.requirements = list(requirements)
+        self.scores = list(scores)
+        self.base_grade = base_grade
+
+    def require(self, predicate):
+        """
+        Adds a requirement; returns the criteria, so that calls can be chained
+        """
+        self.requirements.append(predicate)
+        return self
+
+    def prefer(self, predicate, weight):
+        """
+        Adds weight to the grade of the nodes matching predicate
+        """
+        self.scores.append(Weighted(predicate, weight))
+        return self
+
+    def scale(self, key, weight):
+        """
+        Adds weight times the value of a numeric parameter to the grade
+        """
+        self.scores.append(Scaled(key, weight))
+        return self
+
+    def evaluate_against(self, node_parameters):
+        for requirement in self.requirements:
+            if not requirement.matches(node_parameters):
+                return 0
+        return self.base_grade + sum(score.score(node_parameters) for score in self.scores)
+
+    def cache_key(self):
+        # Rebuilt criterias with the same predicates share cached grades
+        return ("declarative", self.name, tuple(requirement.describe() for requirement in self.requirements),
+            tuple(score.describe() for score in self.scores), self.base_grade, self.cache_version)
+
+    def get_index_predicate(self):
+        """
+        The requirement the compiled index files this criteria under: the most selective
+        equality or set membership, else a range, else None
+        """
+        def selectivity(requirement):
+            if isinstance(requirement, Equals):
+                return 0
+            if isinstance(requirement, OneOf):
+                return len(requirement.values)
+            return float("inf")
+
+        indexable = [requirement for requirement in self.requirements if isinstance(requirement, (Equals, OneOf, Range))]
+        return min(indexable, key=selectivity) if indexable else None
+
+class CompiledRoleCriterias(list):
+    """
+    List of role criterias with an inverted index from parameter values to the declarative
+    criterias that can match them. It can be used wherever a list of role criterias is
+    expected (LogicalNode, RoleAssignmentService, ...): evaluate_grade_matrix then only
+    grades, for each node, the declarative criterias its parameters can match, plus every
+    criteria without an index predicate.
+    """
+
+    def __init__(self, role_criterias):
+        list.__init__(self, role_criterias)
+
+        # (key, value) -> role ids, for Equals and OneOf requirements
+        self.value_index = {}
+        # key -> (ranges without a minimum, sorted minimums, ranges sorted on their minimum),
+        # each range a (minimum, maximum, role_id) triple
+        self.range_index = {}
+        # Graded for every node: declarative criterias with nothing to index on, and
+        # hand-written criterias (graded through role_criteria.evaluate_grade_matrix)
+        self.unindexed_role_ids = []
+        self.opaque_role_ids = []
+
+        ranges = {}
+        for (role_id, role_criteria) in enumerate(self):
+            if not isinstance(role_criteria, DeclarativeRoleCriteria):
+                self.opaque_role_ids.append(role_id)
+                continue
+
+            predicate = role_criteria.get_index_predicate()
+            if predicate is None:
+                self.unindexed_role_ids.append(role_id)
+            elif isinstance(predicate, Equals):
+                self.value_index.setdefault((predicate.key, predicate.value), []).append(role_id)
+            elif isinstance(predicate, OneOf):
+                for value in predicate.values:
+                    self.value_index.setdefault((predicate.key, value), []).append(role_id)
+            else:
+                ranges.setdefault(predicate.key, []).append((predicate.minimum, predicate.maximum, role_id))
+
+        for (key, key_ranges) in ranges.items():
+            open_ranges = [key_range for key_range in key_ranges if key_range[0] is None]
+            bounded_ranges = sorted(key_range for key_range in key_ranges if key_range[0] is not None)
+            self.range_index[key] = (open_ranges, [key_range[0] for key_range in bounded_ranges], bounded_ranges)
+
+        self.value_index_keys = sorted(set(key for (key, _) in self.value_index))
+
+    def candidate_roles(self, node_parameters):
+        """
+        Ids of the declarative criterias whose index predicate node_parameters match
+        """
+        role_ids = list(self.unindexed_role_ids)
+
+        for key in self.value_index_keys:
+            if key in node_parameters:
+                try:
+                    role_ids.extend(self.value_index.get((key, node_parameters[key]), ()))
+                except TypeError:
+                    pass
+
+        for (key, (open_ranges, minimums, bounded_ranges)) in self.range_index.items():
+            if key not in node_parameters:
+                continue
+            value = node_parameters[key]
+
+            # Only the ranges starting at or below value can hold it
+            for (_, maximum, role_id) in open_ranges + bounded_ranges[:bisect.bisect_right(minimums, value)]:
+                if maximum is None or value <= maximum:
+                    role_ids.append(role_id)
+
+        return role_ids
+
+    def evaluate_sparse(self, node_parameters):
+        """
+        Grades one node against the declarative criterias it can match. Returns a
+        role id -> grade dictionary of the positive grades.
+        """
+        grades = {}
+        for role_id in self.candidate_roles(node_parameters):
+            grade = self[role_id].evaluate_against(node_parameters)
+            if grade > 0:
+                grades[role_id] = grade
+        return grades
+
+    def evaluate_grade_matrix(self, parameter_table, cache=None):
+        """
+        Counterpart of role_criteria.evaluate_grade_matrix, which calls it for compiled
+        criterias. Only the hand-written criterias go through cache; declarative grades
+        are cheaper to compute than to look up.
+        """
+        grade_matrix = numpy.zeros((len(parameter_table), len(self)))
+
+        if self.opaque_role_ids:
+            opaque_criterias = [self[role_id] for role_id in self.opaque_role_ids]
+            grade_matrix[:, self.opaque_role_ids] = evaluate_grade_matrix(opaque_criterias, parameter_table, cache)
+
+        for (row, node_parameters) in enumerate(parameter_table):
+            for (role_id, grade) in self.evaluate_sparse(node_parameters).items():
+                grade_matrix[row, role_id] = grade
+
+        return grade_matrix
+
+def compile_criterias(role_criterias):
+    return CompiledRoleCriterias(role_criterias)
@@ -0,0 +1,387 @@
+from network import Network
+from async_network import FRAME_HEADER
+from wire_format import varint_size
+import cPickle as pickle
+import random
+import heapq
+
+##################################################################################
+# A deterministic, single threaded network simulator. Handlers of the logical
+# nodes run on a virtual clock: every message leaves its sender at the sender's
+# virtual time, crosses a link whose latency, bandwidth and loss come from
+# pluggable models, and runs its handler at its arrival time. Pending deliveries
+# wait on a priority queue ordered by arrival time; a node waiting on a reply runs
+# that delivery on demand, so the clocks follow the causal order of the messages.
+# Randomness comes from a single seeded generator, so a run is reproducible.
+##################################################################################
+
+class ConstantLatency:
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def get_latency(self, src_node_id, dst_node_id, random):
+        return self.seconds
+
+class UniformLatency:
+    """
+    Latency drawn uniformly from [low, high] for every message
+    """
+
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+
+    def get_latency(self, src_node_id, dst_node_id, random):
+        return random.uniform(self.low, self.high)
+
+class ZoneLatency:
+    """
+    Topology of zones (racks, datacenters, ...): messages within a zone take local_latency,
+    the others remote_latency, each with up to jitter seconds added. node_zones maps node
+    ids to zones (a list or a dictionary).
+    """
+
+    def __init__(self, node_zones, local_latency, remote_latency, jitter=0.0):
+        self.node_zones = node_zones
+        self.local_latency = local_latency
+        self.remote_latency = remote_latency
+        self.jitter = jitter
+
+    def get_latency(self, src_node_id, dst_node_id, random):
+        if self.node_zones[src_node_id] == self.node_zones[dst_node_id]:
+            latency = self.local_latency
+        else:
+            latency = self.remote_latency
+        return latency + random.uniform(0, self.jitter) if self.jitter else latency
+
+class ConstantBandwidth:
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+
+    def get_bandwidth(self, src_node_id, dst_node_id):
+        return self.bytes_per_second
+
+class ZoneBandwidth:
+    """
+    Bandwidth of the links within a zone and between zones, as for ZoneLatency
+    """
+
+    def __init__(self, node_zones, local_bytes_per_second, remote_bytes_per_second):
+        self.node_zones = node_zones
+        self.local_bytes_per_second = local_bytes_per_second
+        self.remote_bytes_per_second = remote_bytes_per_second
+
+    def get_bandwidth(self, src_node_id, dst_node_id):
+        if self.node_zones[src_node_id] == self.node_zones[dst_node_id]:
+            return self.local_bytes_per_second
+        return self.remote_bytes_per_second
+
+class ConstantLoss:
+    """
+    Every transmission is lost with the given probability. Lost messages are sent again
+    once the network's retransmission timeout expires.
+    """
+
+    def __init__(self, probability):
+        if not 0 <= probability < 1:
+            raise ValueError("loss probability must be in [0, 1)")
+        self.probability = probability
+
+    def get_loss_rate(self, src_node_id, dst_node_id):
+        return self.probability
+
+def message_size(value):
+    """
+    Bytes of a message or reply on the wire. Encoded messages are byte strings already;
+    anything else is measured by pickling it.
+    """
+    if value is None:
+        return 0
+    if isinstance(value, (str, bytearray)):
+        return len(value)
+    if isinstance(value, (int, long)) and value >= 0:
+        return varint_size(value)
+    if isinstance(value, tuple):
+        return sum(message_size(item) for item in value)
+    return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+class Link:
+    """
+    Directed link between two nodes. Messages are serialized onto the link one at a time.
+    """
+
+    def __init__(self):
+        self.busy_until = 0.0
+        self.busy_time = 0.0
+        self.messages = 0
+        self.bytes = 0
+        self.lost_messages = 0
+
+class DiscreteEventNetwork(Network):
+
+    class Future:
+        """
+        Simulates the rpyc async interface. The handler runs when the reply is first waited
+        on, or when the network drains its queue.
+        """
+
+        def __init__(self, network, message_type, src_node_id, dst_node_id, handler, args, arrival_time, hops,
+                     trace_context):
+            self.network = network
+            self.message_type = message_type
+            self.src_node_id = src_node_id
+            self.dst_node_id = dst_node_id
+            self.handler = handler
+            self.args = args
+            self.arrival_time = arrival_time
+            self.hops = hops
+            self.trace_context = trace_context
+            self.done = False
+            self.value = None
+            self.exception = None
+            self.reply_time = None
+            # Set once the sender has given up on the reply
+            self.abandoned = False
+
+        def wait(self):
+            self.network.deliver(self)
+            self.network.advance(self.reply_time, self.hops + 1)
+            if self.exception is not None:
+                raise self.exception
+
+    def __init__(self, logical_nodes, latency_model=None, bandwidth_model=None, loss_model=None,
+                 processing_time=0.0, retransmission_timeout=0.2, seed=0, encode_messages=True):
+        """
+        latency_model, bandwidth_model and loss_model give the properties of every link
+        (see ConstantLatency, UniformLatency and ZoneLatency; ConstantBandwidth and
+        ZoneBandwidth; ConstantLoss). Links default to 0.5ms of latency, unlimited
+        bandwidth and no loss. processing_time is the virtual time a node spends in every
+        handler. Messages are encoded by default, so that link usage follows the wire
+        format's sizes.
+        """
+        Network.__init__(self, encode_messages)
+
+        self.latency_model = latency_model if latency_model is not None else ConstantLatency(0.0005)
+        self.bandwidth_model = bandwidth_model
+        self.loss_model = loss_model
+        self.processing_time = processing_time
+        self.retransmission_timeout = retransmission_timeout
+        self.random = random.Random(seed)
+
+        self.logical_nodes = logical_nodes
+        for logical_node in logical_nodes:
+            logical_node.set_network(self)
+
+        self.events = []
+        self.next_event_id = 0
+        self.links = {}
+
+        # The virtual time, hop count and node of the handler that is running
+        self.now = 0.0
+        self.hops = 0
+        self.current_node_id = None
+
+        self.start_time = 0.0
+        self.end_time = 0.0
+        self.critical_path_length = 0
+
+    def add_node(self, node_id, logical_node):
+        if logical_node.node_id != node_id:
+            raise ValueError("node %d cannot be added as node %d" % (logical_node.node_id, node_id))
+        logical_node.set_network(self)
+        Network.add_node(self, node_id, logical_node)
+
+    def run(self, node_id, method_name, *args):
+        """
+        Calls a method of a node (e.g. "begin_logical_assignment") at the current virtual
+        time, then delivers every message still pending. Returns the method's result.
+        """
+        self.start_time = self.now
+        self.end_time = self.now
+        self.hops = 0
+        self.critical_path_length = 0
+        for link in self.links.values():
+            link.busy_time = 0.0
+            link.messages = 0
+            link.bytes = 0
+            link.lost_messages = 0
+
+        self.current_node_id = node_id
+        value = getattr(self.logical_nodes[node_id], method_name)(*args)
+        self.advance(self.now, self.hops)
+
+        while self.events:
+            (_, _, future) = heapq.heappop(self.events)
+            self.deliver(future)
+            if not future.abandoned:
+                self.advance(future.reply_time, future.hops + 1)
+
+        self.current_node_id = None
+        return value
+
+    def send_async_message(self, message_type, dst_node_id, handler_name, *args):
+        handler = getattr(self.logical_nodes[dst_node_id], handler_name)
+        return self.send_message(message_type, dst_node_id, handler, args)
+
+    def get_handler(self, message_type, dst_node_id, handler_name):
+        """
+        Handlers called directly (the token walk) block until their reply arrives
+        """
+        def call(*args):
+            future = self.send_message(message_type, dst_node_id, getattr(self.logical_nodes[dst_node_id], handler_name), args)
+            future.wait()
+            return future.value
+        return call
+
+    def send_message(self, message_type, dst_node_id, handler, args):
+        src_node_id = self.current_node_id
+        arrival_time = self.transmit(src_node_id, dst_node_id, self.now, message_size(args))
+        trace_context = self.tracer.get_context() if self.tracer is not None else None
+        future = DiscreteEventNetwork.Future(self, message_type, src_node_id, dst_node_id, handler, args,
+            arrival_time, self.hops + 1, trace_context)
+
+        heapq.heappush(self.events, (arrival_time, self.next_event_id, future))
+        self.next_event_id += 1
+        return future
+
+    def gather(self, message_type, results, levels=1):
+        """
+        Gathers in virtual time: every message is delivered, and the replies are returned in
+        the order they arrive, up to the phase's deadline. Later replies are ignored, and do
+        not count towards the completion time.
+        """
+        timeout = self.phase_timeouts.get(message_type)
+        return DiscreteEventNetwork.Gather(self, results, timeout * levels if timeout is not None else None)
+
+    class Gather:
+        """
+        Virtual time counterpart of network.Gather
+        """
+
+        def __init__(self, network, results, timeout):
+            self.network = network
+            self.results = list(results)
+            self.timeout = timeout
+            self.dropped = {}
+
+        def __iter__(self):
+            network = self.network
+            deadline = network.now + self.timeout if self.timeout is not None else float("inf")
+
+            # Late replies are still delivered: the slow node does handle the message
+            for (_, result) in self.results:
+                network.deliver(result.result)
+            arrivals = sorted(self.results, key=lambda node_result: node_result[1].result.reply_time)
+
+            for (node_id, result) in arrivals:
+                future = result.result
+                if future.reply_time > deadline:
+                    future.abandoned = True
+                    self.dropped[node_id] = "timeout"
+                    continue
+                network.advance(future.reply_time, future.hops + 1)
+                if future.exception is not None:
+                    self.dropped[node_id] = "error"
+                    continue
+                yield (node_id, result)
+
+            # The sender only learns that a reply is late once the deadline has passed
+            if "timeout" in self.dropped.values():
+                network.advance(deadline, network.hops)
+
+    def deliver(self, future):
+        """
+        Runs the handler of a message at its arrival time, on the destination node, and
+        sends the reply back
+        """
+        if future.done:
+            return
+
+        context = (self.now, self.hops, self.current_node_id)
+        (self.now, self.hops, self.current_node_id) = (future.arrival_time, future.hops, future.dst_node_id)
+        try:
+            future.value = self.run_traced_handler(future.dst_node_id, future.message_type, future.trace_context,
+                future.handler, *future.args)
+        except Exception as e:
+            future.exception = e
+
+        finish_time = self.now + self.processing_time
+        future.hops = self.hops
+        future.reply_time = self.transmit(future.dst_node_id, future.src_node_id, finish_time, message_size(future.value))
+        future.done = True
+
+        (self.now, self.hops, self.current_node_id) = context
+
+    def transmit(self, src_node_id, dst_node_id, send_time, num_bytes):
+        """
+        Returns the arrival time of num_bytes (plus framing) sent at send_time
+        """
+        link = self.links.get((src_node_id, dst_node_id))
+        if link is None:
+            link = self.links[(src_node_id, dst_node_id)] = Link()
+
+        num_bytes += FRAME_HEADER.size
+        bandwidth = self.bandwidth_model.get_bandwidth(src_node_id, dst_node_id) if self.bandwidth_model else None
+        transmission_time = float(num_bytes) / bandwidth if bandwidth else 0.0
+        loss_rate = self.loss_model.get_loss_rate(src_node_id, dst_node_id) if self.loss_model else 0.0
+
+        link.messages += 1
+        start_time = max(send_time, link.busy_until)
+        while True:
+            link.busy_until = start_time + transmission_time
+            link.busy_time += transmission_time
+            link.bytes += num_bytes
+            if not loss_rate or self.random.random() >= loss_rate:
+                break
+            link.lost_messages += 1
+            start_time = max(link.busy_until, start_time + self.retransmission_timeout)
+
+        return link.busy_until + self.latency_model.get_latency(src_node_id, dst_node_id, self.random)
+
+    def advance(self, time, hops):
+        """
+        Moves the running handler's clock forward, e.g. once a reply has arrived
+        """
+        self.now = max(self.now, time)
+        self.hops = max(self.hops, hops)
+        self.end_time = max(self.end_time, self.now)
+        self.critical_path_length = max(self.critical_path_length, self.hops)
+
+    def get_completion_time(self):
+        """
+        Simulated seconds from the start of the last run until its last message arrived
+        """
+        return self.end_time - self.start_time
+
+    def get_critical_path_length(self):
+        """
+        Number of messages on the longest causal chain of the last run, replies included
+        """
+        return self.critical_path_length
+
+    def get_link_statistics(self):
+        """
+        Returns a (src node id, dst node id) -> statistics dictionary for every link used in
+        the last run. utilization is the fraction of the run the link spent transmitting.
+        """
+        completion_time = self.get_completion_time()
+        statistics = {}
+        for (link_id, link) in self.links.items():
+            if not link.messages:
+                continue
+            statistics[link_id] = {
+                "messages": link.messages,
+                "bytes": link.bytes,
+                "lost_messages": link.lost_messages,
+                "busy_time": link.busy_time,
+                "utilization": link.busy_time / completion_time if completion_time else 0.0
+            }
+        return statistics
+
+    def start_server(self):
+        pass
+
+    def stop_server(self):
+        pass
@@ -0,0 +1,118 @@
+from collections import OrderedDict
+import threading
+import hashlib
+import numpy
+
+##################################################################################
+# Opt-in memoization of RoleCriteria grades. A grade is cached under the criteria's
+# cache_key (its identity and cache_version) and a fingerprint of the node's
+# parameters, so repeated assignment rounds over unchanged nodes skip the user's
+# evaluate_against / evaluate_batch hooks entirely.
+##################################################################################
+
+# Parameter values whose repr is their value, the same in every process
+REPR_TYPES = (type(None), bool, int, long, float, complex, str, numpy.generic)
+
+def parameters_fingerprint(parameters):
+    """
+    Stable digest of a node's parameters: equal parameters give equal fingerprints across
+    calls and processes, regardless of dictionary or set ordering. Parameter values are
+    numbers, strings, None, numpy arrays, dictionaries, lists, tuples and sets of those, or
+    objects with a __fingerprint__ method returning such a value; any other value raises a
+    TypeError, since its repr may hold its address and miss in-place changes.
+    """
+    return hashlib.sha1(_canonical(parameters)).hexdigest()
+
+def _canonical(value):
+    if isinstance(value, dict):
+        return "{" + ",".join(sorted(_canonical(key) + ":" + _canonical(item) for (key, item) in value.items())) + "}"
+    if isinstance(value, list):
+        return "[" + ",".join(_canonical(item) for item in value) + "]"
+    if isinstance(value, tuple):
+        return "(" + ",".join(_canonical(item) for item in value) + ")"
+    if isinstance(value, (set, frozenset)):
+        return "<" + ",".join(sorted(_canonical(item) for item in value)) + ">"
+    if isinstance(value, numpy.ndarray):
+        return "ndarray:%s:%s:%s" % (value.dtype.str, value.shape, hashlib.sha1(numpy.ascontiguousarray(value).tobytes()).hexdigest())
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    if isinstance(value, REPR_TYPES):
+        return type(value).__name__ + ":" + repr(value)
+    fingerprint = getattr(value, "__fingerprint__", None)
+    if fingerprint is not None:
+        return value.__class__.__name__ + "#" + _canonical(fingerprint())
+    raise TypeError("parameter values of type %s cannot be fingerprinted, give them a __fingerprint__ method"
+        % value.__class__.__name__)
+
+class EvaluationCache:
+    """
+    Thread safe, size bounded cache of grades with least recently used eviction.
+    Keys are (criteria cache key, parameters fingerprint) pairs.
+    """
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        """
+        Returns the cached grade for key, or None on a miss
+        """
+        self.lock.acquire()
+        try:
+            grade = self.entries.pop(key, None)
+            if grade is None:
+                self.misses += 1
+                return None
+
+            # Re-inserting moves the entry to the most recently used end
+            self.entries[key] = grade
+            self.hits += 1
+            return grade
+        finally:
+            self.lock.release()
+
+    def store(self, key, grade):
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.entries[key] = grade
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def invalidate(self, role_criteria=None, parameters=None):
+        """
+        Drops the entries of one criteria, of one set of node parameters, or of both at once.
+        With no arguments, the whole cache is cleared.
+        """
+        criteria_key = role_criteria.cache_key() if role_criteria is not None else None
+        fingerprint = parameters_fingerprint(parameters) if parameters is not None else None
+
+        self.lock.acquire()
+        try:
+            if criteria_key is None and fingerprint is None:
+                self.entries.clear()
+                return
+
+            for key in list(self.entries):
+                if criteria_key is not None and key[0] != criteria_key:
+                    continue
+                if fingerprint is not None and key[1] != fingerprint:
+                    continue
+                del self.entries[key]
+        finally:
+            self.lock.release()
+
+    def get_hit_count(self):
+        return self.hits
+
+    def get_miss_count(self):
+        return self.misses
+
+    def __len__(self):
+        return len(self.entries)
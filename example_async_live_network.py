@@ -0,0 +1,86 @@
+from network import *
+from async_network import *
+from logical_node import *
+from role_criteria import *
+
+import sys
+
+##################################################################################
+# Same cluster as example_live_network.py, running on AsyncLiveNetwork instead of
+# rpyc. Nodes can either be started in separate processes (start_node) or all in
+# this process on localhost (run_local).
+##################################################################################
+class MockRoleCriteria(RoleCriteria):
+    def __init__(self, name, node_grade_map):
+        self.name = name
+        self.node_grade_map = node_grade_map
+
+    def evaluate_against(self, node_parameters):
+        return self.node_grade_map[node_parameters["node_id"]]
+
+role_criterias = [
+    MockRoleCriteria("rc0", {0: 1, 1: 0, 2: 3}),
+    MockRoleCriteria("rc1", {0: 4, 1: 4, 2: 0}),
+    MockRoleCriteria("rc2", {0: 0, 1: 8, 2: 0})
+]
+
+nodes = [
+    LogicalNode(0, { "node_id": 0 }, role_criterias, iterative_token_walk=True),
+    LogicalNode(1, { "node_id": 1 }, role_criterias, iterative_token_walk=True),
+    LogicalNode(2, { "node_id": 2 }, role_criterias, iterative_token_walk=True)
+]
+
+node_ip_addresses = [
+    ("localhost", 5005),
+    ("localhost", 5006),
+    ("localhost", 5007)
+]
+
+def begin_algorithm(node_id):
+    # One frame loop carries the requests to every node, and is stopped once done
+    loop = FrameLoop(None)
+    loop.start()
+    try:
+        clients = [AsyncLiveNetwork.Peer(loop, node_ip_address) for node_ip_address in node_ip_addresses]
+        token = clients[node_id].begin_logical_assignment()
+
+        if token:
+            print "Error! Some roles couldn't be satisfied"
+            for role_id in token.unassigned_roles:
+                print "Role %d: %s" % (role_id, role_criterias[role_id].name)
+        else:
+            print "Success! All roles assigned!"
+            for client in clients:
+                assigned_role = client.get_attribute("assigned_role")
+                if assigned_role is not None:
+                    print "Node %d's role: %s" % (client.get_attribute("node_id"), role_criterias[assigned_role].name)
+    finally:
+        loop.stop()
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print "USAGE: python example_async_live_network.py command [NODE_ID]"
+        exit(1)
+
+    command = sys.argv[1].lower()
+
+    if command == "start_node":
+        node = nodes[int(sys.argv[2])]
+        network = AsyncLiveNetwork(node, node_ip_addresses)
+        network.start_server()
+
+    elif command == "begin_algorithm":
+        begin_algorithm(int(sys.argv[2]))
+
+    elif command == "run_local":
+        networks = [AsyncLiveNetwork(node, node_ip_addresses) for node in nodes]
+        for network in networks:
+            network.start_server(block=False)
+
+        begin_algorithm(0)
+
+        for network in networks:
+            network.stop_server()
+    else:
+        print "Unrecognized command: %s" % command
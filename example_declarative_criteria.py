@@ -0,0 +1,37 @@
+from network import *
+from logical_node import *
+from criteria_dsl import *
+
+##################################################################################
+# The cluster of example_simple.py, with its criterias written declaratively.
+# compile_criterias indexes them on their parameter values, so that every node
+# only grades the roles it can match.
+##################################################################################
+role_criterias = compile_criterias([
+    DeclarativeRoleCriteria("very sad").require(Equals("happy", False)).require(Equals("excited", False)),
+    DeclarativeRoleCriteria("just content").require(Equals("happy", True)).require(Equals("excited", False)),
+    DeclarativeRoleCriteria("freaking excited", [Equals("happy", True), Equals("excited", True)])
+])
+
+nodes = [
+    LogicalNode(0, { "happy": True, "excited": True }, role_criterias),
+    LogicalNode(1, { "happy": True, "excited": True }, role_criterias),
+    LogicalNode(2, { "happy": False, "excited": False }, role_criterias),
+    LogicalNode(3, { "happy": True, "excited": False }, role_criterias)
+]
+
+if __name__ == '__main__':
+
+    network = SimulatedNetwork(nodes)
+
+    token = nodes[0].begin_logical_assignment()
+
+    if token:
+        print "Error! Some roles couldn't be satisfied"
+        for role_id in token.unassigned_roles:
+            print "Role %d: %s" % (role_id, role_criterias[role_id].name)
+    else:
+        print "Success! All roles assigned!"
+        for node in nodes:
+            if node.assigned_role is not None:
+                print "Node %d's role: %s" % (node.node_id, role_criterias[node.assigned_role].name)
@@ -31,9 +31,9 @@ role_criterias = [
 ]
 
 nodes = [
-    LogicalNode(0, { "node_id": 0 }, role_criterias),
-    LogicalNode(1, { "node_id": 1 }, role_criterias),
-    LogicalNode(2, { "node_id": 2 }, role_criterias)
+    LogicalNode(0, { "node_id": 0 }, role_criterias, iterative_token_walk=True),
+    LogicalNode(1, { "node_id": 1 }, role_criterias, iterative_token_walk=True),
+    LogicalNode(2, { "node_id": 2 }, role_criterias, iterative_token_walk=True)
 ]
 
 node_ip_addresses = [
@@ -53,13 +53,13 @@ if __name__ == '__main__':
 
     if command == "start_node":
         node = nodes[node_id]
-        network = LiveNetwork(node, node_ip_addresses)
+        network = LiveNetwork(node, node_ip_addresses, warm_up=True)
         network.start_server()
 
     elif command == "begin_algorithm":
 
-        client = LiveNetwork.create_conn(node_ip_addresses[node_id])
-        token = client.root.begin_logical_assignment()
+        clients = [LiveNetwork.Client(node_ip_address, pool_size=1) for node_ip_address in node_ip_addresses]
+        token = clients[node_id].begin_logical_assignment()
 
         if token:
             print "Error! Some roles couldn't be satisfied"
@@ -67,9 +67,9 @@ if __name__ == '__main__':
                 print "Role %d: %s" % (role_id, role_criterias[role_id].name)
         else:
             print "Success! All roles assigned!"
-            for node_ip_address in node_ip_addresses:
-                node_proxy = LiveNetwork.create_conn(node_ip_address)
-                if node_proxy.root.assigned_role is not None:
-                    print "Node %d's role: %s" % (node_proxy.root.node_id, role_criterias[node_proxy.root.assigned_role].name)
+            for client in clients:
+                assigned_role = client.get_attribute("assigned_role")
+                if assigned_role is not None:
+                    print "Node %d's role: %s" % (client.get_attribute("node_id"), role_criterias[assigned_role].name)
     else:
         print "Unrecognized command: %s" % command
\ No newline at end of file
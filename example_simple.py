@@ -3,6 +3,8 @@ from network import *
 from logical_node import *
 from role_criteria import *
 
+import numpy
+
 ##################################################################################
 # Example code that roughly shows how the framework is to be used. Note: the
 # relationship between the network and the logical nodes will likely change.
@@ -16,6 +18,11 @@ class MyAwesomeRoleCriteria(RoleCriteria):
     def evaluate_against(self, node_parameters):
         return int(self.happy == node_parameters["happy"] and self.excited == node_parameters["excited"])
 
+    def evaluate_batch(self, parameter_table):
+        happy = numpy.array([node_parameters["happy"] for node_parameters in parameter_table])
+        excited = numpy.array([node_parameters["excited"] for node_parameters in parameter_table])
+        return ((happy == self.happy) & (excited == self.excited)).astype(int)
+
 # Clients will define their own RoleCriteria, which will expect
 # a certain set of parameters to evaluate on
 role_criterias = [
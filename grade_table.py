@@ -0,0 +1,168 @@
+from collections import MutableMapping, Mapping
+from array import array
+import numpy
+
+##################################################################################
+# Compact storage of the grades of a whole cluster. Only the positive grades of
+# each node are kept, as one row of a sparse matrix (CSR): flat arrays of role ids
+# and grades, and the offset of every row. Grades arrive a chunk of nodes at a
+# time, straight from a dense grade matrix, so bulk ingestion never builds a
+# dictionary or set per node. A node graded again gets a new row; the arrays are
+# compacted once the rows left behind outnumber the live ones.
+##################################################################################
+
+class GradeTable(MutableMapping):
+    """
+    node id -> role id -> grade mapping over the rows. Grades are returned as new
+    dictionaries, so solvers can use the table wherever a role grade map is expected.
+    checkpoint, a checkpoint.Checkpoint, serves the grades of the nodes not graded since
+    it was restored.
+    """
+
+    def __init__(self, num_roles, checkpoint=None):
+        self.num_roles = num_roles
+        self.checkpoint = checkpoint
+
+        self.row_offsets = array("l", [0])
+        self.role_ids = array("i")
+        self.grades = array("d")
+        # node id -> its row, and the number of rows no node points to any more
+        self.row_index = {}
+        self.dead_rows = 0
+        # Checkpointed nodes graded again or removed since the restore
+        self.shadowed = set()
+
+    def add_grades(self, node_ids, grade_matrix):
+        """
+        Stores the positive grades of a len(node_ids) x num_roles grade matrix, row i
+        holding the grades of node_ids[i]
+        """
+        grade_matrix = numpy.asarray(grade_matrix, dtype=numpy.float64)
+        (rows, role_ids) = (grade_matrix > 0).nonzero()
+
+        first_row = len(self.row_offsets) - 1
+        row_offsets = self.row_offsets[-1] + numpy.cumsum(numpy.bincount(rows, minlength=len(node_ids)))
+        self.row_offsets.fromstring(row_offsets.astype(numpy.int_).tobytes())
+        self.role_ids.fromstring(role_ids.astype(numpy.intc).tobytes())
+        self.grades.fromstring(grade_matrix[rows, role_ids].tobytes())
+
+        for (row, node_id) in enumerate(node_ids, first_row):
+            self._index(node_id, row)
+        self._compact_if_sparse()
+
+    def get_roles(self, node_id):
+        """
+        Set of the roles node_id satisfies
+        """
+        row = self.row_index.get(node_id)
+        if row is not None:
+            return set(self.role_ids[self.row_offsets[row]:self.row_offsets[row + 1]])
+        return set(self._get_base(node_id))
+
+    def __getitem__(self, node_id):
+        row = self.row_index.get(node_id)
+        if row is not None:
+            (start, end) = (self.row_offsets[row], self.row_offsets[row + 1])
+            return dict(zip(self.role_ids[start:end], self.grades[start:end]))
+        return self._get_base(node_id)
+
+    def _get_base(self, node_id):
+        grades = None
+        if self.checkpoint is not None and node_id not in self.shadowed:
+            grades = self.checkpoint.get_grades(node_id)
+        if grades is None:
+            raise KeyError(node_id)
+        return grades
+
+    def _in_base(self, node_id):
+        return self.checkpoint is not None and node_id not in self.shadowed and \
+            self.checkpoint.find_row(node_id) is not None
+
+    def __contains__(self, node_id):
+        return node_id in self.row_index or self._in_base(node_id)
+
+    def __setitem__(self, node_id, role_grades):
+        role_grades = sorted(role_grades.items())
+        self.role_ids.extend(role_id for (role_id, _) in role_grades)
+        self.grades.extend(grade for (_, grade) in role_grades)
+        self.row_offsets.append(len(self.role_ids))
+        self._index(node_id, len(self.row_offsets) - 2)
+        self._compact_if_sparse()
+
+    def __delitem__(self, node_id):
+        if node_id in self.row_index:
+            del self.row_index[node_id]
+            self.dead_rows += 1
+        elif self._in_base(node_id):
+            self.shadowed.add(node_id)
+        else:
+            raise KeyError(node_id)
+
+    def _index(self, node_id, row):
+        if node_id in self.row_index:
+            self.dead_rows += 1
+        elif self._in_base(node_id):
+            self.shadowed.add(node_id)
+        self.row_index[node_id] = row
+
+    def __iter__(self):
+        if self.checkpoint is not None:
+            for node_id in self.checkpoint.node_ids.tolist():
+                if node_id not in self.shadowed:
+                    yield node_id
+        for node_id in list(self.row_index):
+            yield node_id
+
+    def __len__(self):
+        num_base_nodes = self.checkpoint.get_num_nodes() - len(self.shadowed) if self.checkpoint is not None else 0
+        return num_base_nodes + len(self.row_index)
+
+    def _compact_if_sparse(self):
+        if self.dead_rows > len(self.row_index):
+            self.compact()
+
+    def compact(self):
+        """
+        Drops the rows of nodes graded again or removed
+        """
+        row_offsets = numpy.frombuffer(self.row_offsets, dtype=numpy.int_)
+        live_rows = numpy.array(list(self.row_index.values()), dtype=numpy.int_)
+        (starts, ends) = (row_offsets[live_rows], row_offsets[live_rows + 1])
+
+        # Positions of every kept grade, row after row
+        lengths = ends - starts
+        new_offsets = numpy.zeros(len(live_rows) + 1, dtype=numpy.int_)
+        new_offsets[1:] = numpy.cumsum(lengths)
+        positions = numpy.repeat(starts - new_offsets[:-1], lengths) + numpy.arange(new_offsets[-1])
+
+        role_ids = numpy.frombuffer(self.role_ids, dtype=numpy.intc)[positions]
+        grades = numpy.frombuffer(self.grades, dtype=numpy.float64)[positions]
+
+        self.row_offsets = array("l", new_offsets.tobytes())
+        self.role_ids = array("i", role_ids.tobytes())
+        self.grades = array("d", grades.tobytes())
+        self.row_index = dict(zip(list(self.row_index), range(len(live_rows))))
+        self.dead_rows = 0
+
+    def satisfaction_map(self):
+        return RoleSatisfactionMap(self)
+
+class RoleSatisfactionMap(Mapping):
+    """
+    Read only node id -> set of satisfiable roles view of a GradeTable
+    """
+
+    def __init__(self, grade_table):
+        self.grade_table = grade_table
+
+    def __getitem__(self, node_id):
+        return self.grade_table.get_roles(node_id)
+
+    def __contains__(self, node_id):
+        return node_id in self.grade_table
+
+    def __iter__(self):
+        return iter(self.grade_table)
+
+    def __len__(self):
+        return len(self.grade_table)
@@ -0,0 +1,288 @@
+from logical_node import LogicalNode
+from network import SimulatedNetwork, InlineExecutor
+from naive_centralized_algorithm import RoleAssignmentService
+from assignment_solvers import HopcroftKarpSolver, solve_with_role_counts
+import multiprocessing
+import time
+
+##################################################################################
+# Hierarchical role assignment for very large clusters. Nodes are partitioned into
+# zones, and every zone's demand (its share of each role count) is assigned by a
+# local coordinator, the zones in parallel on forked worker processes. Only the demand a zone could not fill
+# and the idle nodes able to fill it are escalated to a global reconciliation step,
+# which solves that (much smaller) residual problem centrally.
+##################################################################################
+
+class BlockPartitioner:
+    """
+    Contiguous blocks of at most zone_size nodes, in node order
+    """
+
+    def __init__(self, zone_size):
+        if zone_size < 1:
+            raise ValueError("zone_size must be at least 1")
+        self.zone_size = zone_size
+
+    def partition(self, nodes):
+        return [nodes[start:start + self.zone_size] for start in range(0, len(nodes), self.zone_size)]
+
+class ModuloPartitioner:
+    """
+    num_zones zones, node i going to zone i % num_zones
+    """
+
+    def __init__(self, num_zones):
+        if num_zones < 1:
+            raise ValueError("num_zones must be at least 1")
+        self.num_zones = num_zones
+
+    def partition(self, nodes):
+        zones = [nodes[zone_id::self.num_zones] for zone_id in range(self.num_zones)]
+        return [zone for zone in zones if zone]
+
+class ParameterPartitioner:
+    """
+    One zone per distinct value of a node parameter, e.g. "rack" or "datacenter". Nodes
+    without the parameter share a zone.
+    """
+
+    def __init__(self, parameter_name):
+        self.parameter_name = parameter_name
+
+    def partition(self, nodes):
+        zones = {}
+        zone_order = []
+        for node in nodes:
+            key = node.parameters.get(self.parameter_name)
+            if key not in zones:
+                zones[key] = []
+                zone_order.append(key)
+            zones[key].append(node)
+        return [zones[key] for key in zone_order]
+
+class CentralizedZoneAssigner:
+    """
+    Assigns a zone with a RoleAssignmentService of its own
+    """
+
+    def __init__(self, solver=None, evaluation_cache=None):
+        self.solver = solver
+        self.evaluation_cache = evaluation_cache
+
+    def assign(self, zone_nodes, role_criterias, role_counts):
+        """
+        Returns (role_assignment_map, role_grade_map) for the zone's nodes, the grade map
+        covering at least the nodes left without a role
+        """
+        service = RoleAssignmentService(role_criterias, self.solver, self.evaluation_cache, role_counts)
+        service.evaluate_nodes(zone_nodes)
+        service.compute_role_assignment()
+        return (service.role_assignment_map, service.role_grade_map)
+
+class TokenZoneAssigner:
+    """
+    Assigns a zone with the token algorithm, on a SimulatedNetwork of copies of the zone's
+    nodes. The zone's first node is its coordinator and begins the logical assignment.
+    """
+
+    def __init__(self, broadcast_fanout=None, evaluation_cache=None):
+        self.broadcast_fanout = broadcast_fanout
+        self.evaluation_cache = evaluation_cache
+
+    def assign(self, zone_nodes, role_criterias, role_counts):
+        local_nodes = [LogicalNode(local_id, node.parameters, role_criterias, iterative_token_walk=True,
+                broadcast_fanout=self.broadcast_fanout, evaluation_cache=self.evaluation_cache)
+            for (local_id, node) in enumerate(zone_nodes)]
+        coordinator = local_nodes[0]
+
+        SimulatedNetwork(local_nodes, InlineExecutor())
+        coordinator.begin_logical_assignment(role_counts)
+
+        # Update messages drop fully assigned roles from the candidates' grades, and another
+        # zone may still escalate those roles, so idle candidates of such roles are re-graded
+        regraded_local_ids = set()
+        for (role_id, local_ids) in coordinator.role_candidates.items():
+            if role_counts[role_id] > 0 and role_id not in coordinator.unfilled_roles:
+                regraded_local_ids.update(local_ids)
+
+        role_assignment_map = {}
+        role_grade_map = {}
+        for (node, local_node) in zip(zone_nodes, local_nodes):
+            if local_node.assigned_role is not None:
+                role_assignment_map[node.node_id] = local_node.assigned_role
+                continue
+
+            if local_node.node_id in regraded_local_ids:
+                local_node.evaluate_roles()
+            role_grade_map[node.node_id] = dict(local_node.satisfiable_roles)
+        return (role_assignment_map, role_grade_map)
+
+# The HierarchicalAssignment, zones and zone role counts of a worker process
+_zone_work = None
+
+def _init_zone_worker(assignment, zones, zone_role_counts):
+    global _zone_work
+    _zone_work = (assignment, zones, zone_role_counts)
+
+def _assign_zone(zone_id):
+    (assignment, zones, zone_role_counts) = _zone_work
+    (role_assignment_map, role_grade_map, latency) = assignment.assign_zone(zones[zone_id], zone_role_counts[zone_id])
+
+    # Only the grades of the idle nodes are used, and they travel as plain dictionaries
+    idle_grade_map = dict((node_id, dict(role_grades)) for (node_id, role_grades) in role_grade_map.items()
+        if node_id not in role_assignment_map)
+    return (dict(role_assignment_map), idle_grade_map, latency)
+
+def split_role_counts(role_counts, zone_sizes):
+    """
+    Splits each role's count across the zones in proportion to their sizes (largest
+    remainder). Roles whose counts do not split evenly start their leftover replicas at
+    a different zone each, so that single replica roles spread over the zones.
+    Returns one list of role counts per zone.
+    """
+    num_zones = len(zone_sizes)
+    total_size = float(sum(zone_sizes))
+    zone_role_counts = [[0] * len(role_counts) for _ in range(num_zones)]
+
+    for (role_id, count) in enumerate(role_counts):
+        shares = [count * zone_size / total_size for zone_size in zone_sizes]
+        for zone_id in range(num_zones):
+            zone_role_counts[zone_id][role_id] = int(shares[zone_id])
+
+        leftover = count - sum(int(share) for share in shares)
+        order = sorted(range(num_zones), key=lambda zone_id: (int(shares[zone_id]) - shares[zone_id],
+            (zone_id - role_id) % num_zones))
+        for zone_id in order[:leftover]:
+            zone_role_counts[zone_id][role_id] += 1
+
+    return zone_role_counts
+
+class HierarchicalAssignment:
+
+    def __init__(self, role_criterias, partitioner, zone_assigner=None, solver=None, role_counts=None,
+                 num_workers=None):
+        """
+        partitioner splits the nodes into zones (see BlockPartitioner, ModuloPartitioner and
+        ParameterPartitioner). zone_assigner runs the assignment of a single zone, and defaults
+        to a CentralizedZoneAssigner; pass a TokenZoneAssigner to run the token algorithm in
+        each zone. solver is the backend of the global reconciliation step. role_counts, if
+        given, holds the number of nodes wanted for each role criteria, as for
+        RoleAssignmentService. Zones are assigned on a pool of num_workers forked processes,
+        so that their grading and solving run in parallel, or one at a time in this process
+        without it. Worker processes send back the zones' assignments and the grades of their
+        idle nodes; the evaluation caches of their zone assigners are not updated here.
+        """
+        self.role_criterias = role_criterias
+        self.partitioner = partitioner
+        self.zone_assigner = zone_assigner if zone_assigner is not None else CentralizedZoneAssigner()
+        self.solver = solver if solver is not None else HopcroftKarpSolver()
+        self.role_counts = role_counts
+        self.num_workers = num_workers
+
+        self.role_assignment_map = {}
+        self.unassigned_roles = None
+        self.zone_node_ids = []
+        self.escalated_demand = {}
+        self.escalated_node_ids = []
+        self.latencies = {}
+
+    def get_role_counts(self):
+        if self.role_counts is not None:
+            return list(self.role_counts)
+        return [1] * len(self.role_criterias)
+
+    def compute_role_assignment(self, nodes):
+        """
+        Assigns roles over nodes, zone by zone and then globally. Returns the roles left
+        short of nodes, or None if every role was filled.
+        """
+        start_time = time.time()
+        zones = self.partitioner.partition(list(nodes))
+        self.zone_node_ids = [[node.node_id for node in zone] for zone in zones]
+        zone_role_counts = split_role_counts(self.get_role_counts(), [len(zone) for zone in zones])
+        partition_time = time.time()
+
+        zone_results = self.assign_zones(zones, zone_role_counts)
+        zone_time = time.time()
+
+        self.role_assignment_map = {}
+        self.escalated_demand = {}
+        surplus_grade_map = {}
+        for ((role_assignment_map, role_grade_map, _), role_counts) in zip(zone_results, zone_role_counts):
+            self.role_assignment_map.update(role_assignment_map)
+
+            filled_counts = [0] * len(role_counts)
+            for role_id in role_assignment_map.values():
+                filled_counts[role_id] += 1
+            for (role_id, count) in enumerate(role_counts):
+                if count > filled_counts[role_id]:
+                    self.escalated_demand[role_id] = self.escalated_demand.get(role_id, 0) + count - filled_counts[role_id]
+
+            for (node_id, role_grades) in role_grade_map.items():
+                if node_id not in role_assignment_map:
+                    surplus_grade_map[node_id] = role_grades
+
+        self.unassigned_roles = self.reconcile(surplus_grade_map)
+        end_time = time.time()
+
+        self.latencies = {
+            "partition": partition_time - start_time,
+            "zones": [zone_latency for (_, _, zone_latency) in zone_results],
+            "zone_level": zone_time - partition_time,
+            "global": end_time - zone_time,
+            "total": end_time - start_time
+        }
+        return self.unassigned_roles
+
+    def assign_zones(self, zones, zone_role_counts):
+        """
+        Returns a (role_assignment_map, role_grade_map, latency) triple per zone
+        """
+        if not self.num_workers or len(zones) < 2:
+            return [self.assign_zone(zone, role_counts) for (zone, role_counts) in zip(zones, zone_role_counts)]
+
+        # The workers inherit the zones when forked, and only send their results back
+        pool = multiprocessing.Pool(min(self.num_workers, len(zones)), _init_zone_worker,
+            (self, zones, zone_role_counts))
+        try:
+            return pool.map(_assign_zone, range(len(zones)), chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def assign_zone(self, zone, role_counts):
+        start_time = time.time()
+        (role_assignment_map, role_grade_map) = self.zone_assigner.assign(zone, self.role_criterias, role_counts)
+        return (role_assignment_map, role_grade_map, time.time() - start_time)
+
+    def reconcile(self, surplus_grade_map):
+        """
+        Fills the escalated demand from the zones' idle nodes. Only idle nodes able to take
+        an escalated role are considered.
+        """
+        if not self.escalated_demand:
+            self.escalated_node_ids = []
+            return None
+
+        escalated_grade_map = {}
+        for (node_id, role_grades) in surplus_grade_map.items():
+            grades = dict((role_id, grade) for (role_id, grade) in role_grades.items()
+                if role_id in self.escalated_demand)
+            if grades:
+                escalated_grade_map[node_id] = grades
+        self.escalated_node_ids = sorted(escalated_grade_map)
+
+        (role_assignment_map, unassigned_roles) = solve_with_role_counts(self.solver, escalated_grade_map,
+            self.escalated_demand)
+        self.role_assignment_map.update(role_assignment_map)
+        return unassigned_roles
+
+    def get_role_assignment(self, node_id):
+        return self.role_assignment_map[node_id]
+
+    def get_latencies(self):
+        """
+        Seconds spent per level of the last assignment: "partition", "zone_level" (all zones,
+        in parallel), "zones" (a list, one entry per zone), "global" and "total"
+        """
+        return self.latencies
@@ -1,49 +1,305 @@
-from logical_token import Token
+from logical_token import Token, FLEXIBILITY_ELEMENT, PRIORITY_ELEMENT, NODE_ID_ELEMENT, SATISFIABLE_ROLES_ELEMENT
+from role_criteria import evaluate_grade_matrix
+from wire_format import encode_token, decode_token, encode_assignment_index, encode_assignment_indexes, \
+    decode_evaluate_roles_message
+from tracing import traced
+from checkpoint import write_checkpoint, Checkpoint, NO_ROLE
+from network import EVALUATE_ROLES_MESSAGE, UPDATE_ASSIGNMENT_INDEX_MESSAGE, HANDLER_MESSAGE_TYPES
+import traceback
 import rpyc
 import sys
 import copy
+import heapq
+
+def dropped_assignment_index(node_id):
+    """
+    Stands in, in the replies to an "Evaluate Roles" broadcast, for a node that did not
+    answer in time: a node that can take no role
+    """
+    return (0, float("inf"), node_id, ())
+
+class LogicalNode(object):
+
+    # Fixed attribute layout instead of a per instance __dict__, since a simulation holds
+    # one LogicalNode per node of the fleet
+    __slots__ = ("node_id", "parameters", "role_criterias", "child_node_ids", "iterative_token_walk",
+        "broadcast_fanout", "evaluation_cache", "satisfiable_roles", "overall_grade", "assigned_role",
+        "network", "role_counts", "assignment_role_counts", "role_assignments", "unfilled_roles", "role_candidates",
+        "dropped_nodes")
+
+    def __init__(self, node_id, parameters, role_criterias, child_node_ids = [], iterative_token_walk = False,
+                 broadcast_fanout = None, evaluation_cache = None, role_counts = None):
+        """
+        When iterative_token_walk is set, the node that begins the logical assignment drives
+        the token walk itself: every hop returns the token to it instead of forwarding it
+        along a nested chain of calls, so stack depth and blocked threads stay constant.
+
+        When broadcast_fanout is set and no child_node_ids are given, the "Evaluate Roles"
+        broadcast runs over a balanced tree with at most broadcast_fanout children per node,
+        so the root neither messages nor sorts every node itself.
+
+        evaluation_cache, an evaluation_cache.EvaluationCache, reuses the grades of earlier
+        evaluations while the node's parameters are unchanged.
 
-FLEXIBILITY_ELEMENT = 0
-PRIORITY_ELEMENT = 1
-NODE_ID_ELEMENT = 2
+        role_counts, if given, holds the number of nodes wanted for each role criteria, so that
+        replicas of a role share a single criteria. Only the node that begins the logical
+        assignment uses it; every role is wanted once by default.
+        """
+        if broadcast_fanout is not None and broadcast_fanout < 1:
+            raise ValueError("broadcast_fanout must be at least 1")
 
-class LogicalNode:
-    def __init__(self, node_id, parameters, role_criterias, child_node_ids = []):
         self.node_id = node_id
         self.parameters = parameters
         self.role_criterias = role_criterias
         self.child_node_ids = child_node_ids
-        self.satisfiable_roles = set()
+        self.iterative_token_walk = iterative_token_walk
+        self.broadcast_fanout = broadcast_fanout
+        self.evaluation_cache = evaluation_cache
+        self.satisfiable_roles = {}
+        self.overall_grade = 0
         self.assigned_role = None
         self.network = None
+        self.role_counts = role_counts
+
+        # Kept by the node that begins the logical assignment, for incremental repairs.
+        # assignment_role_counts holds the role counts of the assignment, and
+        # role_assignments maps each role id to the ids of the nodes that took it.
+        self.assignment_role_counts = None
+        self.role_assignments = {}
+        self.unfilled_roles = set()
+        self.role_candidates = {}
+        # Nodes dropped from the assignment for failing to answer in time (see
+        # Network.set_phase_timeouts), mapped to the message type they did not answer
+        self.dropped_nodes = {}
 
     def set_network(self, network):
         self.network = network
 
-    def begin_logical_assignment(self):
+    @traced
+    def begin_logical_assignment(self, role_counts = None):
         """
         Kicks off the logical assignment operation by broadcasting an "Evaluate Roles" message,
         creating a token, and then sending that token off to the first least flexible node.
+        role_counts, if given, is used for this assignment and its repairs instead of the
+        node's own.
         """
         if self.child_node_ids:
-            child_node_ids = self.child_node_ids
+            assignment_indexes = self.evaluate_roles_broadcast(self.child_node_ids)
         else:
-            child_node_ids = range(self.network.get_num_nodes())
-            child_node_ids.remove(self.node_id)
+            node_ids = self.network.get_node_ids()
+            node_ids.remove(self.node_id)
+
+            if self.broadcast_fanout:
+                assignment_indexes = self.evaluate_roles_tree_broadcast(node_ids)
+            else:
+                assignment_indexes = self.evaluate_roles_broadcast(node_ids)
 
-        assignment_indexes = self.evaluate_roles_broadcast(child_node_ids)
+        self.assignment_role_counts = role_counts
+        self.role_assignments = {}
+        self.dropped_nodes = {}
+        assignment_indexes = self.remove_dropped_nodes(assignment_indexes)
+        self.role_candidates = self.create_role_candidates(assignment_indexes)
 
+        role_counts = dict((role_id, self.get_role_count(role_id)) for role_id in range(len(self.role_criterias)))
+        return self.assign_roles(role_counts, assignment_indexes)
+
+    def save_checkpoint(self, path):
+        """
+        Writes the state kept by the node that began the logical assignment (the roles
+        assigned to every node, the role candidates and the unfilled roles) to path, so that
+        a restarted coordinator repairs the assignment without broadcasting again. Only the
+        roles of the candidates are known here, so their grades are stored as NaN.
+        """
+        role_grade_map = {}
+        for (role_id, node_ids) in self.role_candidates.items():
+            for node_id in node_ids:
+                role_grade_map.setdefault(node_id, {})[role_id] = float("nan")
+
+        role_assignment_map = {}
+        for (role_id, node_ids) in self.role_assignments.items():
+            for node_id in node_ids:
+                role_assignment_map[node_id] = role_id
+
+        write_checkpoint(path, len(self.role_criterias), role_grade_map, role_assignment_map,
+            unassigned_roles=self.unfilled_roles)
+
+    def restore_checkpoint(self, path):
+        checkpoint = Checkpoint(path)
+        try:
+            if checkpoint.num_roles != len(self.role_criterias):
+                raise ValueError("checkpoint has %d roles, the node has %d" % (checkpoint.num_roles, len(self.role_criterias)))
+
+            node_ids = checkpoint.node_ids.tolist()
+            self.role_assignments = {}
+            for (node_id, role_id) in zip(node_ids, checkpoint.assigned_roles.tolist()):
+                if role_id != NO_ROLE:
+                    self.role_assignments.setdefault(role_id, []).append(node_id)
+
+            self.role_candidates = {}
+            row_lengths = checkpoint.row_offsets[1:] - checkpoint.row_offsets[:-1]
+            for (node_id, role_id) in zip(checkpoint.node_ids.repeat(row_lengths).tolist(), checkpoint.grade_role_ids.tolist()):
+                self.role_candidates.setdefault(role_id, []).append(node_id)
+
+            self.unfilled_roles = checkpoint.get_unassigned_roles()
+            self.assigned_role = checkpoint.get_assigned_role(self.node_id)
+        finally:
+            checkpoint.close()
+
+    def get_role_count(self, role_id):
+        role_counts = self.assignment_role_counts if self.assignment_role_counts is not None else self.role_counts
+        return role_counts[role_id] if role_counts is not None else 1
+
+    def assign_roles(self, role_counts, assignment_indexes):
+        """
+        Creates a token for role_counts (role id -> number of nodes wanted) over the given
+        assignment indexes, sends it down the assignment path, and records the roles it assigned
+        """
         assignment_path = self.create_assigment_path(assignment_indexes)
-        role_ids = range(len(self.role_criterias))
+        role_candidates = self.create_role_candidates(assignment_indexes)
+
+        token = Token(list(role_counts), assignment_path, role_candidates, role_counts=role_counts)
+
+        if self.iterative_token_walk:
+            token = self.walk_token(token)
+        else:
+            next_node_id = token.next_node()
+            if next_node_id is not None:
+                token = self.network.send_token(self.node_id, next_node_id, token)
+
+        for (role_id, node_ids) in token.role_assignments.items():
+            self.role_assignments.setdefault(role_id, []).extend(node_ids)
+        self.unfilled_roles = set(token.unassigned_roles)
+        self.dropped_nodes.update((node_id, UPDATE_ASSIGNMENT_INDEX_MESSAGE) for node_id in token.dropped_node_ids)
+        return token
+
+    def remove_dropped_nodes(self, assignment_indexes):
+        """
+        Takes the stand-ins of the nodes dropped from a broadcast (see
+        dropped_assignment_index) out of assignment_indexes, into dropped_nodes
+        """
+        live_assignment_indexes = []
+        for assignment_index in assignment_indexes:
+            if assignment_index[FLEXIBILITY_ELEMENT] > 0:
+                live_assignment_indexes.append(assignment_index)
+            else:
+                self.dropped_nodes[assignment_index[NODE_ID_ELEMENT]] = EVALUATE_ROLES_MESSAGE
+        return live_assignment_indexes
+
+    def get_dropped_nodes(self):
+        """
+        node id -> message type of the nodes the last assignment (and the repairs since)
+        dropped for failing to answer in time, or at all
+        """
+        return self.dropped_nodes
+
+    @traced
+    def node_joined(self, node_id):
+        """
+        Called on the node that began the logical assignment once a new node has been added
+        to its network. The new node is evaluated against every role, then takes part in
+        repairing the assignment if any role is unfilled.
+        """
+        result = self.network.send_evaluate_roles_message(self.node_id, node_id)
+        gather = self.network.gather(EVALUATE_ROLES_MESSAGE, [(node_id, result)])
+        for (_, result) in gather:
+            for assignment_index in result.value:
+                for role_id in assignment_index[SATISFIABLE_ROLES_ELEMENT]:
+                    self.role_candidates.setdefault(role_id, []).append(node_id)
+        self.dropped_nodes.update((node_id, EVALUATE_ROLES_MESSAGE) for node_id in gather.dropped)
+
+        return self.repair_assignment()
+
+    @traced
+    def node_left(self, node_id):
+        """
+        Called on the node that began the logical assignment once a node that left or failed
+        has been removed from its network. The role the node held, if any, is reassigned.
+        """
+        for (role_id, assigned_node_ids) in self.role_assignments.items():
+            if node_id in assigned_node_ids:
+                assigned_node_ids.remove(node_id)
+                self.unfilled_roles.add(role_id)
+
+        for (role_id, node_ids) in self.role_candidates.items():
+            if node_id in node_ids:
+                self.role_candidates[role_id] = [candidate_node_id for candidate_node_id in node_ids
+                    if candidate_node_id != node_id]
 
-        token = Token(role_ids, assignment_path)
+        return self.repair_assignment()
 
+    @traced
+    def repair_assignment(self):
+        """
+        Runs the token assignment again for the unfilled roles only. Only the idle nodes that
+        satisfy one of those roles are evaluated again, against those roles; every other node
+        keeps its role. Returns the repair token, whose unassigned roles are still unfilled.
+        """
+        role_counts = dict((role_id, self.get_role_count(role_id) - len(self.role_assignments.get(role_id, ())))
+            for role_id in self.unfilled_roles)
+        role_ids = sorted(role_id for (role_id, count) in role_counts.items() if count > 0)
+
+        busy_node_ids = set()
+        for node_ids in self.role_assignments.values():
+            busy_node_ids.update(node_ids)
+        node_ids = set()
+        for role_id in role_ids:
+            node_ids.update(self.role_candidates.get(role_id, ()))
+        node_ids = sorted(node_ids.intersection(self.network.get_node_ids()).difference(busy_node_ids))
+
+        async_results = []
+        for node_id in node_ids:
+            if node_id != self.node_id:
+                result = self.network.send_evaluate_roles_message(self.node_id, node_id, role_ids=role_ids)
+                async_results.append((node_id, result))
+        self.network.flush_messages()
+
+        assignment_indexes = []
+        if self.node_id in node_ids:
+            assignment_index = self.evaluate_roles(role_ids)
+            if assignment_index[FLEXIBILITY_ELEMENT] > 0:
+                assignment_indexes.append(assignment_index)
+
+        gather = self.network.gather(EVALUATE_ROLES_MESSAGE, async_results)
+        for (_, result) in gather:
+            assignment_indexes.extend(result.value)
+        self.dropped_nodes.update((node_id, EVALUATE_ROLES_MESSAGE) for node_id in gather.dropped)
+
+        return self.assign_roles(dict((role_id, role_counts[role_id]) for role_id in role_ids), assignment_indexes)
+
+    @traced
+    def walk_token(self, token):
+        """
+        Drives the token walk from this node: each hop hands the token to the next least
+        flexible node, which chooses a role and hands the token straight back
+        """
         next_node_id = token.next_node()
-        return self.network.send_token(self.node_id, next_node_id, token)
+
+        while next_node_id is not None and token:
+            token = copy.copy(self.network.send_token_hop(self.node_id, next_node_id, token))
+            next_node_id = token.next_node()
+
+        return token
 
     def create_assigment_path(self, assignment_indexes):
-        return map(lambda assignment_index: assignment_index[NODE_ID_ELEMENT], sorted(assignment_indexes))
+        """
+        Builds the token's assignment path as a heap keyed on (flexibility, priority, node_id)
+        """
+        assignment_path = [assignment_index[:SATISFIABLE_ROLES_ELEMENT] for assignment_index in assignment_indexes]
+        heapq.heapify(assignment_path)
+        return assignment_path
 
+    def create_role_candidates(self, assignment_indexes):
+        """
+        Inverts the satisfiable roles reported with each assignment index into a
+        role id -> candidate node ids index
+        """
+        role_candidates = {}
+        for assignment_index in assignment_indexes:
+            for role_id in assignment_index[SATISFIABLE_ROLES_ELEMENT]:
+                role_candidates.setdefault(role_id, []).append(assignment_index[NODE_ID_ELEMENT])
+        return role_candidates
+
+    @traced
     def evaluate_roles_broadcast(self, child_node_ids):
         """
         Used by the root node in the broadcast spanning tree to sort
@@ -54,43 +310,131 @@ class LogicalNode:
         async_results = []
         for child_node_id in child_node_ids:
             result = self.network.send_evaluate_roles_message(self.node_id, child_node_id)
-            async_results.append(result)
+            async_results.append((child_node_id, result))
+        self.network.flush_messages()
 
         assignment_index = self.evaluate_roles()
         if assignment_index[FLEXIBILITY_ELEMENT] > 0:
             assignment_indexes.append(assignment_index)
 
-        for result in async_results:
-            result.wait()
+        # Replies are merged as they arrive; the children that miss the deadline are reported
+        gather = self.network.gather(EVALUATE_ROLES_MESSAGE, async_results)
+        for (_, result) in gather:
             assignment_indexes.extend(result.value)
+        assignment_indexes.extend(dropped_assignment_index(node_id) for node_id in sorted(gather.dropped))
 
         return assignment_indexes
 
-    def receive_evaluate_roles_message(self):
+    def split_broadcast_subtrees(self, node_ids):
+        """
+        Splits node_ids into at most broadcast_fanout contiguous subtrees whose sizes differ
+        by at most one. Returns a (child node id, subtree node ids) pair for each subtree,
+        where the first node of a subtree becomes the child that relays to the rest.
+        """
+        num_children = min(self.broadcast_fanout, len(node_ids))
+        subtrees = []
+
+        start = 0
+        for child_index in range(num_children):
+            end = start + (len(node_ids) - start) // (num_children - child_index)
+            subtrees.append((node_ids[start], node_ids[start + 1:end]))
+            start = end
+
+        return subtrees
+
+    @traced
+    def evaluate_roles_tree_broadcast(self, subtree_node_ids):
+        """
+        Relays the "Evaluate Roles" message down a balanced broadcast tree over
+        subtree_node_ids. Every subtree replies with its assignment indexes already sorted,
+        so each level only merges broadcast_fanout sorted runs.
+        """
+        async_results = []
+        subtrees = self.split_broadcast_subtrees(sorted(subtree_node_ids))
+        for (child_node_id, child_subtree_node_ids) in subtrees:
+            result = self.network.send_evaluate_roles_message(self.node_id, child_node_id, child_subtree_node_ids)
+            async_results.append((child_node_id, result))
+        self.network.flush_messages()
+
+        sorted_runs = []
+
+        assignment_index = self.evaluate_roles()
+        if assignment_index[FLEXIBILITY_ELEMENT] > 0:
+            sorted_runs.append([assignment_index])
+
+        # Every relay below waits for its own subtree, so the deadline grows with the depth
+        gather = self.network.gather(EVALUATE_ROLES_MESSAGE, async_results, self.broadcast_depth(len(subtree_node_ids)))
+        for (_, result) in gather:
+            sorted_runs.append(result.value)
+
+        # A dropped child takes its whole subtree with it
+        dropped_node_ids = []
+        for (child_node_id, child_subtree_node_ids) in subtrees:
+            if child_node_id in gather.dropped:
+                dropped_node_ids.append(child_node_id)
+                dropped_node_ids.extend(child_subtree_node_ids)
+        sorted_runs.append([dropped_assignment_index(node_id) for node_id in sorted(dropped_node_ids)])
+
+        return list(heapq.merge(*sorted_runs))
+
+    def broadcast_depth(self, num_nodes):
+        """
+        Number of levels of the broadcast tree over num_nodes nodes below a relay
+        """
+        depth = 0
+        while num_nodes > 0:
+            depth += 1
+            # The largest subtree, less the child relaying to it
+            num_nodes = -(-num_nodes // self.broadcast_fanout) - 1
+        return depth
+
+    def receive_evaluate_roles_message(self, subtree_node_ids = None, role_ids = None):
         """
         Processes an "Evaluate Roles" message by first forwarding the message to child nodes.
         In the meantime, the current node evaluates itself against the role criterias.
         Finally, the aggregated results are returned to the parent node.
+
+        Messages sent down a broadcast tree carry the node ids of the receiver's subtree,
+        which take the place of child_node_ids. Messages restricted to role_ids, sent when
+        repairing an assignment, only evaluate the receiver.
         """
+        if subtree_node_ids is not None:
+            return self.evaluate_roles_tree_broadcast(subtree_node_ids)
+
+        if role_ids is not None:
+            assignment_index = self.evaluate_roles(role_ids)
+            return [assignment_index] if assignment_index[FLEXIBILITY_ELEMENT] > 0 else []
+
         return self.evaluate_roles_broadcast(self.child_node_ids)
 
-    def evaluate_roles(self):
+    def receive_encoded_evaluate_roles_message(self, data = None):
+        (subtree_node_ids, role_ids) = decode_evaluate_roles_message(data) if data is not None else (None, None)
+        return encode_assignment_indexes(self.receive_evaluate_roles_message(subtree_node_ids, role_ids))
+
+    @traced
+    def evaluate_roles(self, role_ids = None):
         """
-        Simply loops through each role criteria and evaluates it using the current
-        nodes parameters
+        Evaluates every role criteria against the current node's parameters, using the
+        criterias' batch interface where available. role_ids, if given, restricts the
+        satisfiable roles to those roles.
         """
 
         self.overall_grade = 0
-        self.satisfiable_roles = set()
+        self.satisfiable_roles = {}
         self.assigned_role = None
 
-        for (role_id, role_criteria) in enumerate(self.role_criterias):
-            grade = role_criteria.evaluate_against(self.parameters)
-            if grade > 0:
+        grades = evaluate_grade_matrix(self.role_criterias, [self.parameters], self.evaluation_cache)[0]
+
+        if role_ids is not None:
+            role_ids = set(role_ids)
+
+        for role_id in grades.nonzero()[0]:
+            grade = float(grades[role_id])
+            if grade > 0 and (role_ids is None or role_id in role_ids):
                 self.overall_grade += grade
-                self.satisfiable_roles.add((role_id, grade))
+                self.satisfiable_roles[int(role_id)] = grade
 
-        return self.compute_assignment_index(self.overall_grade)
+        return self.compute_assignment_index(self.overall_grade) + (tuple(self.satisfiable_roles),)
 
     def compute_assignment_index(self, overall_grade):
         assignment_flexibility = len(self.satisfiable_roles)
@@ -106,45 +450,80 @@ class LogicalNode:
         self.choose_role_if_available(token)
         return self.forward_token(token)
 
+    def receive_token_hop(self, src_node_id, token):
+        """
+        Processes a single hop of an iterative token walk: chooses a role if one is available
+        and returns the token to the sender instead of forwarding it
+        """
+        token = copy.copy(token)
+        self.choose_role_if_available(token)
+        return token
+
+    def receive_encoded_token(self, src_node_id, data):
+        return encode_token(self.receive_token(src_node_id, decode_token(data)))
+
+    def receive_encoded_token_hop(self, src_node_id, data):
+        return encode_token(self.receive_token_hop(src_node_id, decode_token(data)))
+
+    @traced
     def choose_role_if_available(self, token):
         """
-        Determines assignable roles and chooses one if available
+        Determines assignable roles and chooses the one with the highest grade, if available
         """
-        assignable_roles = \
-            token.determine_assignable_roles(set(map(lambda satisfiable_role: satisfiable_role[0], self.satisfiable_roles)))
+        assignable_roles = token.determine_assignable_roles(self.satisfiable_roles)
 
         if assignable_roles:
-            self.assigned_role = assignable_roles.pop()
-            token.record_assigned_role(self.assigned_role)
+            self.assigned_role = max(assignable_roles, key=lambda role_id: (self.satisfiable_roles[role_id], -role_id))
+
+            # Only the last replica of a role changes the assignment index of the other nodes,
+            # and only of those that satisfy the role
+            if token.role_counts[self.assigned_role] == 1:
+                candidate_node_ids = token.candidate_nodes(self.assigned_role)
+            else:
+                candidate_node_ids = []
+            token.record_assigned_role(self.assigned_role, self.node_id)
 
             async_results = []
-            for node_id in token.assignment_path:
+            for node_id in candidate_node_ids:
                 result = \
                     self.network.send_update_assignment_index_message(self.node_id, node_id, self.assigned_role)
-                async_results.append(result)
+                async_results.append((node_id, result))
+            self.network.flush_messages()
 
-            updated_assignment_indexes = []
-            for result in async_results:
-                result.wait()
-                updated_assignment_index = result.value
-                if updated_assignment_index[FLEXIBILITY_ELEMENT] > 0:
-                    updated_assignment_indexes.append(updated_assignment_index)
-
-            token.assignment_path = self.create_assigment_path(updated_assignment_indexes)
+            # Candidates that do not answer in time would hold the token up on their turn too
+            gather = self.network.gather(UPDATE_ASSIGNMENT_INDEX_MESSAGE, async_results)
+            for (_, result) in gather:
+                token.update_assignment_index(result.value)
+            for node_id in sorted(gather.dropped):
+                token.drop_node(node_id)
 
     def receive_update_assignment_index_message(self, assigned_role):
-        found_role = None
+        grade = self.satisfiable_roles.pop(assigned_role, None)
+        if grade is not None:
+            self.overall_grade -= grade
 
-        for satisfiable_role in self.satisfiable_roles:
-            if satisfiable_role[0] == assigned_role:
-                found_role = satisfiable_role
-                break
+        return self.compute_assignment_index(self.overall_grade)
 
-        if found_role:
-            self.satisfiable_roles.remove(found_role)
-            self.overall_grade -= found_role[1]
+    def receive_encoded_update_assignment_index_message(self, assigned_role):
+        return encode_assignment_index(self.receive_update_assignment_index_message(assigned_role))
 
-        return self.compute_assignment_index(self.overall_grade)
+    def receive_message_batch(self, messages):
+        """
+        Processes a batch of (handler name, arguments, trace context) messages (see
+        Network.set_batching) one after the other. Returns a (succeeded, reply or traceback)
+        pair per message, so that one failing message does not fail the others.
+        """
+        replies = []
+        for (handler_name, args, trace_context) in messages:
+            try:
+                if handler_name not in HANDLER_MESSAGE_TYPES:
+                    raise AttributeError("%s is not a message handler" % handler_name)
+                reply = self.network.run_traced_handler(self.node_id, HANDLER_MESSAGE_TYPES[handler_name],
+                    tuple(trace_context) if trace_context is not None else None, getattr(self, handler_name), *args)
+                replies.append((True, reply))
+            except Exception:
+                replies.append((False, traceback.format_exc()))
+        return tuple(replies)
 
     def forward_token(self, token):
         """
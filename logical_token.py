@@ -1,34 +1,120 @@
-class Token:
+import heapq
 
-    def __init__(self, role_ids, assignment_path):
-        self.unassigned_roles = role_ids
+# Layout of an assignment index, see LogicalNode.compute_assignment_index
+FLEXIBILITY_ELEMENT = 0
+PRIORITY_ELEMENT = 1
+NODE_ID_ELEMENT = 2
+SATISFIABLE_ROLES_ELEMENT = 3
+
+class Token(object):
+
+    __slots__ = ("unassigned_roles", "role_counts", "assignment_path", "assignment_indexes", "role_candidates",
+        "role_assignments", "dropped_node_ids")
+
+    def __init__(self, role_ids, assignment_path, role_candidates = None, role_assignments = None, role_counts = None,
+                 dropped_node_ids = None):
+        """
+        assignment_path is a heap of (flexibility, priority, node_id) assignment indexes.
+        role_candidates is an inverted index mapping each role id to the ids of the nodes
+        that satisfy it, so that claiming a role only concerns those nodes.
+        role_assignments maps each role assigned during this walk to the nodes that took it.
+        role_counts maps role ids to the number of nodes still wanted for them; roles
+        missing from it are wanted once. dropped_node_ids lists the nodes dropped from the
+        path during this walk because they did not answer in time.
+        """
+        self.role_counts = dict((role_id, 1) for role_id in role_ids)
+        if role_counts is not None:
+            self.role_counts.update((role_id, count) for (role_id, count) in role_counts.items() if role_id in self.role_counts)
+        self.role_counts = dict((role_id, count) for (role_id, count) in self.role_counts.items() if count > 0)
+        self.unassigned_roles = set(self.role_counts)
         self.assignment_path = assignment_path
+        self.assignment_indexes = dict((assignment_index[NODE_ID_ELEMENT], assignment_index)
+            for assignment_index in assignment_path)
+        self.role_candidates = role_candidates if role_candidates is not None else {}
+        self.role_assignments = role_assignments if role_assignments is not None else {}
+        self.dropped_node_ids = dropped_node_ids if dropped_node_ids is not None else []
 
     @staticmethod
     def from_dict(attr_dict):
-        return Token(attr_dict["unassigned_roles"], attr_dict["assignment_path"])
+        if "assignment_indexes" in attr_dict:
+            assignment_path = list(attr_dict["assignment_indexes"].values())
+            heapq.heapify(assignment_path)
+        else:
+            assignment_path = attr_dict["assignment_path"]
+
+        return Token(attr_dict["unassigned_roles"], assignment_path, attr_dict.get("role_candidates"),
+            attr_dict.get("role_assignments"), attr_dict.get("role_counts"), attr_dict.get("dropped_node_ids"))
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for (name, value) in state.items():
+            setattr(self, name, value)
 
     def determine_assignable_roles(self, satisfiable_roles):
         """
-        Based on a node's satisfiable roles and the currently unassigned
-        roles, determine all assignable roles for that node
+        Based on a node's satisfiable roles (any container of role ids) and the currently
+        unassigned roles, determine all assignable roles for that node. Only the smaller of
+        the two is iterated over.
         """
-        return satisfiable_roles.intersection(set(self.unassigned_roles))
+        if len(satisfiable_roles) <= len(self.unassigned_roles):
+            return set(role_id for role_id in satisfiable_roles if role_id in self.unassigned_roles)
+        return set(role_id for role_id in self.unassigned_roles if role_id in satisfiable_roles)
 
-    def record_assigned_role(self, role_id):
+    def record_assigned_role(self, role_id, node_id):
         """
-        Called by a logical node once the node has chosen a role
+        Called by a logical node once the node has chosen a role. The role stays unassigned
+        until all of its replicas are taken.
         """
-        self.unassigned_roles.remove(role_id)
+        self.role_assignments.setdefault(role_id, []).append(node_id)
+
+        self.role_counts[role_id] -= 1
+        if self.role_counts[role_id] == 0:
+            del self.role_counts[role_id]
+            self.unassigned_roles.remove(role_id)
+            self.role_candidates.pop(role_id, None)
+
+    def candidate_nodes(self, role_id):
+        """
+        Returns the nodes left in the assignment path that satisfy the given role
+        """
+        return [node_id for node_id in self.role_candidates.get(role_id, ()) if node_id in self.assignment_indexes]
+
+    def update_assignment_index(self, assignment_index):
+        """
+        Updates a node's position in the assignment path in place. Nodes that no longer
+        satisfy any role are dropped from the path. Superseded entries stay in the heap
+        and are skipped by next_node.
+        """
+        node_id = assignment_index[NODE_ID_ELEMENT]
+
+        if assignment_index[FLEXIBILITY_ELEMENT] > 0:
+            self.assignment_indexes[node_id] = assignment_index
+            heapq.heappush(self.assignment_path, assignment_index)
+        else:
+            self.assignment_indexes.pop(node_id, None)
+
+    def drop_node(self, node_id):
+        """
+        Takes a node that failed to answer out of the assignment path
+        """
+        self.assignment_indexes.pop(node_id, None)
+        self.dropped_node_ids.append(node_id)
 
     def next_node(self):
         """
         Attempts to retrieve the next node with the smallest assignment index, if it exists.
         """
-        try:
-            return self.assignment_path.pop(0)
-        except IndexError:
-            return None
+        while self.assignment_path:
+            assignment_index = heapq.heappop(self.assignment_path)
+            node_id = assignment_index[NODE_ID_ELEMENT]
+
+            if self.assignment_indexes.get(node_id) == assignment_index:
+                del self.assignment_indexes[node_id]
+                return node_id
+
+        return None
 
     def __nonzero__(self):
         """
@@ -43,4 +129,4 @@ class Token:
         return len(self.unassigned_roles) > 0
 
     def __getitem__(self, item):
-        return self.__dict__[item]
+        return getattr(self, item)
@@ -1,72 +1,198 @@
+from role_criteria import evaluate_grade_matrix
+from assignment_solvers import HopcroftKarpSolver, solve_with_role_counts
+from evaluation_cache import parameters_fingerprint
+from checkpoint import write_checkpoint, Checkpoint, assignment_map, fingerprint_map
+from grade_table import GradeTable
+from node_ingestion import chunked, column_rows, node_id_value
 import sys
 
+# Nodes graded per grade matrix by the bulk APIs, which bounds their working memory
+DEFAULT_CHUNK_SIZE = 4096
+
 class RoleAssignmentService():
 
-    def __init__(self, role_criterias):
+    def __init__(self, role_criterias, solver=None, evaluation_cache=None, role_counts=None):
+        """
+        solver is the backend used by compute_role_assignment (see assignment_solvers.py).
+        Defaults to Hopcroft-Karp, which finds a feasible assignment in polynomial time.
+        evaluation_cache, an evaluation_cache.EvaluationCache, skips re-grading nodes whose
+        parameters have not changed. role_counts, if given, holds the number of nodes wanted
+        for each role criteria; every role is wanted once by default.
+        """
         self.role_criterias = role_criterias
+        self.solver = solver if solver is not None else HopcroftKarpSolver()
+        self.evaluation_cache = evaluation_cache
+        self.role_counts = role_counts
         self.bytes_received = 0
         self.bytes_sent = 0
+        self.messages_received = 0
+        self.messages_sent = 0
 
-        self.role_satisfaction_map = {}
+        # Grades are stored as a sparse matrix; both maps are views of it
+        self.role_grade_map = GradeTable(len(role_criterias))
+        self.role_satisfaction_map = self.role_grade_map.satisfaction_map()
         self.role_assignment_map = {}
         self.unassigned_roles = None
 
+        # Parameters each node was last graded with, and their fingerprints as of the
+        # checkpoint this service was restored from
+        self.node_parameters = {}
+        self.parameter_fingerprints = {}
+        self.checkpoint = None
+
     def get_bytes_sent(self):
         return self.bytes_sent
 
     def get_bytes_received(self):
         return self.bytes_received
 
-    def evaluate_node(self, node):
-        self.bytes_received += sys.getsizeof(node.parameters)
-        self.bytes_received += sys.getsizeof(node.node_id)
-
-        self.role_satisfaction_map[node.node_id] = \
-            set([role_id for (role_id, role_criteria) in \
-                enumerate(self.role_criterias) if role_criteria.evaluate_against(node.parameters) > 0])
-
-    def _compute_role_assignment(self, node_id, unassigned_roles):
-        if not unassigned_roles:
-            self.unassigned_roles = None
-            return True
-
-        if node_id >= len(self.role_satisfaction_map):
-            self.unassigned_roles = set(unassigned_roles)
-            return False
-
-        assignable_roles = self.role_satisfaction_map[node_id].intersection(unassigned_roles)
-        if assignable_roles:
-            for role_id in assignable_roles:
-                unassigned_roles.remove(role_id)
+    def get_messages_sent(self):
+        return self.messages_sent
 
-                if self._compute_role_assignment(node_id + 1, unassigned_roles):
-                    self.role_assignment_map[node_id] = role_id
-                    return True
+    def get_messages_received(self):
+        return self.messages_received
 
-                unassigned_roles.add(role_id)
-
-            return False
-
-        elif self._compute_role_assignment(node_id + 1, unassigned_roles):
-            return True
-
-        else:
-            return False
+    def evaluate_node(self, node):
+        self.evaluate_nodes([node])
+
+    def evaluate_nodes(self, nodes, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Vectorized counterpart of evaluate_node: grades the nodes against every role
+        criteria, building one nodes x roles grade matrix per chunk_size nodes
+        """
+        for chunk in chunked(nodes, chunk_size):
+            for node in chunk:
+                self.bytes_received += sys.getsizeof(node.parameters)
+                self.bytes_received += sys.getsizeof(node.node_id)
+                # A copy, so that parameters changed in place later are told apart
+                self.node_parameters[node.node_id] = dict(node.parameters)
+                self.parameter_fingerprints.pop(node.node_id, None)
+            self.messages_received += len(chunk)
+
+            self.grade_chunk([node.node_id for node in chunk], [node.parameters for node in chunk])
+
+    def ingest(self, rows, chunk_size=DEFAULT_CHUNK_SIZE, fingerprint=False):
+        """
+        Bulk, streaming counterpart of evaluate_nodes for nodes known by their parameters
+        only. rows is an iterable of (node_id, parameters) pairs, e.g. from
+        node_ingestion.read_csv_nodes or read_json_lines_nodes; it is consumed chunk_size
+        rows at a time, so memory stays bounded by the chunk and the compact grade storage.
+        Parameters are not kept: with fingerprint set their fingerprints are, so that
+        checkpoints and evaluate_changed_nodes can tell changed nodes apart. Node ids are
+        converted to integers (see node_ingestion.node_id_value), a ValueError being raised
+        before the chunk of an id that is not one is graded.
+        Returns the number of nodes graded.
+        """
+        num_nodes = 0
+        for chunk in chunked(rows, chunk_size):
+            chunk = [(node_id_value(node_id), parameters) for (node_id, parameters) in chunk]
+            node_ids = [node_id for (node_id, _) in chunk]
+            parameter_table = [parameters for (_, parameters) in chunk]
+
+            for (node_id, parameters) in chunk:
+                self.bytes_received += sys.getsizeof(parameters)
+                self.bytes_received += sys.getsizeof(node_id)
+                self.node_parameters.pop(node_id, None)
+                if fingerprint:
+                    self.parameter_fingerprints[node_id] = parameters_fingerprint(parameters)
+                else:
+                    self.parameter_fingerprints.pop(node_id, None)
+            self.messages_received += len(chunk)
+            num_nodes += len(chunk)
+
+            self.grade_chunk(node_ids, parameter_table)
+        return num_nodes
+
+    def ingest_columns(self, columns, node_id_column="node_id", chunk_size=DEFAULT_CHUNK_SIZE, fingerprint=False):
+        """
+        ingest for a columnar batch: a dictionary of equally long sequences (lists or numpy
+        arrays), one per parameter, the node ids in node_id_column
+        """
+        return self.ingest(column_rows(columns, node_id_column, chunk_size), chunk_size, fingerprint)
+
+    def grade_chunk(self, node_ids, parameter_table):
+        grade_matrix = evaluate_grade_matrix(self.role_criterias, parameter_table, self.evaluation_cache)
+        self.role_grade_map.add_grades(node_ids, grade_matrix)
 
     def compute_role_assignment(self):
-        unassigned_roles = set(range(len(self.role_criterias)))
-        self._compute_role_assignment(0, unassigned_roles)
+        role_ids = set(range(len(self.role_criterias)))
+        if self.role_counts is None:
+            (self.role_assignment_map, self.unassigned_roles) = self.solver.solve(self.role_grade_map, role_ids)
+        else:
+            role_counts = dict((role_id, self.role_counts[role_id]) for role_id in role_ids)
+            (self.role_assignment_map, self.unassigned_roles) = \
+                solve_with_role_counts(self.solver, self.role_grade_map, role_counts)
 
-        self.bytes_sent += sys.getsizeof(unassigned_roles)
+        self.bytes_sent += sys.getsizeof(self.unassigned_roles or set())
+        self.messages_sent += 1
 
         return self.unassigned_roles
 
+    def evaluate_changed_nodes(self, nodes):
+        """
+        Grades only the nodes that are new or whose parameters differ from the ones they were
+        graded with, e.g. after restore_checkpoint. Returns the ids of the graded nodes.
+        """
+        nodes = list(nodes)
+        changed_nodes = []
+        for node in nodes:
+            if node.node_id in self.node_parameters:
+                if self.node_parameters[node.node_id] != node.parameters:
+                    changed_nodes.append(node)
+            elif self.parameter_fingerprints.get(node.node_id) != parameters_fingerprint(node.parameters):
+                changed_nodes.append(node)
+            else:
+                self.node_parameters[node.node_id] = dict(node.parameters)
+
+        # Unchanged nodes only report that they are unchanged
+        self.messages_received += len(nodes) - len(changed_nodes)
+        self.bytes_received += sys.getsizeof(0) * (len(nodes) - len(changed_nodes))
+
+        self.evaluate_nodes(changed_nodes)
+        return [node.node_id for node in changed_nodes]
+
+    def save_checkpoint(self, path):
+        """
+        Writes the grades, the assignment and the fingerprint of the parameters every node
+        was graded with to path (see checkpoint.py)
+        """
+        fingerprints = dict((node_id, fingerprint) for (node_id, fingerprint) in self.parameter_fingerprints.items()
+            if node_id not in self.node_parameters)
+        for (node_id, parameters) in self.node_parameters.items():
+            fingerprints[node_id] = parameters_fingerprint(parameters)
+
+        write_checkpoint(path, len(self.role_criterias), self.role_grade_map, self.role_assignment_map,
+            fingerprints, self.unassigned_roles)
+
+    def restore_checkpoint(self, path):
+        """
+        Memory-maps a checkpoint written by save_checkpoint. get_role_assignment answers
+        straight from the file; grades are read on demand, and updates are kept in memory.
+        """
+        checkpoint = Checkpoint(path)
+        if checkpoint.num_roles != len(self.role_criterias):
+            checkpoint.close()
+            raise ValueError("checkpoint has %d roles, the service has %d" % (checkpoint.num_roles, len(self.role_criterias)))
+
+        if self.checkpoint is not None:
+            self.checkpoint.close()
+        self.checkpoint = checkpoint
+
+        self.role_assignment_map = assignment_map(checkpoint)
+        self.role_grade_map = GradeTable(len(self.role_criterias), checkpoint)
+        self.role_satisfaction_map = self.role_grade_map.satisfaction_map()
+        self.parameter_fingerprints = fingerprint_map(checkpoint)
+        self.node_parameters = {}
+        self.unassigned_roles = checkpoint.get_unassigned_roles() or None
+
     def get_role_assignment(self, node_id):
         self.bytes_received += sys.getsizeof(node_id)
+        self.messages_received += 1
 
         role_assignment = self.role_assignment_map[node_id]
 
         self.bytes_sent += sys.getsizeof(role_assignment)
+        self.messages_sent += 1
 
         return role_assignment
 
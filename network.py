@@ -1,33 +1,348 @@
 import rpyc
 from rpyc.utils.server import ThreadedServer
+from multiprocessing.pool import ThreadPool
 import socket
 import threading
+import Queue
+import traceback
+import time
 import sys
 
+from wire_format import encode_token, decode_token, encode_assignment_index, decode_assignment_index, \
+    encode_assignment_indexes, decode_assignment_indexes, encode_evaluate_roles_message, varint_size
+from tracing import TRACED_MESSAGE, TracedRemoteMethod
+
+EVALUATE_ROLES_MESSAGE = "evaluate_roles"
+TOKEN_MESSAGE = "token"
+TOKEN_HOP_MESSAGE = "token_hop"
+UPDATE_ASSIGNMENT_INDEX_MESSAGE = "update_assignment_index"
+MESSAGE_BATCH = "message_batch"
+
+# Route of the messages a network runs in process (see Network.get_route)
+LOCAL_ROUTE = "local"
+
+# Message type of each LogicalNode handler, used to attribute metrics on the receiving side
+HANDLER_MESSAGE_TYPES = {
+    "receive_evaluate_roles_message": EVALUATE_ROLES_MESSAGE,
+    "receive_encoded_evaluate_roles_message": EVALUATE_ROLES_MESSAGE,
+    "receive_token": TOKEN_MESSAGE,
+    "receive_encoded_token": TOKEN_MESSAGE,
+    "receive_token_hop": TOKEN_HOP_MESSAGE,
+    "receive_encoded_token_hop": TOKEN_HOP_MESSAGE,
+    "receive_update_assignment_index_message": UPDATE_ASSIGNMENT_INDEX_MESSAGE,
+    "receive_encoded_update_assignment_index_message": UPDATE_ASSIGNMENT_INDEX_MESSAGE,
+    "receive_message_batch": MESSAGE_BATCH
+}
+
+# Handlers of these message types may relay the message down a broadcast tree and wait on
+# the replies, so they are not run back to back with the other messages of a batch
+RELAYED_MESSAGE_TYPES = frozenset([EVALUATE_ROLES_MESSAGE])
+
 class Network:
 
-    def __init__(self):
+    def __init__(self, encode_messages=False):
+        """
+        With encode_messages set, tokens and assignment indexes travel by value in the
+        compact binary format of wire_format.py, and the encoded sizes are counted in
+        get_wire_bytes_sent.
+        """
         self.bytes_sent = 0
+        self.wire_bytes_sent = 0
+        self.token_hops = 0
+        self.encode_messages = encode_messages
+        self.metrics = None
+        self.tracer = None
+        self.phase_timeouts = {}
+        self.max_batch_size = None
+        self.pending_batches = threading.local()
+        self.counter_lock = threading.Lock()
+
+    def set_metrics_collector(self, metrics):
+        """
+        Attaches a network_metrics.MetricsCollector. The same collector can be shared by
+        several networks.
+        """
+        self.metrics = metrics
+
+    def set_tracer(self, tracer):
+        """
+        Attaches a tracing.Tracer, or detaches it with None. The same tracer can be shared
+        by several networks.
+        """
+        self.tracer = tracer
+
+    def set_phase_timeouts(self, phase_timeouts):
+        """
+        phase_timeouts maps message types (EVALUATE_ROLES_MESSAGE,
+        UPDATE_ASSIGNMENT_INDEX_MESSAGE) to the seconds a node waits for the replies to
+        the messages it fans out. Nodes that do not reply in time are dropped from the
+        assignment. Phases without a timeout wait for every reply.
+        """
+        self.phase_timeouts = dict(phase_timeouts)
+
+    def set_batching(self, max_batch_size=256):
+        """
+        Coalesces the asynchronous messages ("Evaluate Roles" and "Update Assignment Index")
+        that a node sends in one round and that share a route (see get_route) into a single
+        batch. A batch is sent when the node ends its round with flush_messages or waits on
+        a reply, or once it holds max_batch_size messages; the receiving side runs it and
+        returns every reply at once. None turns batching off.
+
+        Messages of a phase with a timeout (see set_phase_timeouts) are sent one by one, so
+        that a node slow to answer is dropped alone rather than with its whole batch.
+
+        A round sends at most one message to each node, so batching only pays off where a
+        route holds many nodes: the in-process nodes of a SimulatedNetwork and the shards of
+        a ProcessSimulatedNetwork. The live networks, with one node per connection, do not
+        support it.
+        """
+        if max_batch_size is not None and max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        self.max_batch_size = max_batch_size
+
+    def get_route(self, message_type, dst_node_id):
+        """
+        Key of the connection carrying messages of message_type to dst_node_id. Every node
+        is a route of its own, unless a network hosts several nodes behind one connection.
+        """
+        return dst_node_id
+
+    def flush_messages(self):
+        """
+        Sends the batches pending on the calling thread, at the end of a round of messages
+        """
+        batches = getattr(self.pending_batches, "batches", None)
+        if batches:
+            # Handlers run inline by the sends below start rounds of their own
+            self.pending_batches.batches = {}
+            for batch in batches.values():
+                batch.flush()
+
+    def gather(self, message_type, results, levels=1):
+        """
+        Returns a Gather over (node id, message result) pairs, with the timeout of the
+        message type's phase multiplied by levels (the depth of a broadcast tree below the
+        node, whose relays wait in turn)
+        """
+        timeout = self.phase_timeouts.get(message_type)
+        return Gather(results, timeout * levels if timeout is not None else None,
+            self.metrics, results[0][1].src_node_id if results else None)
 
     def get_num_nodes(self):
         return len(self.logical_nodes)
 
-    def send_evaluate_roles_message(self, src_node_id, dst_node_id):
-        async_send_evaluate_roles_message = \
-            self.async(self.logical_nodes[dst_node_id].receive_evaluate_roles_message)
-        return async_send_evaluate_roles_message()
+    def get_node_ids(self):
+        """
+        Ids of the nodes currently in the network. Removed nodes leave a free slot.
+        """
+        return [node_id for (node_id, logical_node) in enumerate(self.logical_nodes) if logical_node is not None]
+
+    def add_node(self, node_id, logical_node):
+        """
+        Adds a logical node, or a proxy for a remote one, under node_id. Every node that
+        messages the new node (in practice, every node) must add it to its own network.
+        """
+        if node_id < len(self.logical_nodes) and self.logical_nodes[node_id] is not None:
+            raise ValueError("node %d is already in the network" % node_id)
+
+        while len(self.logical_nodes) <= node_id:
+            self.logical_nodes.append(None)
+        self.logical_nodes[node_id] = logical_node
+
+    def remove_node(self, node_id):
+        """
+        Removes a node that left or failed. Its id is not reused for other nodes.
+        """
+        logical_node = self.logical_nodes[node_id]
+        self.logical_nodes[node_id] = None
+        return logical_node
+
+    def send_evaluate_roles_message(self, src_node_id, dst_node_id, subtree_node_ids=None, role_ids=None):
+        """
+        subtree_node_ids, if given, are the nodes below dst_node_id in the broadcast tree.
+        role_ids, if given, restricts the evaluation to those roles.
+        """
+        if subtree_node_ids is None and role_ids is None:
+            self.record_wire_bytes(EVALUATE_ROLES_MESSAGE, 0)
+            args = ()
+        elif self.encode_messages:
+            args = (self.record_wire_bytes(EVALUATE_ROLES_MESSAGE, encode_evaluate_roles_message(subtree_node_ids, role_ids)),)
+        else:
+            self.measure_message(EVALUATE_ROLES_MESSAGE, (subtree_node_ids, role_ids),
+                lambda arguments: encode_evaluate_roles_message(*arguments))
+            args = (subtree_node_ids, role_ids)
+
+        if self.encode_messages:
+            result = self.send_async_message(EVALUATE_ROLES_MESSAGE, dst_node_id, "receive_encoded_evaluate_roles_message", *args)
+            return MessageResult(result, self, EVALUATE_ROLES_MESSAGE, src_node_id, decode=decode_assignment_indexes)
+
+        result = self.send_async_message(EVALUATE_ROLES_MESSAGE, dst_node_id, "receive_evaluate_roles_message", *args)
+        return MessageResult(result, self, EVALUATE_ROLES_MESSAGE, src_node_id, measure=encode_assignment_indexes)
 
     def send_token(self, src_node_id, dst_node_id, token):
-        self.bytes_sent += sys.getsizeof(token)
+        return self.send_token_message(TOKEN_MESSAGE, "receive_token", src_node_id, dst_node_id, token)
+
+    def send_token_hop(self, src_node_id, dst_node_id, token):
+        return self.send_token_message(TOKEN_HOP_MESSAGE, "receive_token_hop", src_node_id, dst_node_id, token)
+
+    def send_token_message(self, message_type, handler_name, src_node_id, dst_node_id, token):
+        self.count_bytes_sent(sys.getsizeof(token), token_hops=1)
 
-        return self.logical_nodes[dst_node_id].receive_token(src_node_id, token)
+        if self.encode_messages:
+            handler = self.get_handler(message_type, dst_node_id, "receive_encoded_" + handler_name[len("receive_"):])
+            data = self.record_wire_bytes(message_type, encode_token(token))
+            return decode_token(self.record_wire_bytes(message_type, handler(src_node_id, data), reply=True))
+
+        self.measure_message(message_type, token, encode_token)
+        handler = self.get_handler(message_type, dst_node_id, handler_name)
+        token = handler(src_node_id, token)
+        self.measure_message(message_type, token, encode_token, reply=True)
+        return token
 
     def send_update_assignment_index_message(self, src_node_id, dst_node_id, assigned_role):
-        self.bytes_sent += sys.getsizeof(assigned_role)
-        async_send_update_assignment_index_message = \
-            self.async(self.logical_nodes[dst_node_id].receive_update_assignment_index_message)
+        self.count_bytes_sent(sys.getsizeof(assigned_role))
+
+        if self.encode_messages:
+            self.record_wire_bytes(UPDATE_ASSIGNMENT_INDEX_MESSAGE, varint_size(assigned_role))
+            result = self.send_async_message(UPDATE_ASSIGNMENT_INDEX_MESSAGE, dst_node_id,
+                "receive_encoded_update_assignment_index_message", assigned_role)
+            return MessageResult(result, self, UPDATE_ASSIGNMENT_INDEX_MESSAGE, src_node_id, decode=decode_assignment_index)
+
+        self.measure_message(UPDATE_ASSIGNMENT_INDEX_MESSAGE, assigned_role, varint_size)
+        result = self.send_async_message(UPDATE_ASSIGNMENT_INDEX_MESSAGE, dst_node_id,
+            "receive_update_assignment_index_message", assigned_role)
+        return MessageResult(result, self, UPDATE_ASSIGNMENT_INDEX_MESSAGE, src_node_id, measure=encode_assignment_index)
+
+    def send_async_message(self, message_type, dst_node_id, handler_name, *args):
+        if self.max_batch_size is not None and message_type not in self.phase_timeouts:
+            return self.batch_message(message_type, dst_node_id, handler_name, args)
+        return self.async(self.get_handler(message_type, dst_node_id, handler_name))(*args)
 
-        return async_send_update_assignment_index_message(assigned_role)
+    def batch_message(self, message_type, dst_node_id, handler_name, args):
+        # Rounds belong to the sending thread, so each thread coalesces its own messages
+        batches = getattr(self.pending_batches, "batches", None)
+        if batches is None:
+            batches = self.pending_batches.batches = {}
+
+        route = self.get_route(message_type, dst_node_id)
+        trace_context = self.tracer.get_context() if self.tracer is not None else None
+        result = None
+        while result is None:
+            batch = batches.get(route)
+            if batch is None:
+                batch = batches[route] = MessageBatch(self, route, batches)
+            # None if the batch was sent in the meantime
+            result = batch.add((message_type, dst_node_id, handler_name, args, trace_context))
+
+        if len(batch.messages) >= self.max_batch_size:
+            batch.flush()
+        return result
+
+    def send_message_batch(self, route, messages):
+        """
+        Sends a batch of (message type, destination node id, handler name, arguments, trace
+        context) messages bound for route. Returns an async result whose value holds a
+        (succeeded, reply or traceback) pair per message.
+        """
+        handler = self.get_handler(MESSAGE_BATCH, route, "receive_message_batch")
+        return self.async(handler)(tuple((handler_name, args, trace_context)
+            for (_, _, handler_name, args, trace_context) in messages))
+
+    def run_message_batch(self, messages, sent_time=None):
+        """
+        Runs a batch of messages bound for nodes of this network one after the other, for
+        networks that batch in-process messages. Returns the replies as send_message_batch does.
+        """
+        replies = []
+        for (message_type, dst_node_id, handler_name, args, trace_context) in messages:
+            try:
+                if self.metrics is not None and sent_time is not None:
+                    self.metrics.record_queue_time(dst_node_id, time.time() - sent_time)
+                handler = getattr(self.logical_nodes[dst_node_id], handler_name)
+                replies.append((True, self.run_traced_handler(dst_node_id, message_type, trace_context, handler, *args)))
+            except Exception:
+                replies.append((False, traceback.format_exc()))
+        return tuple(replies)
+
+    def get_handler(self, message_type, dst_node_id, handler_name):
+        """
+        Looks up a handler on the destination node. Handlers of local nodes are wrapped to
+        measure their queue time and latency; remote nodes measure their own handlers.
+        """
+        handler = getattr(self.logical_nodes[dst_node_id], handler_name)
+        if hasattr(handler, "call_async"):
+            if self.tracer is None:
+                return handler
+            return TracedRemoteMethod(getattr(self.logical_nodes[dst_node_id], TRACED_MESSAGE),
+                self.tracer.get_context(), handler_name)
+
+        if self.metrics is None and self.tracer is None:
+            return handler
+
+        sent_time = time.time()
+        trace_context = self.tracer.get_context() if self.tracer is not None else None
+        def measured_handler(*args):
+            if self.metrics is not None:
+                self.metrics.record_queue_time(dst_node_id, time.time() - sent_time)
+            return self.run_traced_handler(dst_node_id, message_type, trace_context, handler, *args)
+        return measured_handler
+
+    def run_handler(self, message_type, handler, *args):
+        if self.metrics is None:
+            return handler(*args)
+
+        start_time = time.time()
+        try:
+            return handler(*args)
+        finally:
+            self.metrics.record_handler_latency(message_type, time.time() - start_time)
+
+    def run_traced_handler(self, node_id, message_type, trace_context, handler, *args):
+        """
+        Runs a handler of node_id in a span of its own, the child of the span that sent the
+        message (trace_context)
+        """
+        if self.tracer is None:
+            return self.run_handler(message_type, handler, *args)
+
+        with self.tracer.span(message_type, node_id, trace_context, category="message"):
+            return self.run_handler(message_type, handler, *args)
+
+    def count_bytes_sent(self, num_bytes, token_hops=0):
+        self.counter_lock.acquire()
+        self.bytes_sent += num_bytes
+        self.token_hops += token_hops
+        self.counter_lock.release()
+
+    def record_wire_bytes(self, message_type, data, reply=False):
+        """
+        Counts an encoded request or reply (or a number of bytes) and returns it unchanged
+        """
+        num_bytes = data if isinstance(data, int) else len(data)
+
+        self.counter_lock.acquire()
+        self.wire_bytes_sent += num_bytes
+        self.counter_lock.release()
+
+        self.record_message_metrics(message_type, num_bytes, reply)
+        return data
+
+    def measure_message(self, message_type, message, encode, reply=False):
+        """
+        Reports the encoded size of a message that is not actually encoded, so that runs
+        with and without encode_messages produce the same metrics
+        """
+        if self.metrics is not None:
+            size = encode(message)
+            self.record_message_metrics(message_type, size if isinstance(size, int) else len(size), reply)
+
+    def record_message_metrics(self, message_type, num_bytes, reply):
+        if self.metrics is None:
+            return
+        if reply:
+            self.metrics.record_reply_bytes(message_type, num_bytes)
+        else:
+            self.metrics.record_message_bytes(message_type, num_bytes)
 
     def start_server(self):
         self.server.start()
@@ -38,6 +353,267 @@ class Network:
     def get_bytes_sent(self):
         return self.bytes_sent
 
+    def get_wire_bytes_sent(self):
+        return self.wire_bytes_sent
+
+    def get_token_hops(self):
+        return self.token_hops
+
+class MessageResult:
+    """
+    Wraps the async result of a message. Decodes encoded replies on first access, and
+    records reply sizes and the time the sending node spends waiting.
+    """
+
+    def __init__(self, result, network, message_type, src_node_id, decode=None, measure=None):
+        self.result = result
+        self.network = network
+        self.message_type = message_type
+        self.src_node_id = src_node_id
+        self.decode = decode
+        self.measure = measure
+        self.decoded = False
+        self._value = None
+
+    def wait(self):
+        if self.network.metrics is None:
+            self.result.wait()
+            return
+
+        start_time = time.time()
+        self.result.wait()
+        self.network.metrics.record_wait_time(self.src_node_id, time.time() - start_time)
+
+    def add_callback(self, callback):
+        """
+        Calls callback with this result once the reply has arrived (at once if it has)
+        """
+        self.result.add_callback(lambda _: callback(self))
+
+    def poll(self):
+        poll_result(self.result)
+
+    def abandon(self):
+        """
+        Gives up on the reply, so that the transport can free what it holds for it
+        """
+        abandon_result(self.result)
+
+    def failed(self):
+        return getattr(self.result, "exception", None) is not None or getattr(self.result, "error", False)
+
+    @property
+    def value(self):
+        if not self.decoded:
+            value = self.result.value
+            if self.decode is not None:
+                value = self.decode(self.network.record_wire_bytes(self.message_type, value, reply=True))
+            elif self.measure is not None:
+                self.network.measure_message(self.message_type, value, self.measure, reply=True)
+            self._value = value
+            self.decoded = True
+        return self._value
+
+def poll_result(result):
+    # rpyc replies only arrive while their connection is served, which ready does
+    poll = getattr(result, "poll", None)
+    if poll is not None:
+        poll()
+    else:
+        result.ready
+
+def abandon_result(result):
+    abandon = getattr(result, "abandon", None)
+    if abandon is not None:
+        abandon()
+
+class MessageBatchError(Exception):
+    """
+    Raised for a message of a batch whose handler failed, with the handler's traceback
+    """
+
+class MessageBatch:
+    """
+    Messages bound for one route within a round. A batch of a single message is sent as
+    that message alone.
+    """
+
+    def __init__(self, network, route, batches):
+        self.network = network
+        self.route = route
+        # The pending batches of the sending thread, which this batch leaves once sent
+        self.batches = batches
+        self.messages = []
+        self.result = None
+        self.lock = threading.Lock()
+
+    def add(self, message):
+        """
+        Queues a message and returns its BatchedResult, or None if the batch was already sent
+        """
+        self.lock.acquire()
+        try:
+            if self.result is not None:
+                return None
+            self.messages.append(message)
+            return BatchedResult(self, len(self.messages) - 1)
+        finally:
+            self.lock.release()
+
+    def is_batched(self):
+        return len(self.messages) > 1
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            if self.result is not None:
+                return
+            if self.batches.get(self.route) is self:
+                del self.batches[self.route]
+            self.result = self.send()
+        finally:
+            self.lock.release()
+
+    def send(self):
+        network = self.network
+        if network.metrics is not None:
+            network.metrics.record_batch_size(len(self.messages))
+        if self.is_batched():
+            return network.send_message_batch(self.route, self.messages)
+
+        (message_type, dst_node_id, handler_name, args, trace_context) = self.messages[0]
+        if network.tracer is None:
+            return network.async(network.get_handler(message_type, dst_node_id, handler_name))(*args)
+
+        # Sent as a child of the span that queued it
+        previous_context = network.tracer.set_context(trace_context)
+        try:
+            return network.async(network.get_handler(message_type, dst_node_id, handler_name))(*args)
+        finally:
+            network.tracer.set_context(previous_context)
+
+class BatchedResult:
+    """
+    Async result of one message of a MessageBatch. Waiting on it sends the batch if it is
+    still pending.
+    """
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+        self.resolved = False
+        self._value = None
+        self._exception = None
+
+    def wait(self):
+        self.batch.flush()
+        self.batch.result.wait()
+
+    def add_callback(self, callback):
+        self.batch.flush()
+        self.batch.result.add_callback(lambda _: callback(self))
+
+    def poll(self):
+        self.batch.flush()
+        poll_result(self.batch.result)
+
+    def abandon(self):
+        # Every message of a batch shares its reply
+        if self.batch.result is not None:
+            abandon_result(self.batch.result)
+
+    def _resolve(self):
+        if self.resolved:
+            return
+        self.wait()
+
+        result = self.batch.result
+        try:
+            value = result.value
+            # Simulated futures keep the exception aside instead of raising it
+            exception = getattr(result, "exception", None)
+        except Exception as e:
+            (value, exception) = (None, e)
+
+        if exception is None and self.batch.is_batched():
+            (succeeded, reply) = value[self.index]
+            (value, exception) = (reply, None) if succeeded else (None, MessageBatchError(reply))
+
+        (self._value, self._exception) = (value, exception)
+        self.resolved = True
+
+    @property
+    def exception(self):
+        self._resolve()
+        return self._exception
+
+    @property
+    def value(self):
+        self._resolve()
+        if self._exception is not None:
+            raise self._exception
+        return self._value
+
+class Gather:
+    """
+    Iterates over (node id, message result) pairs in the order the replies arrive, until
+    every reply has arrived or timeout seconds have passed. Replies that failed (e.g. the
+    node is gone) are not returned, and the replies still missing at the deadline are
+    abandoned (see MessageResult.abandon). Afterwards, dropped maps the node id of every
+    reply that failed or did not arrive in time to "error" or "timeout".
+    """
+
+    def __init__(self, results, timeout=None, metrics=None, src_node_id=None, poll_interval=0.005):
+        self.results = list(results)
+        self.timeout = timeout
+        self.metrics = metrics
+        self.src_node_id = src_node_id
+        self.poll_interval = poll_interval
+        self.dropped = {}
+
+    def __iter__(self):
+        start_time = time.time()
+        deadline = start_time + self.timeout if self.timeout is not None else None
+
+        completions = Queue.Queue()
+        pending = dict(self.results)
+        for (node_id, result) in self.results:
+            result.add_callback(lambda result, node_id=node_id: completions.put(node_id))
+
+        while pending:
+            remaining = deadline - time.time() if deadline is not None else self.poll_interval
+            if remaining <= 0:
+                break
+
+            try:
+                node_id = completions.get(True, min(remaining, self.poll_interval))
+            except Queue.Empty:
+                # Some replies only make progress while they are waited on: rpyc replies, and
+                # simulated messages that no worker has picked up yet, which run right here
+                for result in pending.values():
+                    result.poll()
+                continue
+
+            result = pending.pop(node_id, None)
+            if result is None:
+                continue
+            if result.failed():
+                self.dropped[node_id] = "error"
+                continue
+
+            self.record_wait_time(start_time)
+            yield (node_id, result)
+            start_time = time.time()
+
+        for (node_id, result) in pending.items():
+            self.dropped[node_id] = "timeout"
+            result.abandon()
+        self.record_wait_time(start_time)
+
+    def record_wait_time(self, start_time):
+        if self.metrics is not None:
+            self.metrics.record_wait_time(self.src_node_id, time.time() - start_time)
+
 def create_logical_node_service(logical_node):
 
     class LogicalNodeService(rpyc.Service):
@@ -45,43 +621,266 @@ def create_logical_node_service(logical_node):
         def exposed_begin_logical_assignment(self):
             return logical_node.begin_logical_assignment()
 
-        def exposed_receive_evaluate_roles_message(self):
-            return logical_node.receive_evaluate_roles_message()
+        def exposed_receive_evaluate_roles_message(self, subtree_node_ids=None, role_ids=None):
+            return logical_node.receive_evaluate_roles_message(subtree_node_ids, role_ids)
+
+        def exposed_node_joined(self, node_id):
+            return logical_node.node_joined(node_id)
+
+        def exposed_node_left(self, node_id):
+            return logical_node.node_left(node_id)
+
+        def exposed_repair_assignment(self):
+            return logical_node.repair_assignment()
 
         def exposed_receive_token(self, src_node_id, token):
             return logical_node.receive_token(src_node_id, token)
 
+        def exposed_receive_token_hop(self, src_node_id, token):
+            return logical_node.receive_token_hop(src_node_id, token)
+
         def exposed_receive_update_assignment_index_message(self, assigned_role):
             return logical_node.receive_update_assignment_index_message(assigned_role)
 
+        def exposed_receive_encoded_evaluate_roles_message(self, data=None):
+            return logical_node.receive_encoded_evaluate_roles_message(data)
+
+        def exposed_receive_encoded_token(self, src_node_id, data):
+            return logical_node.receive_encoded_token(src_node_id, data)
+
+        def exposed_receive_encoded_token_hop(self, src_node_id, data):
+            return logical_node.receive_encoded_token_hop(src_node_id, data)
+
+        def exposed_receive_encoded_update_assignment_index_message(self, assigned_role):
+            return logical_node.receive_encoded_update_assignment_index_message(assigned_role)
+
+        def exposed_receive_traced_message(self, trace_context, name, *args):
+            if name not in HANDLER_MESSAGE_TYPES:
+                raise AttributeError("%s is not a message handler" % name)
+            return logical_node.network.run_traced_handler(logical_node.node_id, HANDLER_MESSAGE_TYPES[name],
+                tuple(trace_context) if trace_context is not None else None, getattr(logical_node, name), *args)
+
         # override rpyc's security
         def _rpyc_getattr(self, name):
-            return getattr(logical_node, name)
+            if name == TRACED_MESSAGE:
+                return self.exposed_receive_traced_message
+            attribute = getattr(logical_node, name)
+            if name in HANDLER_MESSAGE_TYPES:
+                return lambda *args: logical_node.network.run_handler(HANDLER_MESSAGE_TYPES[name], attribute, *args)
+            return attribute
 
     return LogicalNodeService
 
 
+class ConnectionPool:
+    """
+    Pool of persistent rpyc connections to a single peer. A connection is checked out
+    for the duration of one request, so concurrent requests never share a connection.
+    Idle connections are health checked before reuse and replaced when they fail.
+    """
+
+    def __init__(self, node_ip_address, size=4, health_check_interval=30.0):
+        self.node_ip_address = node_ip_address
+        self.size = size
+        self.health_check_interval = health_check_interval
+        self.idle_conns = []
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(size)
+
+    def acquire(self):
+        self.slots.acquire()
+        try:
+            while True:
+                self.lock.acquire()
+                idle_conn = self.idle_conns.pop() if self.idle_conns else None
+                self.lock.release()
+
+                if idle_conn is None:
+                    return LiveNetwork.create_conn(self.node_ip_address)
+
+                (conn, last_used) = idle_conn
+                if self.is_healthy(conn, last_used):
+                    return conn
+                self._close(conn)
+        except:
+            self.slots.release()
+            raise
+
+    def release(self, conn):
+        if not conn.closed:
+            self.lock.acquire()
+            self.idle_conns.append((conn, time.time()))
+            self.lock.release()
+        self.slots.release()
+
+    def discard(self, conn):
+        """
+        Returns the slot of a connection that failed, closing the connection
+        """
+        self._close(conn)
+        self.slots.release()
+
+    def is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.time() - last_used < self.health_check_interval:
+            return True
+        try:
+            conn.ping()
+            return True
+        except Exception:
+            return False
+
+    def warm_up(self):
+        """
+        Opens every connection of the pool ahead of time
+        """
+        conns = []
+        try:
+            for _ in range(self.size):
+                conns.append(self.acquire())
+        finally:
+            for conn in conns:
+                self.release(conn)
+
+    def close(self):
+        self.lock.acquire()
+        idle_conns = self.idle_conns
+        self.idle_conns = []
+        self.lock.release()
+
+        for (conn, _) in idle_conns:
+            self._close(conn)
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
 class LiveNetwork(Network):
 
     class Client:
+        """
+        Proxy for a remote logical node. Attribute access returns a RemoteMethod that
+        runs over a connection checked out of the peer's ConnectionPool.
+        """
 
-        def __init__(self, node_ip_address):
-            self.conn = None
+        def __init__(self, node_ip_address, pool_size=4):
             self.node_ip_address = node_ip_address
+            self.pool = ConnectionPool(node_ip_address, pool_size)
+
+        def call(self, name, *args):
+            return self._call(lambda conn: getattr(conn.root, name)(*args))
+
+        def call_async(self, name, *args):
+            (conn, result) = self._request(lambda conn: rpyc.async(getattr(conn.root, name))(*args))
+            return LiveNetwork.PooledResult(result, self.pool, conn)
+
+        def get_attribute(self, name):
+            return self._call(lambda conn: getattr(conn.root, name))
+
+        def _call(self, send):
+            (conn, value) = self._request(send)
+            self.pool.release(conn)
+            return value
+
+        def _request(self, send):
+            """
+            Sends a request over a pooled connection, reconnecting once if the pooled
+            connection turns out to be broken. The connection is back in the pool whenever
+            the request fails, e.g. with the error of a remote handler.
+            """
+            for attempt in range(2):
+                conn = self.pool.acquire()
+                try:
+                    return (conn, send(conn))
+                except (EOFError, socket.error):
+                    self.pool.discard(conn)
+                    if attempt:
+                        raise
+                except:
+                    self.pool.release(conn)
+                    raise
 
         def __getattr__(self, name):
-            if not self.conn:
-                self.conn = LiveNetwork.create_conn(self.node_ip_address)
-            return self.conn.root.__getattr__(name)
+            if name.startswith("_"):
+                raise AttributeError(name)
+            return LiveNetwork.RemoteMethod(self, name)
+
+    class PooledResult:
+        """
+        rpyc async result of a request on a pooled connection. The connection goes back to
+        the pool when the reply arrives, or is discarded when the caller abandons the reply:
+        nothing would serve the connection again for a late reply.
+        """
+
+        def __init__(self, result, pool, conn):
+            self.result = result
+            self.pool = pool
+            self.conn = conn
+            self.returned = False
+            self.lock = threading.Lock()
+            result.add_callback(lambda _: self._return(self.pool.release))
+
+        def _return(self, give_back):
+            # Whichever of the reply and abandon comes first returns the connection
+            self.lock.acquire()
+            returned = self.returned
+            self.returned = True
+            self.lock.release()
+            if not returned:
+                give_back(self.conn)
+
+        def abandon(self):
+            self._return(self.pool.discard)
 
-    def __init__(self, server_node, node_ip_addresses):
-        Network.__init__(self)
+        def wait(self):
+            self.result.wait()
+
+        def add_callback(self, callback):
+            self.result.add_callback(lambda _: callback(self))
+
+        @property
+        def ready(self):
+            return self.result.ready
+
+        @property
+        def error(self):
+            return self.result.error
+
+        @property
+        def value(self):
+            return self.result.value
+
+    class RemoteMethod:
+
+        def __init__(self, client, name):
+            self.client = client
+            self.name = name
+
+        def call_async(self, *args):
+            return self.client.call_async(self.name, *args)
 
-        self.async = rpyc.async
+        def __call__(self, *args):
+            return self.client.call(self.name, *args)
+
+    def __init__(self, server_node, node_ip_addresses, pool_size=4, warm_up=False, warm_up_timeout=30.0):
+        """
+        pool_size is the number of connections kept per peer. With warm_up set, start_server
+        opens every pool in the background so that the first assignment does not pay the
+        connection handshakes on its critical path.
+        """
+        Network.__init__(self, encode_messages=True)
+
+        self.async = self._async
+        self.pool_size = pool_size
+        self.warm_up = warm_up
+        self.warm_up_timeout = warm_up_timeout
         self.logical_nodes = []
         for (node_id, node_ip_address) in enumerate(node_ip_addresses):
             if node_id != server_node.node_id:
-                self.logical_nodes.append(LiveNetwork.Client(node_ip_address))
+                self.logical_nodes.append(LiveNetwork.Client(node_ip_address, pool_size))
             else:
                 server_node.set_network(self)
                 self.logical_nodes.append(server_node)
@@ -91,10 +890,99 @@ class LiveNetwork(Network):
                     hostname=node_ip_addresses[server_node.node_id][0],
                     port=node_ip_addresses[server_node.node_id][1],
                     protocol_config = {"allow_all_attrs": True, "allow_pickle": True})
+
+    def _async(self, func):
+        if hasattr(func, "call_async"):
+            return func.call_async
+        return rpyc.async(func)
+
+    def set_batching(self, max_batch_size=256):
+        raise NotImplementedError("LiveNetwork sends every message on the connection of its node")
+
+    def add_node(self, node_id, node_ip_address):
+        Network.add_node(self, node_id, LiveNetwork.Client(node_ip_address, self.pool_size))
+
+    def remove_node(self, node_id):
+        logical_node = Network.remove_node(self, node_id)
+        if isinstance(logical_node, LiveNetwork.Client):
+            logical_node.pool.close()
+        return logical_node
+
+    def start_server(self):
+        if self.warm_up:
+            warm_up_thread = threading.Thread(target=self.warm_up_connections)
+            warm_up_thread.daemon = True
+            warm_up_thread.start()
+
+        Network.start_server(self)
+
+    def stop_server(self):
+        Network.stop_server(self)
+        for logical_node in self.logical_nodes:
+            if isinstance(logical_node, LiveNetwork.Client):
+                logical_node.pool.close()
+
+    def warm_up_connections(self):
+        """
+        Opens the connection pool of every peer, retrying peers that are not up yet
+        until warm_up_timeout expires
+        """
+        deadline = time.time() + self.warm_up_timeout
+        clients = [logical_node for logical_node in self.logical_nodes if isinstance(logical_node, LiveNetwork.Client)]
+
+        while clients and time.time() < deadline:
+            for client in list(clients):
+                try:
+                    client.pool.warm_up()
+                    clients.remove(client)
+                except (EOFError, socket.error):
+                    pass
+            if clients:
+                time.sleep(0.5)
+
     @staticmethod
     def create_conn(node_ip_address):
         return rpyc.connect(node_ip_address[0], node_ip_address[1], config = {"allow_all_attrs": True, "allow_pickle": True})
 
+class ThreadPerMessageExecutor:
+    """
+    Runs every submitted call on a thread of its own
+    """
+
+    def submit(self, func, *args):
+        computation = threading.Thread(target=func, args=args)
+        computation.start()
+
+    def shutdown(self):
+        pass
+
+class ThreadPoolExecutor:
+    """
+    Runs submitted calls on a bounded pool of worker threads. A single pool can be
+    shared by several networks.
+    """
+
+    def __init__(self, num_workers=8):
+        self.pool = ThreadPool(num_workers)
+
+    def submit(self, func, *args):
+        self.pool.apply_async(func, args)
+
+    def shutdown(self):
+        self.pool.close()
+        self.pool.join()
+
+class InlineExecutor:
+    """
+    Runs submitted calls synchronously on the calling thread, for single threaded runs
+    """
+
+    def submit(self, func, *args):
+        func(*args)
+
+    def shutdown(self):
+        pass
+
 class SimulatedNetwork(Network):
     """
     Simplifies development. Should be swappable with a derived Network class that uses real connections
@@ -107,42 +995,107 @@ class SimulatedNetwork(Network):
         Heavily adapted from http://code.activestate.com/recipes/84317-easy-threading-with-futures/
         """
 
-        def __init__(self, func):
+        def __init__(self, func, executor):
             self.func = func
+            self.executor = executor
             self._reset()
             self.still_computing = threading.Condition()   # Notify on this Condition when result is ready
 
         def _reset(self):
+            self.started = False
             self.done = False
             self.value = None
             self.exception = None
+            self.callbacks = []
 
         def __call__(self, *args):
             self._reset()
-            computation = threading.Thread(target=self._compute, args=args)
-            computation.start()
+            self.args = args
+            self.executor.submit(self.poll)
             return self
 
         def wait(self):
+            # If no worker has picked the call up yet, run it on the waiting thread. This keeps
+            # nested waits from deadlocking a bounded pool whose workers are all waiting.
+            if self._claim():
+                self._compute(*self.args)
+                return
+
             self.still_computing.acquire()
             while not self.done:
                 self.still_computing.wait()
             self.still_computing.release()
 
-        def _compute(self, *arg, **kwargs):
+        def add_callback(self, callback):
             self.still_computing.acquire()
+            done = self.done
+            if not done:
+                self.callbacks.append(callback)
+            self.still_computing.release()
+            if done:
+                callback(self)
+
+        def _claim(self):
+            self.still_computing.acquire()
+            claimed = not self.started
+            self.started = True
+            self.still_computing.release()
+            return claimed
+
+        def poll(self):
+            """
+            Runs the call here unless a worker (or a waiting thread) has already claimed it
+            """
+            if self._claim():
+                self._compute(*self.args)
+
+        def _compute(self, *arg, **kwargs):
+            value = None
+            exception = None
             try:
-                self.value = self.func(*arg, **kwargs)
+                value = self.func(*arg, **kwargs)
             except Exception as e:
-                self.exception = e
+                exception = e
+
+            self.still_computing.acquire()
+            self.value = value
+            self.exception = exception
             self.done = True
-            self.still_computing.notify()
+            self.still_computing.notify_all()
+            callbacks = self.callbacks
+            self.callbacks = []
             self.still_computing.release()
 
-    def __init__(self, logical_nodes):
-        Network.__init__(self)
+            for callback in callbacks:
+                callback(self)
+
+    def __init__(self, logical_nodes, executor=None, encode_messages=False):
+        """
+        executor runs the simulated asynchronous messages. Defaults to a thread per message;
+        pass a ThreadPoolExecutor to bound the number of threads or an InlineExecutor to
+        run single threaded. encode_messages sends messages through the wire format, as
+        the live networks do.
+        """
+        Network.__init__(self, encode_messages)
 
-        self.async = SimulatedNetwork.Future
+        self.executor = executor if executor is not None else ThreadPerMessageExecutor()
+        self.async = lambda func: SimulatedNetwork.Future(func, self.executor)
         self.logical_nodes = logical_nodes
         for logical_node in logical_nodes:
             logical_node.set_network(self)
+
+    def add_node(self, node_id, logical_node):
+        if logical_node.node_id != node_id:
+            raise ValueError("node %d cannot be added as node %d" % (logical_node.node_id, node_id))
+        logical_node.set_network(self)
+        Network.add_node(self, node_id, logical_node)
+
+    def get_route(self, message_type, dst_node_id):
+        # Every node is in process, so the messages of a round run together on one worker,
+        # save for relayed ones
+        if message_type in RELAYED_MESSAGE_TYPES:
+            return dst_node_id
+        return LOCAL_ROUTE
+
+    def send_message_batch(self, route, messages):
+        return self.async(self.run_message_batch)(messages, time.time())
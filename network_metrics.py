@@ -0,0 +1,191 @@
+from collections import defaultdict
+import threading
+import json
+import csv
+
+##################################################################################
+# Metrics collected by the Network classes. A single MetricsCollector can be
+# attached to any number of networks (see Network.set_metrics_collector), so that
+# simulated and live runs produce directly comparable numbers.
+##################################################################################
+
+class Histogram:
+    """
+    Histogram with power of two bucket boundaries, cheap enough to update on every message
+    """
+
+    def __init__(self, smallest_bucket=1e-6):
+        self.smallest_bucket = smallest_bucket
+        self.buckets = defaultdict(int)
+
+    def add(self, value):
+        upper_bound = self.smallest_bucket
+        while value > upper_bound:
+            upper_bound *= 2
+        self.buckets[upper_bound] += 1
+
+    def to_dict(self):
+        return dict(("%g" % upper_bound, count) for (upper_bound, count) in sorted(self.buckets.items()))
+
+class Statistic:
+    """
+    Running count, total and maximum of one metric
+    """
+
+    def __init__(self, histogram=None):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.histogram = histogram
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        if self.histogram is not None:
+            self.histogram.add(value)
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        if self.histogram is not None and other.histogram is not None:
+            for (upper_bound, count) in other.histogram.buckets.items():
+                self.histogram.buckets[upper_bound] += count
+
+    def to_dict(self):
+        statistic = {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "max": self.max
+        }
+        if self.histogram is not None:
+            statistic["histogram"] = self.histogram.to_dict()
+        return statistic
+
+class MetricsCollector:
+    """
+    Thread safe collector of per message type and per node metrics:
+
+    - message bytes: serialized size of each request; its count is the number of messages
+    - reply bytes: serialized size of each reply
+    - handler latency: time spent in the receiving node's handler
+    - queue time: time between a message being sent and its handler starting
+    - wait time: time a node spends blocked waiting for replies
+    - batch size: number of messages sent together, per batch (see Network.set_batching)
+    """
+
+    def __init__(self, histograms=False):
+        self.histograms = histograms
+        self.lock = threading.Lock()
+        self.message_statistics = {}
+        self.node_statistics = {}
+
+    def record_message_bytes(self, message_type, num_bytes):
+        self._add(self.message_statistics, (message_type, "bytes"), num_bytes)
+
+    def record_reply_bytes(self, message_type, num_bytes):
+        self._add(self.message_statistics, (message_type, "reply_bytes"), num_bytes)
+
+    def record_handler_latency(self, message_type, seconds):
+        self._add(self.message_statistics, (message_type, "handler_latency"), seconds)
+
+    def record_batch_size(self, num_messages):
+        self._add(self.message_statistics, ("message_batch", "batch_size"), num_messages)
+
+    def record_queue_time(self, node_id, seconds):
+        self._add(self.node_statistics, (node_id, "queue_time"), seconds)
+
+    def record_wait_time(self, node_id, seconds):
+        self._add(self.node_statistics, (node_id, "wait_time"), seconds)
+
+    def _add(self, statistics, key, value):
+        self.lock.acquire()
+        try:
+            statistic = statistics.get(key)
+            if statistic is None:
+                statistic = statistics[key] = Statistic(Histogram() if self.histograms else None)
+            statistic.add(value)
+        finally:
+            self.lock.release()
+
+    def get_message_count(self, message_type=None):
+        """
+        Number of messages sent, of one message type or of all of them
+        """
+        return sum(statistic.count for ((current_type, metric), statistic) in self.message_statistics.items()
+            if metric == "bytes" and message_type in (None, current_type))
+
+    def get_batch_count(self):
+        """
+        Number of batches sent, i.e. of requests that reached the transport while batching
+        """
+        statistic = self.message_statistics.get(("message_batch", "batch_size"))
+        return statistic.count if statistic is not None else 0
+
+    def get_message_bytes(self, message_type=None):
+        """
+        Total request and reply bytes, for one message type or all of them
+        """
+        return sum(statistic.total for ((current_type, metric), statistic) in self.message_statistics.items()
+            if metric in ("bytes", "reply_bytes") and message_type in (None, current_type))
+
+    def merge(self, other):
+        """
+        Folds the metrics of another collector, e.g. one per live node, into this one
+        """
+        other.lock.acquire()
+        try:
+            items = [(self.message_statistics, key, statistic) for (key, statistic) in other.message_statistics.items()] + \
+                [(self.node_statistics, key, statistic) for (key, statistic) in other.node_statistics.items()]
+        finally:
+            other.lock.release()
+
+        self.lock.acquire()
+        try:
+            for (statistics, key, statistic) in items:
+                if key not in statistics:
+                    statistics[key] = Statistic(Histogram() if self.histograms else None)
+                statistics[key].merge(statistic)
+        finally:
+            self.lock.release()
+
+    def to_dict(self):
+        self.lock.acquire()
+        try:
+            messages = defaultdict(dict)
+            for ((message_type, metric), statistic) in self.message_statistics.items():
+                messages[message_type][metric] = statistic.to_dict()
+
+            nodes = defaultdict(dict)
+            for ((node_id, metric), statistic) in self.node_statistics.items():
+                nodes[str(node_id)][metric] = statistic.to_dict()
+
+            return {"messages": dict(messages), "nodes": dict(nodes)}
+        finally:
+            self.lock.release()
+
+    def to_json(self, indent=2):
+        return json.dumps(self.to_dict(), indent=indent, sort_keys=True)
+
+    def write_csv(self, output_file):
+        """
+        Writes one row per (scope, key, metric) with the summary statistics
+        """
+        summary = self.to_dict()
+        output = csv.DictWriter(output_file, fieldnames=["scope", "key", "metric", "count", "total", "mean", "max"])
+        output.writeheader()
+
+        for scope in ("messages", "nodes"):
+            for (key, metrics) in sorted(summary[scope].items()):
+                for (metric, statistic) in sorted(metrics.items()):
+                    output.writerow({
+                        "scope": scope,
+                        "key": key,
+                        "metric": metric,
+                        "count": statistic["count"],
+                        "total": statistic["total"],
+                        "mean": statistic["mean"],
+                        "max": statistic["max"]
+                    })
@@ -0,0 +1,110 @@
+from contextlib import contextmanager
+import itertools
+import json
+import csv
+
+##################################################################################
+# Streaming sources of node parameters for RoleAssignmentService.ingest. Every
+# reader yields (node_id, parameters) pairs lazily, so a cluster description far
+# larger than memory can be graded a chunk at a time.
+##################################################################################
+
+def chunked(iterable, chunk_size):
+    """
+    Yields lists of up to chunk_size consecutive items of iterable
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1")
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+@contextmanager
+def _open_source(source):
+    # A path is opened (and closed) here; an open file is left to its owner
+    if isinstance(source, basestring):
+        with open(source) as input_file:
+            yield input_file
+    else:
+        yield source
+
+def node_id_value(node_id):
+    """
+    node_id as a non-negative integer, the only node ids checkpoints can store (see
+    checkpoint.write_checkpoint). Integral numbers and their decimal strings are accepted;
+    any other id raises a ValueError.
+    """
+    try:
+        value = int(node_id)
+    except (TypeError, ValueError):
+        raise ValueError("node ids must be non-negative integers, not %r" % (node_id,))
+    if value < 0 or (not isinstance(node_id, basestring) and value != node_id):
+        raise ValueError("node ids must be non-negative integers, not %r" % (node_id,))
+    return value
+
+def parse_value(text):
+    """
+    Best effort typing of a CSV field: integers, floats and true/false become numbers and
+    booleans, anything else stays a string
+    """
+    for convert in (int, float):
+        try:
+            return convert(text)
+        except ValueError:
+            pass
+    lowered = text.lower()
+    if lowered in ("true", "false"):
+        return lowered == "true"
+    return text
+
+def read_csv_nodes(source, node_id_column="node_id", converters=None):
+    """
+    Yields a (node_id, parameters) pair per row of a CSV file with a header line. source
+    is a path or an open file. converters maps column names to functions parsing their
+    fields; the other fields go through parse_value. Empty fields are left out of the
+    parameters. The node id column is kept among the parameters.
+    """
+    converters = converters or {}
+    with _open_source(source) as input_file:
+        for row in csv.DictReader(input_file):
+            parameters = {}
+            for (key, text) in row.items():
+                if text is None or text == "":
+                    continue
+                parameters[key] = converters[key](text) if key in converters else parse_value(text)
+            yield (parameters[node_id_column], parameters)
+
+def read_json_lines_nodes(source, node_id_key="node_id"):
+    """
+    Yields a (node_id, parameters) pair per line of a JSON-lines file, each line a JSON
+    object holding a node's parameters. Blank lines are skipped.
+    """
+    with _open_source(source) as input_file:
+        for line in input_file:
+            if not line.strip():
+                continue
+            parameters = json.loads(line)
+            yield (parameters[node_id_key], parameters)
+
+def column_rows(columns, node_id_column="node_id", chunk_size=4096):
+    """
+    Yields a (node_id, parameters) pair per row of a columnar batch: a dictionary of
+    equally long sequences (lists or numpy arrays), one per parameter. Columns are
+    converted to rows chunk_size rows at a time.
+    """
+    names = list(columns)
+    num_rows = len(columns[node_id_column])
+    id_position = names.index(node_id_column)
+
+    for start in range(0, num_rows, chunk_size):
+        block = []
+        for name in names:
+            values = columns[name][start:start + chunk_size]
+            # numpy scalars become plain Python values
+            block.append(values.tolist() if hasattr(values, "tolist") else list(values))
+
+        for values in zip(*block):
+            yield (values[id_position], dict(zip(names, values)))
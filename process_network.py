@@ -0,0 +1,376 @@
+from network import Network, SimulatedNetwork, ThreadPerMessageExecutor, ThreadPoolExecutor, HANDLER_MESSAGE_TYPES, \
+    RELAYED_MESSAGE_TYPES, LOCAL_ROUTE
+from network_metrics import MetricsCollector
+from tracing import Tracer, TRACED_MESSAGE
+from async_network import FrameLoop, AsyncLiveNetwork, EXPOSED_METHODS, GET_ATTRIBUTE, REPLY_FRAME, ERROR_FRAME
+import cPickle as pickle
+import multiprocessing
+import threading
+import traceback
+import socket
+import time
+
+##################################################################################
+# A simulated network that shards the logical nodes across forked processes, so
+# that role evaluation and message handling are not serialized by a single GIL.
+# Every pair of shards shares a socketpair carrying the framed, multiplexed
+# messages of async_network.py, and the driving process holds one more socketpair
+# per shard. Nodes are placed in contiguous blocks of node ids, which keeps most
+# of a broadcast subtree on a single shard. With batching on, the messages a node
+# sends to the nodes of one shard in one round travel in a single frame.
+##################################################################################
+
+class ShardPeer:
+    """
+    Proxy for a logical node hosted by another process. Requests name the destination
+    node, since a shard hosts many of them.
+    """
+
+    def __init__(self, connections, shard_id, node_id):
+        self.connections = connections
+        self.shard_id = shard_id
+        self.node_id = node_id
+
+    def call_async(self, name, *args):
+        return self.connections[self.shard_id].request(pickle.dumps((self.node_id, name, args), pickle.HIGHEST_PROTOCOL))
+
+    def get_attribute(self, name):
+        return self.call_async(GET_ATTRIBUTE, name).value
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return AsyncLiveNetwork.RemoteMethod(self, name)
+
+class ShardNetwork(Network):
+    """
+    The network seen by the nodes of one shard process. Messages between nodes of the same
+    shard stay in process; the others travel to the owning shard.
+    """
+
+    def __init__(self, shard_id, logical_nodes, node_shards, loop, executor, encode_messages):
+        Network.__init__(self, encode_messages)
+
+        self.shard_id = shard_id
+        self.loop = loop
+        self.executor = executor
+        self.async = self._async
+        self.connections = {}
+
+        self.logical_nodes = []
+        for (node_id, logical_node) in enumerate(logical_nodes):
+            if node_shards[node_id] == shard_id:
+                logical_node.set_network(self)
+                self.logical_nodes.append(logical_node)
+            else:
+                self.logical_nodes.append(ShardPeer(self.connections, node_shards[node_id], node_id))
+
+    def _async(self, func):
+        if hasattr(func, "call_async"):
+            return func.call_async
+        return SimulatedNetwork.Future(func, self.executor)
+
+    def get_route(self, message_type, dst_node_id):
+        # Nodes of another shard share its connection. Those of this shard are in process, so
+        # the messages of a round run together on one worker, save for relayed ones.
+        logical_node = self.logical_nodes[dst_node_id]
+        if isinstance(logical_node, ShardPeer):
+            return ("shard", logical_node.shard_id)
+        if message_type in RELAYED_MESSAGE_TYPES:
+            return dst_node_id
+        return LOCAL_ROUTE
+
+    def send_message_batch(self, route, messages):
+        if not isinstance(route, tuple):
+            return self.async(self.run_message_batch)(messages, time.time())
+
+        messages = [(dst_node_id, handler_name, args, trace_context)
+            for (_, dst_node_id, handler_name, args, trace_context) in messages]
+        payload = pickle.dumps((None, "receive_message_batch", (messages,)), pickle.HIGHEST_PROTOCOL)
+        return self.connections[route[1]].request(payload)
+
+    def _on_request(self, connection, request_id, payload):
+        self.executor.submit(self._handle_request, connection, request_id, payload, time.time())
+
+    def _handle_request(self, connection, request_id, payload, received_time):
+        # Still unset below if the payload fails to unpickle
+        (node_id, name) = (None, None)
+        try:
+            (node_id, name, args) = pickle.loads(payload)
+
+            if node_id is None and name == "receive_message_batch":
+                self.receive_message_batch(connection, request_id, args[0], received_time)
+                return
+
+            trace_context = None
+            if name == TRACED_MESSAGE:
+                (trace_context, name, args) = (args[0], args[1], args[2:])
+
+            if node_id is None:
+                value = self.run_shard_command(name, *args)
+            else:
+                value = self.run_message(node_id, name, args, trace_context, received_time)
+
+            connection.send_frame(REPLY_FRAME, request_id, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            connection.send_frame(ERROR_FRAME, request_id, pickle.dumps(traceback.format_exc()))
+
+        if node_id is None and name == "stop":
+            self.loop.stop()
+
+    def run_message(self, node_id, name, args, trace_context, received_time):
+        if name == GET_ATTRIBUTE and not args[0].startswith("_"):
+            return getattr(self.logical_nodes[node_id], args[0])
+        if name not in EXPOSED_METHODS:
+            raise AttributeError("%s is not exposed" % name)
+
+        if self.metrics is not None:
+            self.metrics.record_queue_time(node_id, time.time() - received_time)
+        handler = getattr(self.logical_nodes[node_id], name)
+        return self.run_traced_handler(node_id, HANDLER_MESSAGE_TYPES.get(name, name), trace_context, handler, *args)
+
+    def receive_message_batch(self, connection, request_id, messages, received_time):
+        """
+        Runs a batch of (node id, handler name, arguments, trace context) messages for nodes
+        of this shard, and sends their (succeeded, reply or traceback) pairs back in one frame.
+        Relayed messages get a worker each, since their handlers wait on replies of their own;
+        the others run back to back on this worker.
+        """
+        replies = [None] * len(messages)
+        remaining = [len(messages)]
+        lock = threading.Lock()
+
+        def run(index):
+            (node_id, name, args, trace_context) = messages[index]
+            try:
+                replies[index] = (True, self.run_message(node_id, name, args, trace_context, received_time))
+            except Exception:
+                replies[index] = (False, traceback.format_exc())
+
+            lock.acquire()
+            remaining[0] -= 1
+            last = remaining[0] == 0
+            lock.release()
+
+            # Whichever message finishes last replies for the batch
+            if last:
+                try:
+                    connection.send_frame(REPLY_FRAME, request_id, pickle.dumps(tuple(replies), pickle.HIGHEST_PROTOCOL))
+                except Exception:
+                    connection.send_frame(ERROR_FRAME, request_id, pickle.dumps(traceback.format_exc()))
+
+        relayed = [HANDLER_MESSAGE_TYPES.get(message[1]) in RELAYED_MESSAGE_TYPES for message in messages]
+        for index in range(len(messages)):
+            if relayed[index]:
+                self.executor.submit(run, index)
+        for index in range(len(messages)):
+            if not relayed[index]:
+                run(index)
+
+    def run_shard_command(self, name, *args):
+        """
+        Requests sent by the driving process to the shard as a whole
+        """
+        if name == "get_attributes":
+            return dict((node_id, getattr(logical_node, args[0])) for (node_id, logical_node) in enumerate(self.logical_nodes)
+                if not isinstance(logical_node, ShardPeer))
+
+        elif name == "get_counters":
+            return (self.bytes_sent, self.wire_bytes_sent, self.token_hops)
+
+        elif name == "set_metrics":
+            self.set_metrics_collector(MetricsCollector(*args) if args else None)
+            return None
+
+        elif name == "drain_metrics":
+            # Swap in a fresh collector, so that the driver never merges the same metrics twice
+            metrics = self.metrics
+            if metrics is None:
+                return None
+            self.set_metrics_collector(MetricsCollector(metrics.histograms))
+            return (metrics.message_statistics, metrics.node_statistics)
+
+        elif name == "set_tracer":
+            self.set_tracer(Tracer() if args[0] else None)
+            return None
+
+        elif name == "set_phase_timeouts":
+            self.set_phase_timeouts(args[0])
+            return None
+
+        elif name == "set_batching":
+            self.set_batching(args[0])
+            return None
+
+        elif name == "drain_spans":
+            return self.tracer.drain() if self.tracer is not None else []
+
+        elif name == "stop":
+            return None
+
+        raise AttributeError("unknown shard command %s" % name)
+
+def _run_shard(shard_id, logical_nodes, node_shards, shard_sockets, driver_socket, inherited_sockets, num_workers,
+               encode_messages):
+    # The fork inherits the ends of every socketpair; holding on to the ones of other shards
+    # and of the driver would keep their peers from seeing an EOF when they die
+    used_sockets = set(shard_sockets.values())
+    used_sockets.add(driver_socket)
+    for sock in inherited_sockets:
+        if sock not in used_sockets:
+            sock.close()
+
+    executor = ThreadPoolExecutor(num_workers) if num_workers else ThreadPerMessageExecutor()
+    loop = FrameLoop(None)
+    network = ShardNetwork(shard_id, logical_nodes, node_shards, loop, executor, encode_messages)
+    loop.on_request = network._on_request
+
+    for (peer_shard_id, sock) in shard_sockets.items():
+        network.connections[peer_shard_id] = loop.attach(sock)
+    loop.attach(driver_socket)
+
+    loop.start()
+    while loop.thread.is_alive():
+        loop.thread.join(1)
+    executor.shutdown()
+
+class ProcessSimulatedNetwork(Network):
+    """
+    Drop-in alternative to SimulatedNetwork that hosts the logical nodes in num_processes
+    forked shard processes (one per core by default). Each shard runs incoming messages
+    on its own executor: a thread per message, or a pool of num_workers threads.
+
+    The nodes live in the shards once the network is created, so the driving process
+    reaches them through logical_nodes, e.g. network.logical_nodes[0].begin_logical_assignment(),
+    and reads their state with get_node_attributes. Membership changes are not supported.
+    """
+
+    def __init__(self, logical_nodes, num_processes=None, num_workers=None, encode_messages=False):
+        Network.__init__(self, encode_messages)
+
+        num_nodes = len(logical_nodes)
+        self.num_processes = max(1, min(num_processes or multiprocessing.cpu_count(), num_nodes))
+        node_shards = [node_id * self.num_processes // num_nodes for node_id in range(num_nodes)]
+
+        shard_socket_pairs = dict(((shard_id, peer_shard_id), socket.socketpair())
+            for shard_id in range(self.num_processes) for peer_shard_id in range(shard_id + 1, self.num_processes))
+        driver_socket_pairs = [socket.socketpair() for _ in range(self.num_processes)]
+        inherited_sockets = [sock for socket_pair in shard_socket_pairs.values() + driver_socket_pairs for sock in socket_pair]
+
+        self.processes = []
+        for shard_id in range(self.num_processes):
+            shard_sockets = {}
+            for ((first_shard_id, second_shard_id), (first_socket, second_socket)) in shard_socket_pairs.items():
+                if first_shard_id == shard_id:
+                    shard_sockets[second_shard_id] = first_socket
+                elif second_shard_id == shard_id:
+                    shard_sockets[first_shard_id] = second_socket
+
+            process = multiprocessing.Process(target=_run_shard, args=(shard_id, logical_nodes, node_shards,
+                shard_sockets, driver_socket_pairs[shard_id][1], inherited_sockets, num_workers, encode_messages))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+
+        # The forked shards hold their own copies of these sockets
+        for (first_socket, second_socket) in shard_socket_pairs.values():
+            first_socket.close()
+            second_socket.close()
+
+        self.loop = FrameLoop(None)
+        self.connections = {}
+        for (shard_id, (driver_socket, shard_socket)) in enumerate(driver_socket_pairs):
+            shard_socket.close()
+            self.connections[shard_id] = self.loop.attach(driver_socket)
+        self.loop.start()
+
+        self.logical_nodes = [ShardPeer(self.connections, node_shards[node_id], node_id) for node_id in range(num_nodes)]
+
+    def add_node(self, node_id, logical_node):
+        raise NotImplementedError("ProcessSimulatedNetwork does not support membership changes")
+
+    def remove_node(self, node_id):
+        raise NotImplementedError("ProcessSimulatedNetwork does not support membership changes")
+
+    def run_shard_command(self, name, *args):
+        """
+        Sends a command to every shard and returns their replies, in shard order
+        """
+        results = [self.connections[shard_id].request(pickle.dumps((None, name, args), pickle.HIGHEST_PROTOCOL))
+            for shard_id in range(self.num_processes)]
+        return [result.value for result in results]
+
+    def get_node_attributes(self, name):
+        """
+        Returns a node id -> value dictionary of one attribute (e.g. assigned_role) of every node
+        """
+        attributes = {}
+        for shard_attributes in self.run_shard_command("get_attributes", name):
+            attributes.update(shard_attributes)
+        return attributes
+
+    def set_metrics_collector(self, metrics):
+        """
+        Every shard collects its own metrics; collect_metrics folds them into this collector
+        """
+        Network.set_metrics_collector(self, metrics)
+        if metrics is not None:
+            self.run_shard_command("set_metrics", metrics.histograms)
+        else:
+            self.run_shard_command("set_metrics")
+
+    def collect_metrics(self):
+        for statistics in self.run_shard_command("drain_metrics"):
+            if statistics is not None and self.metrics is not None:
+                shard_metrics = MetricsCollector(self.metrics.histograms)
+                (shard_metrics.message_statistics, shard_metrics.node_statistics) = statistics
+                self.metrics.merge(shard_metrics)
+        return self.metrics
+
+    def set_tracer(self, tracer):
+        """
+        Every shard traces its own nodes; collect_spans folds their spans into this tracer
+        """
+        Network.set_tracer(self, tracer)
+        self.run_shard_command("set_tracer", tracer is not None)
+
+    def set_phase_timeouts(self, phase_timeouts):
+        Network.set_phase_timeouts(self, phase_timeouts)
+        self.run_shard_command("set_phase_timeouts", self.phase_timeouts)
+
+    def set_batching(self, max_batch_size=256):
+        """
+        Batches the messages sent between shards, whose nodes share one connection per shard
+        """
+        Network.set_batching(self, max_batch_size)
+        self.run_shard_command("set_batching", self.max_batch_size)
+
+    def collect_spans(self):
+        for spans in self.run_shard_command("drain_spans"):
+            if self.tracer is not None:
+                self.tracer.add_spans(spans)
+        return self.tracer
+
+    def get_bytes_sent(self):
+        return sum(counters[0] for counters in self.run_shard_command("get_counters"))
+
+    def get_wire_bytes_sent(self):
+        return sum(counters[1] for counters in self.run_shard_command("get_counters"))
+
+    def get_token_hops(self):
+        return sum(counters[2] for counters in self.run_shard_command("get_counters"))
+
+    def start_server(self):
+        pass
+
+    def stop_server(self):
+        try:
+            self.run_shard_command("stop")
+        except (EOFError, socket.error):
+            pass
+
+        for process in self.processes:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+        self.loop.stop()
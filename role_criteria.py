@@ -1,8 +1,13 @@
 from abc import ABCMeta, abstractmethod
+from evaluation_cache import parameters_fingerprint
+import numpy
 
 class RoleCriteria:
     __metaclass__ = ABCMeta
 
+    # Bump whenever the grading logic of a criteria changes, so cached grades are not reused
+    cache_version = 0
+
     @abstractmethod
     def evaluate_against(self, node_parameters):
         """
@@ -32,3 +37,70 @@ class RoleCriteria:
         grade for node_1.
         """
         pass
+
+    def evaluate_batch(self, parameter_table):
+        """
+        Optional vectorized counterpart of evaluate_against. parameter_table is a sequence
+        of node parameter dictionaries, and the return value should be a one dimensional
+        array holding one grade per entry, in the same order.
+
+        Criterias that can grade many nodes at once (e.g. by looking up a column of
+        parameters with numpy) should override this method. The default implementation
+        returns NotImplemented, in which case callers fall back to evaluate_against.
+        """
+        return NotImplemented
+
+    def cache_key(self):
+        """
+        Identifies this criteria in an evaluation_cache.EvaluationCache. Defaults to the
+        criteria object itself and its cache_version. Criterias that are rebuilt between
+        assignment rounds should return a stable value (e.g. their configuration) instead.
+        """
+        return (self, self.cache_version)
+
+def evaluate_grades(role_criteria, parameter_table):
+    grades = role_criteria.evaluate_batch(parameter_table)
+    if grades is NotImplemented:
+        grades = [role_criteria.evaluate_against(node_parameters) for node_parameters in parameter_table]
+    return grades
+
+def evaluate_grade_matrix(role_criterias, parameter_table, cache=None):
+    """
+    Builds the full nodes x roles grade matrix for the given parameter table in one call.
+    Row i holds the grades of parameter_table[i], column j the grades of role_criterias[j].
+
+    With an evaluation_cache.EvaluationCache, only the grades missing from the cache are
+    evaluated, and they are stored for the next call.
+    """
+    # Compiled criterias (see criteria_dsl.py) only grade the roles their index can match
+    evaluate_indexed = getattr(role_criterias, "evaluate_grade_matrix", None)
+    if evaluate_indexed is not None:
+        return evaluate_indexed(parameter_table, cache)
+
+    grade_matrix = numpy.zeros((len(parameter_table), len(role_criterias)))
+
+    if cache is None:
+        for (role_id, role_criteria) in enumerate(role_criterias):
+            grade_matrix[:, role_id] = evaluate_grades(role_criteria, parameter_table)
+        return grade_matrix
+
+    fingerprints = [parameters_fingerprint(node_parameters) for node_parameters in parameter_table]
+
+    for (role_id, role_criteria) in enumerate(role_criterias):
+        criteria_key = role_criteria.cache_key()
+
+        missing_rows = []
+        for (row, fingerprint) in enumerate(fingerprints):
+            grade = cache.lookup((criteria_key, fingerprint))
+            if grade is None:
+                missing_rows.append(row)
+            else:
+                grade_matrix[row, role_id] = grade
+
+        if missing_rows:
+            grades = evaluate_grades(role_criteria, [parameter_table[row] for row in missing_rows])
+            for (row, grade) in zip(missing_rows, grades):
+                grade_matrix[row, role_id] = grade
+                cache.store((criteria_key, fingerprints[row]), float(grade))
+
+    return grade_matrix
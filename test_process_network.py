@@ -0,0 +1,76 @@
+from process_network import ProcessSimulatedNetwork
+from logical_node import LogicalNode
+from role_criteria import RoleCriteria
+import threading
+import unittest
+import signal
+import os
+
+##################################################################################
+# Failure handling of ProcessSimulatedNetwork. Run with
+#
+#   python -m unittest test_process_network
+##################################################################################
+
+class ResidueCriteria(RoleCriteria):
+
+    def __init__(self, residue):
+        self.residue = residue
+
+    def evaluate_against(self, node_parameters):
+        return 1.0 if node_parameters["x"] % 3 == self.residue else 0.0
+
+class DeadShardTest(unittest.TestCase):
+
+    def setUp(self):
+        role_criterias = [ResidueCriteria(residue) for residue in range(3)]
+        nodes = [LogicalNode(node_id, { "x": node_id }, role_criterias) for node_id in range(6)]
+        self.network = ProcessSimulatedNetwork(nodes, num_processes=3)
+
+    def tearDown(self):
+        for process in self.network.processes:
+            if process.is_alive():
+                process.terminate()
+        self.network.loop.stop()
+
+    def call(self, func, *args):
+        """
+        Returns func(*args), or raises what it raised. A shard whose death goes unnoticed
+        blocks the driver forever, so the call runs on a thread that must finish in time.
+        """
+        outcome = []
+        def run():
+            try:
+                outcome.append((True, func(*args)))
+            except Exception as e:
+                outcome.append((False, e))
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+        if not outcome:
+            self.fail("the driver did not notice the dead shard")
+
+        (succeeded, value) = outcome[0]
+        if not succeeded:
+            raise value
+        return value
+
+    def kill_shard(self, shard_id):
+        process = self.network.processes[shard_id]
+        os.kill(process.pid, signal.SIGKILL)
+        process.join()
+
+    def test_driver_sees_dead_shard(self):
+        self.assertEqual(self.network.get_token_hops(), 0)
+        self.kill_shard(1)
+        self.assertRaises(EOFError, self.call, self.network.get_token_hops)
+
+    def test_assignment_drops_nodes_of_dead_shard(self):
+        self.kill_shard(1)
+        self.call(self.network.logical_nodes[0].begin_logical_assignment)
+        dropped_nodes = self.call(self.network.logical_nodes[0].get_attribute, "dropped_nodes")
+        self.assertEqual(sorted(dropped_nodes), [2, 3])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,267 @@
+from functools import wraps
+import itertools
+import threading
+import struct
+import json
+import time
+import os
+
+##################################################################################
+# Opt-in execution tracing. A Tracer attached to a network (Network.set_tracer)
+# records a span for every message handled by a logical node and for the main
+# phases of the algorithm (role evaluation, broadcasts, token walk, ...). Messages
+# carry the context of the span that sent them, across threads and processes, so
+# the spans of a whole run form one tree. Spans export to the Chrome trace event
+# format, which chrome://tracing and Perfetto show as a timeline with one track per
+# node and arrows along every message.
+##################################################################################
+
+# Remote method that carries a trace context ahead of the name and arguments of the real handler
+TRACED_MESSAGE = "receive_traced_message"
+
+class Span:
+    """
+    Context manager for one span. While it is open, it is the parent of the spans opened
+    on the same thread and of the messages that thread sends.
+    """
+
+    def __init__(self, tracer, name, node_id, parent_context, category):
+        self.tracer = tracer
+        self.name = name
+        self.node_id = node_id
+        self.category = category
+        self.span_id = tracer.next_span_id()
+        if parent_context is not None:
+            (self.trace_id, self.parent_id) = parent_context
+        else:
+            (self.trace_id, self.parent_id) = (self.span_id, None)
+
+    def __enter__(self):
+        self.previous_context = self.tracer.set_context((self.trace_id, self.span_id))
+        self.start = self.tracer.clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = self.tracer.clock()
+        self.tracer.set_context(self.previous_context)
+        self.tracer.record({
+            "name": self.name,
+            "category": self.category,
+            "node_id": self.node_id,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "thread": threading.current_thread().ident,
+            "start": self.start,
+            "end": end
+        })
+
+class Tracer:
+    """
+    Thread safe collector of spans. clock returns the current time in seconds; pass a
+    virtual clock to trace simulated runs, e.g. lambda: network.now for a
+    DiscreteEventNetwork. One tracer may be shared by the networks of a process.
+    """
+
+    def __init__(self, clock=None):
+        self.clock = clock if clock is not None else time.time
+        self.spans = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+        # Span ids stay unique across processes: a random prefix per tracer, then a counter
+        self.span_id_prefix = struct.unpack("!I", os.urandom(4))[0] & 0x7FFFFFFF
+        self.span_counter = itertools.count(1)
+
+    def next_span_id(self):
+        return (self.span_id_prefix << 32) | next(self.span_counter)
+
+    def span(self, name, node_id, parent_context=None, category="phase"):
+        """
+        Opens a span for node_id. Without parent_context, the span is a child of the span
+        open on the calling thread, if any.
+        """
+        if parent_context is None:
+            parent_context = self.get_context()
+        return Span(self, name, node_id, parent_context, category)
+
+    def get_context(self):
+        """
+        (trace id, span id) of the span open on the calling thread, or None
+        """
+        return getattr(self.local, "context", None)
+
+    def set_context(self, context):
+        previous_context = self.get_context()
+        self.local.context = context
+        return previous_context
+
+    def record(self, span):
+        self.lock.acquire()
+        self.spans.append(span)
+        self.lock.release()
+
+    def get_spans(self):
+        self.lock.acquire()
+        spans = list(self.spans)
+        self.lock.release()
+        return spans
+
+    def add_spans(self, spans):
+        """
+        Merges spans recorded by another tracer, e.g. in another process
+        """
+        self.lock.acquire()
+        self.spans.extend(spans)
+        self.lock.release()
+
+    def drain(self):
+        """
+        Returns the recorded spans and forgets them
+        """
+        self.lock.acquire()
+        spans = self.spans
+        self.spans = []
+        self.lock.release()
+        return spans
+
+    def to_chrome_trace(self):
+        return chrome_trace(self.get_spans())
+
+    def export_chrome_trace(self, path):
+        with open(path, "w") as output_file:
+            json.dump(self.to_chrome_trace(), output_file)
+
+def traced(method):
+    """
+    Decorator for LogicalNode methods: records a span for every call while the node's
+    network has a tracer
+    """
+    @wraps(method)
+    def traced_method(self, *args, **kwargs):
+        tracer = self.network.tracer if self.network is not None else None
+        if tracer is None:
+            return method(self, *args, **kwargs)
+
+        with tracer.span(method.__name__, self.node_id):
+            return method(self, *args, **kwargs)
+
+    return traced_method
+
+class TracedRemoteMethod:
+    """
+    Sends a message to a remote node through its TRACED_MESSAGE method, with the sender's
+    trace context ahead of the handler's name and arguments
+    """
+
+    def __init__(self, remote_method, context, handler_name):
+        self.remote_method = remote_method
+        self.context = context
+        self.handler_name = handler_name
+
+    def call_async(self, *args):
+        return self.remote_method.call_async(self.context, self.handler_name, *args)
+
+    def __call__(self, *args):
+        return self.remote_method(self.context, self.handler_name, *args)
+
+def chrome_trace(spans):
+    """
+    Converts spans to a Chrome trace: one "process" per node, complete ("X") events for
+    the spans, and flow events from a parent span to the children it started on another
+    node or thread
+    """
+    events = []
+    spans_by_id = dict((span["span_id"], span) for span in spans)
+    thread_ids = {}
+    num_threads = {}
+
+    # Small thread numbers per node read better than thread idents
+    def thread_id(span):
+        key = (span["node_id"], span["thread"])
+        if key not in thread_ids:
+            thread_ids[key] = num_threads.get(span["node_id"], 0)
+            num_threads[span["node_id"]] = thread_ids[key] + 1
+        return thread_ids[key]
+
+    def pid(node_id):
+        return node_id if node_id is not None else -1
+
+    for node_id in sorted(set(span["node_id"] for span in spans)):
+        events.append({ "name": "process_name", "ph": "M", "pid": pid(node_id), "tid": 0,
+            "args": { "name": "node %s" % node_id if node_id is not None else "driver" } })
+
+    for span in sorted(spans, key=lambda span: span["start"]):
+        events.append({
+            "name": span["name"],
+            "cat": span["category"],
+            "ph": "X",
+            "ts": span["start"] * 1e6,
+            "dur": (span["end"] - span["start"]) * 1e6,
+            "pid": pid(span["node_id"]),
+            "tid": thread_id(span),
+            "args": { "trace_id": _hex_id(span["trace_id"]), "span_id": _hex_id(span["span_id"]),
+                "parent_id": _hex_id(span["parent_id"]) }
+        })
+
+        parent = spans_by_id.get(span["parent_id"])
+        if parent is None or (parent["node_id"], parent["thread"]) == (span["node_id"], span["thread"]):
+            continue
+
+        flow_start = min(max(span["start"], parent["start"]), parent["end"])
+        events.append({ "name": span["name"], "cat": "flow", "ph": "s", "id": _hex_id(span["span_id"]),
+            "ts": flow_start * 1e6, "pid": pid(parent["node_id"]), "tid": thread_id(parent) })
+        events.append({ "name": span["name"], "cat": "flow", "ph": "f", "bp": "e", "id": _hex_id(span["span_id"]),
+            "ts": span["start"] * 1e6, "pid": pid(span["node_id"]), "tid": thread_id(span) })
+
+    return { "traceEvents": events, "displayTimeUnit": "ms" }
+
+def _hex_id(span_id):
+    # Span ids exceed the integers a JavaScript number holds exactly
+    return "%x" % span_id if span_id is not None else None
+
+def _parse_id(span_id):
+    return int(span_id, 16) if span_id is not None else None
+
+def load_chrome_trace_spans(path):
+    """
+    Reads back the spans of a Chrome trace written by export_chrome_trace
+    """
+    with open(path) as input_file:
+        trace = json.load(input_file)
+
+    node_ids = {}
+    threads = {}
+    for event in trace["traceEvents"]:
+        if event["ph"] == "M" and event["name"] == "process_name":
+            name = event["args"]["name"]
+            node_ids[event["pid"]] = None if name == "driver" else int(name[len("node "):])
+
+    spans = []
+    for event in trace["traceEvents"]:
+        if event["ph"] != "X":
+            continue
+        spans.append({
+            "name": event["name"],
+            "category": event["cat"],
+            "node_id": node_ids.get(event["pid"], event["pid"]),
+            "trace_id": _parse_id(event["args"]["trace_id"]),
+            "span_id": _parse_id(event["args"]["span_id"]),
+            "parent_id": _parse_id(event["args"]["parent_id"]),
+            "thread": threads.setdefault((path, event["pid"], event["tid"]), len(threads)),
+            "start": event["ts"] / 1e6,
+            "end": (event["ts"] + event["dur"]) / 1e6
+        })
+    return spans
+
+def merge_chrome_traces(paths, output_path):
+    """
+    Merges the traces exported by the processes of a live cluster (one per node) into a
+    single timeline, linking messages across processes
+    """
+    spans = []
+    for path in paths:
+        spans.extend(load_chrome_trace_spans(path))
+
+    with open(output_path, "w") as output_file:
+        json.dump(chrome_trace(spans), output_file)
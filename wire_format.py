@@ -0,0 +1,280 @@
+from logical_token import Token, FLEXIBILITY_ELEMENT, PRIORITY_ELEMENT, NODE_ID_ELEMENT, SATISFIABLE_ROLES_ELEMENT
+import struct
+
+##################################################################################
+# Compact binary encoding of the messages exchanged between logical nodes, so that
+# they can be sent by value instead of being pickled or proxied. Integers are
+# unsigned LEB128 varints, sorted id lists are delta encoded and priorities are
+# big endian doubles.
+##################################################################################
+
+WIRE_FORMAT_VERSION = 4
+
+ROLE_LIST_ENCODING = 0
+ROLE_BITSET_ENCODING = 1
+
+DOUBLE = struct.Struct("!d")
+
+class WireFormatError(Exception):
+    pass
+
+class Reader:
+    """
+    Sequential reader over an encoded message
+    """
+
+    def __init__(self, data):
+        self.data = bytearray(data)
+        self.position = 0
+
+    def read_varint(self):
+        value = 0
+        shift = 0
+        while True:
+            try:
+                byte = self.data[self.position]
+            except IndexError:
+                raise WireFormatError("truncated message")
+            self.position += 1
+            value |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return value
+            shift += 7
+
+    def read_double(self):
+        if self.position + DOUBLE.size > len(self.data):
+            raise WireFormatError("truncated message")
+        (value,) = DOUBLE.unpack_from(buffer(self.data), self.position)
+        self.position += DOUBLE.size
+        return value
+
+    def read_bytes(self, length):
+        if self.position + length > len(self.data):
+            raise WireFormatError("truncated message")
+        value = self.data[self.position:self.position + length]
+        self.position += length
+        return value
+
+def write_varint(output, value):
+    while value > 0x7F:
+        output.append((value & 0x7F) | 0x80)
+        value >>= 7
+    output.append(value)
+
+def varint_size(value):
+    size = 1
+    while value > 0x7F:
+        value >>= 7
+        size += 1
+    return size
+
+def write_double(output, value):
+    output += DOUBLE.pack(value)
+
+def write_id_list(output, ids):
+    """
+    Writes a list of non-negative ids as a count followed by sorted, delta encoded varints
+    """
+    write_varint(output, len(ids))
+    previous_id = 0
+    for current_id in sorted(ids):
+        write_varint(output, current_id - previous_id)
+        previous_id = current_id
+
+def read_id_list(reader):
+    ids = []
+    previous_id = 0
+    for _ in range(reader.read_varint()):
+        previous_id += reader.read_varint()
+        ids.append(previous_id)
+    return ids
+
+def write_role_set(output, role_ids):
+    """
+    Writes a set of role ids either as an id list or as a bitset, whichever is smaller
+    """
+    list_output = bytearray()
+    write_id_list(list_output, role_ids)
+
+    num_bits = max(role_ids) + 1 if role_ids else 0
+    bitset = bytearray((num_bits + 7) // 8)
+    for role_id in role_ids:
+        bitset[role_id // 8] |= 1 << (role_id % 8)
+
+    if len(bitset) + 1 < len(list_output):
+        output.append(ROLE_BITSET_ENCODING)
+        write_varint(output, num_bits)
+        output += bitset
+    else:
+        output.append(ROLE_LIST_ENCODING)
+        output += list_output
+
+def read_role_set(reader):
+    encoding = reader.read_varint()
+
+    if encoding == ROLE_LIST_ENCODING:
+        return read_id_list(reader)
+
+    elif encoding == ROLE_BITSET_ENCODING:
+        num_bits = reader.read_varint()
+        bitset = reader.read_bytes((num_bits + 7) // 8)
+        return [role_id for role_id in range(num_bits) if bitset[role_id // 8] & (1 << (role_id % 8))]
+
+    raise WireFormatError("unknown role set encoding %d" % encoding)
+
+def write_header(output):
+    output.append(WIRE_FORMAT_VERSION)
+
+def read_header(reader):
+    version = reader.read_varint()
+    if version != WIRE_FORMAT_VERSION:
+        raise WireFormatError("unsupported wire format version %d" % version)
+
+def write_assignment_index(output, assignment_index):
+    write_varint(output, assignment_index[NODE_ID_ELEMENT])
+    write_varint(output, assignment_index[FLEXIBILITY_ELEMENT])
+    write_double(output, assignment_index[PRIORITY_ELEMENT])
+
+def read_assignment_index(reader):
+    node_id = reader.read_varint()
+    flexibility = reader.read_varint()
+    priority = reader.read_double()
+    return (flexibility, priority, node_id)
+
+def encode_assignment_index(assignment_index):
+    output = bytearray()
+    write_header(output)
+    write_assignment_index(output, assignment_index)
+    return bytes(output)
+
+def decode_assignment_index(data):
+    reader = Reader(data)
+    read_header(reader)
+    return read_assignment_index(reader)
+
+def encode_assignment_indexes(assignment_indexes):
+    """
+    Encodes the assignment indexes returned by an "Evaluate Roles" message, including
+    the satisfiable role ids each of them carries
+    """
+    output = bytearray()
+    write_header(output)
+    write_varint(output, len(assignment_indexes))
+    for assignment_index in assignment_indexes:
+        write_assignment_index(output, assignment_index)
+        write_role_set(output, assignment_index[SATISFIABLE_ROLES_ELEMENT])
+    return bytes(output)
+
+def decode_assignment_indexes(data):
+    reader = Reader(data)
+    read_header(reader)
+    assignment_indexes = []
+    for _ in range(reader.read_varint()):
+        assignment_index = read_assignment_index(reader)
+        assignment_indexes.append(assignment_index + (tuple(read_role_set(reader)),))
+    return assignment_indexes
+
+SUBTREE_NODE_IDS_FLAG = 1
+ROLE_IDS_FLAG = 2
+
+def encode_evaluate_roles_message(subtree_node_ids=None, role_ids=None):
+    """
+    Encodes the optional arguments of an "Evaluate Roles" message: the node ids of the
+    receiver's broadcast subtree and the role ids to restrict the evaluation to
+    """
+    output = bytearray()
+    write_header(output)
+    write_varint(output, (SUBTREE_NODE_IDS_FLAG if subtree_node_ids is not None else 0) |
+        (ROLE_IDS_FLAG if role_ids is not None else 0))
+    if subtree_node_ids is not None:
+        write_id_list(output, subtree_node_ids)
+    if role_ids is not None:
+        write_role_set(output, role_ids)
+    return bytes(output)
+
+def decode_evaluate_roles_message(data):
+    """
+    Returns a (subtree_node_ids, role_ids) pair, either of which may be None
+    """
+    reader = Reader(data)
+    read_header(reader)
+    flags = reader.read_varint()
+    subtree_node_ids = read_id_list(reader) if flags & SUBTREE_NODE_IDS_FLAG else None
+    role_ids = read_role_set(reader) if flags & ROLE_IDS_FLAG else None
+    return (subtree_node_ids, role_ids)
+
+def encode_token(token):
+    """
+    Encodes the unassigned roles with the counts that are not one, the live entries of
+    the assignment path, the role candidates that are still in the path, the roles
+    assigned so far and the nodes dropped from the path. Superseded heap entries are
+    not sent.
+    """
+    output = bytearray()
+    write_header(output)
+
+    write_role_set(output, token.unassigned_roles)
+
+    role_counts = sorted((role_id, count) for (role_id, count) in token.role_counts.items() if count != 1)
+    write_varint(output, len(role_counts))
+    previous_role_id = 0
+    for (role_id, count) in role_counts:
+        write_varint(output, role_id - previous_role_id)
+        write_varint(output, count)
+        previous_role_id = role_id
+
+    assignment_indexes = sorted(token.assignment_indexes.values())
+    write_varint(output, len(assignment_indexes))
+    for assignment_index in assignment_indexes:
+        write_assignment_index(output, assignment_index)
+
+    role_candidates = [(role_id, token.candidate_nodes(role_id)) for role_id in sorted(token.role_candidates)]
+    role_candidates = [(role_id, node_ids) for (role_id, node_ids) in role_candidates if node_ids]
+    write_varint(output, len(role_candidates))
+    previous_role_id = 0
+    for (role_id, node_ids) in role_candidates:
+        write_varint(output, role_id - previous_role_id)
+        write_id_list(output, node_ids)
+        previous_role_id = role_id
+
+    write_varint(output, len(token.role_assignments))
+    previous_role_id = 0
+    for (role_id, node_ids) in sorted(token.role_assignments.items()):
+        write_varint(output, role_id - previous_role_id)
+        write_id_list(output, node_ids)
+        previous_role_id = role_id
+
+    write_id_list(output, token.dropped_node_ids)
+
+    return bytes(output)
+
+def decode_token(data):
+    reader = Reader(data)
+    read_header(reader)
+
+    unassigned_roles = read_role_set(reader)
+
+    role_counts = {}
+    role_id = 0
+    for _ in range(reader.read_varint()):
+        role_id += reader.read_varint()
+        role_counts[role_id] = reader.read_varint()
+
+    # Entries were written in sorted order, which is already a valid heap
+    assignment_path = [read_assignment_index(reader) for _ in range(reader.read_varint())]
+
+    role_candidates = {}
+    role_id = 0
+    for _ in range(reader.read_varint()):
+        role_id += reader.read_varint()
+        role_candidates[role_id] = read_id_list(reader)
+
+    role_assignments = {}
+    role_id = 0
+    for _ in range(reader.read_varint()):
+        role_id += reader.read_varint()
+        role_assignments[role_id] = read_id_list(reader)
+
+    dropped_node_ids = read_id_list(reader)
+
+    return Token(unassigned_roles, assignment_path, role_candidates, role_assignments, role_counts, dropped_node_ids)